@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""Controller benchmark
+
+Runs ShortestPathSwitching without ryu-manager, Mininet or OVS: the
+topology generators of benchmark.py are turned into the Ryu topology
+events the app handles (EventSwitchEnter, EventLinkAdd, EventHostAdd),
+and every switch is a FakeDatapath that records the messages the app
+sends and answers its barriers at once.
+
+For every topology and size it reports:
+
+* convergence -- wall time from the first switch event until every
+                 FlowMod batch was confirmed
+* flow_mods   -- FlowMods sent (and packet-outs, barriers, bytes)
+* rules       -- forwarding rules left installed on all switches, and
+                 the routes per rule (SPS_COMPRESS=1 compresses them)
+* failover    -- mean time from cutting a link until a route that used
+                 it was moved off it: by the controller's rule swap with
+                 SPS_FAST_FAILOVER=1 (failover_coverage is the share of
+                 routes it moved), by the route recompute otherwise;
+                 repair is the time until the recompute completed
+* peak_memory -- tracemalloc peak over a second, traced run
+
+Results are printed as a table, or as JSON with --json so that runs can
+be stored and compared.
+
+Usage:
+
+    python3 app_benchmark.py --sizes 20 80 --topos fattree mesh --json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser
+from ryu.topology import event, switches
+
+import shortest_paths
+from benchmark import TOPOLOGIES, switch_count
+
+_HEADER = struct.Struct('!BBHI')
+
+
+class FakeDatapath(object):
+    """
+    Stand-in for ryu.controller.controller.Datapath that serializes and
+    counts what the app sends instead of writing it to a socket.
+
+    on_barrier -- Called with (datapath, xid) for every barrier request,
+                  to answer it
+    """
+
+    ofproto = ofproto_v1_0
+    ofproto_parser = ofproto_v1_0_parser
+
+    def __init__(self, dpid, on_barrier=None):
+        self.id = dpid
+        self.xid = 0
+        self.on_barrier = on_barrier
+        self.counts = {}  # OpenFlow message type -> messages
+        self.bytes = 0
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        self.send(msg.buf)
+
+    def send(self, buf):
+        self.bytes += len(buf)
+        offset = 0
+        while offset < len(buf):
+            _, msg_type, length, xid = _HEADER.unpack_from(buf, offset)
+            self.counts[msg_type] = self.counts.get(msg_type, 0) + 1
+            if (msg_type == ofproto_v1_0.OFPT_BARRIER_REQUEST and
+                    self.on_barrier is not None):
+                self.on_barrier(self, xid)
+            offset += length
+
+    def send_packet_out(self, buffer_id=0xffffffff, in_port=None,
+                        actions=None, data=None):
+        if in_port is None:
+            in_port = self.ofproto.OFPP_NONE
+        self.send_msg(self.ofproto_parser.OFPPacketOut(
+            self, buffer_id, in_port, actions, data))
+
+    def count(self, msg_type):
+        return self.counts.get(msg_type, 0)
+
+
+def _hw_addr(dpid, port_no):
+    return '0a:%02x:%02x:%02x:%02x:%02x' % (
+        (dpid >> 24) & 0xff, (dpid >> 16) & 0xff, (dpid >> 8) & 0xff,
+        dpid & 0xff, port_no & 0xff)
+
+
+def _host_mac(dpid):
+    return '00:00:%02x:%02x:%02x:%02x' % (
+        (dpid >> 24) & 0xff, (dpid >> 16) & 0xff,
+        (dpid >> 8) & 0xff, dpid & 0xff)
+
+
+def build_events(n, links, on_barrier):
+    """
+    Return the datapaths and the Ryu topology events of n switches, the
+    links and one host per switch (on port 1), in the order the app
+    would see them
+    """
+    last_port = dict.fromkeys(range(1, n + 1), 1)
+    link_ports = []
+    for a, b in links:
+        last_port[a] += 1
+        last_port[b] += 1
+        link_ports.append(((a, last_port[a]), (b, last_port[b])))
+
+    datapaths = {}
+    ryu_switches = {}
+    events = []
+    for dpid in range(1, n + 1):
+        dp = FakeDatapath(dpid, on_barrier)
+        switch = switches.Switch(dp)
+        for port_no in range(1, last_port[dpid] + 1):
+            switch.add_port(ofproto_v1_0_parser.OFPPhyPort(
+                port_no, _hw_addr(dpid, port_no), b'eth%d' % port_no,
+                0, 0, 0, 0, 0, 0))
+        datapaths[dpid] = dp
+        ryu_switches[dpid] = switch
+        events.append(event.EventSwitchEnter(switch))
+
+    def port(dpid, port_no):
+        return ryu_switches[dpid].ports[port_no - 1]
+
+    for (a, port_a), (b, port_b) in link_ports:
+        src, dst = port(a, port_a), port(b, port_b)
+        events.append(event.EventLinkAdd(switches.Link(src, dst)))
+        events.append(event.EventLinkAdd(switches.Link(dst, src)))
+    for dpid in range(1, n + 1):
+        host = switches.Host(_host_mac(dpid), port(dpid, 1))
+        host.ipv4.append('10.%d.%d.%d' % (
+            (dpid >> 16) & 0xff, (dpid >> 8) & 0xff, dpid & 0xff))
+        events.append(event.EventHostAdd(host))
+    return datapaths, events
+
+
+def converge(n, links, burst=False):
+    """
+    Feed the topology events of one topology to a fresh app.  Returns
+    the app, the datapaths, the events and the convergence time in
+    seconds.
+    """
+    app = shortest_paths.ShortestPathSwitching()
+    app.logger.setLevel(logging.ERROR)
+    if burst:
+        # Hold every event in a single burst, flushed below
+        app.coalescer.window = app.coalescer.max_delay = float('inf')
+    else:
+        app.coalescer.window = 0
+
+    def on_barrier(dp, xid):
+        reply = ofproto_v1_0_parser.OFPBarrierReply(dp)
+        reply.xid = xid
+        app.barrier_reply_handler(ofp_event.EventOFPBarrierReply(reply))
+
+    datapaths, events = build_events(n, links, on_barrier)
+    handlers = {
+        event.EventSwitchEnter: app.handle_switch_add,
+        event.EventLinkAdd: app.handle_link_add,
+        event.EventHostAdd: app.handle_host_add,
+    }
+    # Convergence is checked on the barrier replies (every FlowMod batch
+    # confirmed), not on stdout, which only has the rule dumps of a run
+    # with SPS_TRACE set; keep those out of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for ev in events:
+            handlers[type(ev)](ev)
+        app.coalescer.flush()
+        elapsed = time.perf_counter() - start
+    pending = sum(len(w) for w in app.barrier_waiters.values())
+    if pending:
+        raise RuntimeError("%d FlowMod batches left unconfirmed" % pending)
+    return app, datapaths, events, elapsed
+
+
+def _routes_on(app, port):
+    """Return the number of routes of the switch of port leaving by it"""
+    table = app.flow_tables.get(port.dpid)
+    if table is None:
+        return 0
+    return sum(1 for p in table.routes.values()
+               if p == port.port_no or
+               isinstance(p, tuple) and port.port_no in p)
+
+
+def measure_failover(app, events, samples=20):
+    """
+    Cut up to `samples` links of a converged app, one at a time, and
+    restore each one afterwards.  Returns the mean seconds until a route
+    that used a cut link was moved off it, the share of those routes the
+    link-delete handlers moved before the recompute, and the mean
+    seconds until the recompute completed.
+    """
+    links = [ev.link for ev in events if isinstance(ev, event.EventLinkAdd)]
+    # The two directions of a link are consecutive
+    links = links[0::2]
+    if not links or samples <= 0:
+        return None, None, None
+    links = links[::max(1, len(links) // samples)][:samples]
+    window = app.coalescer.window
+    app.coalescer.window = None
+    affected = swapped = 0
+    failover = repair = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for link in links:
+            reverse = switches.Link(link.dst, link.src)
+            before = _routes_on(app, link.src) + _routes_on(app, link.dst)
+            start = time.perf_counter()
+            app.handle_link_delete(event.EventLinkDelete(link))
+            app.handle_link_delete(event.EventLinkDelete(reverse))
+            moved = time.perf_counter()
+            left = _routes_on(app, link.src) + _routes_on(app, link.dst)
+            flush_start = time.perf_counter()
+            app.coalescer.flush()
+            done = moved + time.perf_counter() - flush_start
+            affected += before
+            swapped += before - left
+            failover += (before - left) * (moved - start) + left * (
+                done - start)
+            repair += done - start
+            app.handle_link_add(event.EventLinkAdd(link))
+            app.handle_link_add(event.EventLinkAdd(reverse))
+            app.coalescer.flush()
+    app.coalescer.window = window
+    if not affected:
+        return None, None, repair / len(links)
+    return (failover / affected, float(swapped) / affected,
+            repair / len(links))
+
+
+def run(n, topo, burst=False, memory=True, failover_samples=20):
+    links = TOPOLOGIES[topo](n)
+    n = switch_count(n, links)
+    app, datapaths, events, elapsed = converge(n, links, burst)
+
+    ofp = ofproto_v1_0
+    result = {
+        'topo': topo, 'switches': n, 'links': len(links), 'hosts': n,
+        'burst': burst, 'convergence': elapsed,
+        'flow_mods': sum(dp.count(ofp.OFPT_FLOW_MOD)
+                         for dp in datapaths.values()),
+        'packet_outs': sum(dp.count(ofp.OFPT_PACKET_OUT)
+                           for dp in datapaths.values()),
+        'barriers': sum(dp.count(ofp.OFPT_BARRIER_REQUEST)
+                        for dp in datapaths.values()),
+        'bytes': sum(dp.bytes for dp in datapaths.values()),
+        'bursts': app.coalescer.bursts,
+        'rules': sum(len(t.installed) for t in app.flow_tables.values()),
+        'peak_memory': None,
+    }
+    result['compression'] = (sum(len(t.routes) for t in
+                                 app.flow_tables.values()) /
+                             max(result['rules'], 1))
+    (result['failover'], result['failover_coverage'],
+     result['repair']) = measure_failover(app, events, failover_samples)
+    del app, datapaths, events
+
+    if memory:
+        # tracemalloc slows everything down, so memory is measured on a
+        # run of its own
+        tracemalloc.start()
+        try:
+            converge(n, links, burst)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Controller benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 80])
+    parser.add_argument('--topos', nargs='+',
+                        default=['fattree', 'mesh', 'linear', 'regular'],
+                        choices=sorted(TOPOLOGIES))
+    parser.add_argument('--burst', action='store_true',
+                        help="coalesce all events into one recompute")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="skip the tracemalloc run")
+    parser.add_argument('--failover-samples', type=int, default=20,
+                        help="links cut to measure failover (0: none)")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    if not args.json:
+        print("%-8s %8s %8s %12s %10s %10s %8s %12s %12s" %
+              ('topo', 'switches', 'links', 'converge(s)', 'flowmods',
+               'barriers', 'rules', 'failover(ms)', 'peak(KiB)'))
+    for topo in args.topos:
+        for n in args.sizes:
+            r = run(n, topo, args.burst, args.memory, args.failover_samples)
+            results.append(r)
+            if not args.json:
+                peak = r['peak_memory']
+                failover = r['failover']
+                print("%-8s %8d %8d %12.3f %10d %10d %8d %12s %12s" %
+                      (r['topo'], r['switches'], r['links'],
+                       r['convergence'], r['flow_mods'], r['barriers'],
+                       r['rules'],
+                       '-' if failover is None else
+                       '%.3f' % (failover * 1000),
+                       '-' if peak is None else '%d' % (peak // 1024)))
+    if args.json:
+        json.dump({'benchmark': 'controller',
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'route_engine': shortest_paths.ROUTE_ENGINE,
+                   'ecmp': shortest_paths.ECMP,
+                   'compress': shortest_paths.COMPRESS,
+                   'fast_failover': shortest_paths.FAST_FAILOVER,
+                   'results': results},
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Pre-serialized ARP replies
+
+The controller answers every ARP request for a known host itself.
+Building the reply with ryu.lib.packet costs far more than the rest of
+the packet-in, yet a reply only depends on the requester (MAC, IP) and
+the target IP, whose MAC comes from the stable ARP table.
+
+ArpReplyCache keeps, per target IP, a reply template with the sender
+fields already filled in, and the finished replies per requester.
+Entries of a target IP are dropped when its ARP table entry changes.
+
+"""
+
+import struct
+
+from ryu.lib import addrconv
+from ryu.lib.packet import arp
+from ryu.ofproto import ether
+
+# Ethernet + ARP header of an untagged reply
+_REPLY = struct.Struct('!6s6sHHHBBH6s4s6s4s')
+_ETH_DST = slice(0, 6)
+_TARGET_MAC = slice(32, 38)
+_TARGET_IP = slice(38, 42)
+# ryu.lib.packet pads frames to the Ethernet minimum, so do the same
+_PADDING = b'\x00' * (60 - _REPLY.size)
+
+
+class ArpReplyCache(object):
+    """Encoded ARP replies keyed on (requester MAC, requester IP, target IP)
+
+    max_entries -- Upper bound on the number of cached replies; the cache
+                   starts over when it is reached
+    """
+
+    def __init__(self, max_entries=4096):
+        super(ArpReplyCache, self).__init__()
+        self.max_entries = max_entries
+        self.templates = {}  # target ip -> bytes with the sender filled in
+        self.replies = {}    # target ip -> {(req mac, req ip): bytes}
+        self.size = 0
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    def reply(self, requester_mac, requester_ip, target_ip, target_mac):
+        """Return the encoded reply telling requester that target_ip is
+        at target_mac"""
+        replies = self.replies.get(target_ip)
+        if replies is not None:
+            data = replies.get((requester_mac, requester_ip))
+            if data is not None:
+                self.hits += 1
+                return data
+        self.misses += 1
+
+        template = self.templates.get(target_ip)
+        if template is None:
+            target = addrconv.mac.text_to_bin(target_mac)
+            template = _REPLY.pack(
+                b'\x00' * 6, target, ether.ETH_TYPE_ARP, 1,
+                ether.ETH_TYPE_IP, 6, 4, arp.ARP_REPLY,
+                target, addrconv.ipv4.text_to_bin(target_ip),
+                b'\x00' * 6, b'\x00' * 4) + _PADDING
+            self.templates[target_ip] = template
+
+        mac = addrconv.mac.text_to_bin(requester_mac)
+        data = bytearray(template)
+        data[_ETH_DST] = mac
+        data[_TARGET_MAC] = mac
+        data[_TARGET_IP] = addrconv.ipv4.text_to_bin(requester_ip)
+        data = bytes(data)
+
+        if self.size >= self.max_entries:
+            self.replies.clear()
+            self.size = 0
+        self.replies.setdefault(target_ip, {})[
+            (requester_mac, requester_ip)] = data
+        self.size += 1
+        return data
+
+    def invalidate(self, ip):
+        """Forget everything cached for a target IP"""
+        self.templates.pop(ip, None)
+        replies = self.replies.pop(ip, None)
+        if replies is not None:
+            self.size -= len(replies)
+
+    def clear(self):
+        self.templates.clear()
+        self.replies.clear()
+        self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': self.size, 'templates': len(self.templates)}
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Route engine benchmark
+
+Builds synthetic topologies straight into a TopoManager (no Mininet or
+switches needed) with one host per switch, like MeshTopo, and times the
+route engines on them:
+
+* build    -- computing the routes of every host from scratch
+* link_del -- repairing the routes after one link failure
+
+Usage:
+
+    python3 benchmark.py --sizes 100 1000 5000 --topos tree random
+"""
+
+import argparse
+import collections
+import random
+import time
+
+from topo_manager_example import TopoManager, TMSwitch, TMHost
+from route_engine import RouteEngine, MatrixRouteEngine
+
+FakeDatapath = collections.namedtuple('FakeDatapath', 'id')
+FakeSwitch = collections.namedtuple('FakeSwitch', 'dp ports')
+FakePort = collections.namedtuple('FakePort', 'dpid port_no')
+FakeHost = collections.namedtuple('FakeHost', 'mac ipv4 port')
+
+ENGINES = collections.OrderedDict([
+    ('incremental', RouteEngine),
+    ('matrix', MatrixRouteEngine),
+])
+
+
+def linear_links(n):
+    return [(i, i + 1) for i in range(1, n)]
+
+
+def tree_links(n, fanout=2):
+    """Links of a complete tree like TreeTopo, cut off after n switches"""
+    return [(1 + (i - 2) // fanout, i) for i in range(2, n + 1)]
+
+
+def mesh_links(n):
+    return [(i, j) for i in range(1, n + 1) for j in range(i + 1, n + 1)]
+
+
+def random_links(n, degree=4, seed=1):
+    """A connected random graph: a random spanning tree plus extra links
+    until the average degree is reached"""
+    rnd = random.Random(seed)
+    links = set()
+    for i in range(2, n + 1):
+        links.add((rnd.randint(1, i - 1), i))
+    while len(links) < n * degree // 2:
+        a, b = sorted(rnd.sample(range(1, n + 1), 2))
+        links.add((a, b))
+    return sorted(links)
+
+
+def fat_tree_links(n):
+    """Links of the largest k-ary fat tree with at most n switches
+    (5k^2/4 of them): (k/2)^2 core switches, then k pods of k/2
+    aggregation and k/2 edge switches"""
+    k = 2
+    while 5 * (k + 2) ** 2 // 4 <= n:
+        k += 2
+    half = k // 2
+    links = []
+    for pod in range(k):
+        agg = half * half + 1 + pod * k
+        edge = agg + half
+        for i in range(half):
+            for j in range(half):
+                links.append((1 + i * half + j, agg + i))
+                links.append((agg + i, edge + j))
+    return links
+
+
+def random_regular_links(n, degree=4, seed=1):
+    """A random graph where every switch has the same degree, built by
+    pairing link stubs at random and starting over on a dead end"""
+    rnd = random.Random(seed)
+    if n <= degree or n * degree % 2:
+        raise ValueError("no %d-regular graph on %d switches" % (degree, n))
+    while True:
+        stubs = [i for i in range(1, n + 1) for _ in range(degree)]
+        links = set()
+        while stubs:
+            a = stubs.pop(rnd.randrange(len(stubs)))
+            for _ in range(100):
+                i = rnd.randrange(len(stubs))
+                b = stubs[i]
+                if b != a and (min(a, b), max(a, b)) not in links:
+                    break
+            else:
+                break
+            stubs[i] = stubs[-1]
+            stubs.pop()
+            links.add((min(a, b), max(a, b)))
+        if not stubs:
+            return sorted(links)
+
+
+TOPOLOGIES = {
+    'linear': linear_links,
+    'tree': tree_links,
+    'mesh': mesh_links,
+    'random': random_links,
+    'fattree': fat_tree_links,
+    'regular': random_regular_links,
+}
+
+
+def switch_count(n, links):
+    """Return the number of switches a generator actually used"""
+    return max(max(link) for link in links) if links else n
+
+
+def build_topology(n, links):
+    """Return a TopoManager holding n switches, the links and one host
+    per switch (on port 1), and the list of link port pairs"""
+    tm = TopoManager()
+    ports = collections.defaultdict(lambda: [1])  # dpid -> [last port]
+    pairs = []
+    for a, b in links:
+        ports[a][0] += 1
+        ports[b][0] += 1
+        pairs.append((FakePort(a, ports[a][0]), FakePort(b, ports[b][0])))
+    for dpid in range(1, n + 1):
+        switch_ports = [FakePort(dpid, p)
+                        for p in range(1, ports[dpid][0] + 1)]
+        tm.add_switch(TMSwitch('s%d' % dpid,
+                               FakeSwitch(FakeDatapath(dpid), switch_ports)))
+    for src, dst in pairs:
+        tm.add_link(src, dst)
+    for dpid in range(1, n + 1):
+        mac = '00:00:%02x:%02x:%02x:%02x' % (
+            (dpid >> 24) & 0xff, (dpid >> 16) & 0xff,
+            (dpid >> 8) & 0xff, dpid & 0xff)
+        host = TMHost(mac, FakeHost(mac, [], FakePort(dpid, 1)))
+        tm.add_host(host)
+        tm.attach_host(host, tm.switches[dpid])
+    return tm, pairs
+
+
+def run(engine_cls, n, topo, seed=1):
+    links = TOPOLOGIES[topo](n)
+    n = switch_count(n, links)
+    tm, pairs = build_topology(n, links)
+    engine = engine_cls(tm)
+    dests = [(mac, host.get_port().dpid, host.get_port().port_no)
+             for mac, host in tm.hosts.items()]
+
+    start = time.perf_counter()
+    routes = engine.add_destinations(dests)
+    build = time.perf_counter() - start
+
+    src, dst = random.Random(seed).choice(pairs)
+    tm.delete_link(src, dst)
+    start = time.perf_counter()
+    changes = engine.link_deleted(src.dpid, dst.dpid)
+    link_del = time.perf_counter() - start
+
+    return {'engine': engine_cls.__name__, 'topo': topo, 'switches': n,
+            'links': len(pairs), 'routes': len(routes),
+            'build': build, 'link_del': link_del, 'changed': len(changes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route engine benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 5000])
+    parser.add_argument('--topos', nargs='+', default=['tree', 'random'],
+                        choices=sorted(TOPOLOGIES))
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES),
+                        choices=list(ENGINES))
+    args = parser.parse_args()
+
+    print("%-18s %-7s %8s %8s %10s %10s %10s %8s" %
+          ('engine', 'topo', 'switches', 'links', 'routes', 'build(s)',
+           'linkdel(s)', 'changed'))
+    for topo in args.topos:
+        for n in args.sizes:
+            for name in args.engines:
+                r = run(ENGINES[name], n, topo)
+                print("%-18s %-7s %8d %8d %10d %10.3f %10.4f %8d" %
+                      (r['engine'], r['topo'], r['switches'], r['links'],
+                       r['routes'], r['build'], r['link_del'],
+                       r['changed']))
+
+
+if __name__ == '__main__':
+    main()
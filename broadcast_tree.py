@@ -0,0 +1,252 @@
+"""Spanning-tree broadcast
+
+Broadcasts (ARP requests for unknown hosts above all) must reach every
+host without looping around the cycles of the switch graph.  The
+controller keeps a spanning forest of the TopoGraph and every switch
+replicates broadcasts only over its tree ports and its edge (host
+facing) ports:
+
+* a broadcast arriving on a tree port is flooded to the other tree and
+  edge ports in the data plane;
+* a broadcast arriving on an edge port goes to the controller, which
+  answers it (proxy ARP) or injects it into the tree.
+
+The tree is kept up to date incrementally: a new link only joins two
+trees, and a deleted tree link is replaced by any link reconnecting the
+two halves, found by searching the smaller half.
+
+"""
+
+import collections
+from array import array
+
+from flow_table import FLOW_ADD, FLOW_MODIFY, FLOW_DELETE
+
+NO_COMPONENT = -1
+
+
+class SpanningTree(object):
+    """Spanning forest over the switches of a TopoGraph
+
+    tree -- node id -> set of neighbour node ids joined by a tree link
+    comp -- node id -> component label
+    """
+
+    def __init__(self, graph):
+        super(SpanningTree, self).__init__()
+        self.graph = graph
+        self.tree = collections.defaultdict(set)
+        self.comp = array('i')
+        self.sizes = {}  # component label -> switch count
+        self._next_label = 0
+
+    def _label(self):
+        self._next_label += 1
+        return self._next_label
+
+    def _grow(self):
+        missing = len(self.graph) - len(self.comp)
+        if missing > 0:
+            self.comp.extend(array('i', [NO_COMPONENT]) * missing)
+
+    def _component(self, nid):
+        """Return the node ids reachable from nid over tree links"""
+        seen = {nid}
+        stack = [nid]
+        while stack:
+            n = stack.pop()
+            for peer in self.tree[n]:
+                if peer not in seen:
+                    seen.add(peer)
+                    stack.append(peer)
+        return seen
+
+    def _relabel(self, nodes, label):
+        old = self.comp[next(iter(nodes))]
+        for n in nodes:
+            self.comp[n] = label
+        self.sizes[label] = self.sizes.get(label, 0) + len(nodes)
+        if old in self.sizes:
+            self.sizes[old] -= len(nodes)
+            if self.sizes[old] <= 0:
+                del self.sizes[old]
+
+    def _join(self, a, b):
+        """Add the tree link a <-> b, merging the smaller component into
+        the larger one"""
+        if self.sizes.get(self.comp[a], 0) < self.sizes.get(self.comp[b], 0):
+            a, b = b, a
+        self._relabel(self._component(b), self.comp[a])
+        self.tree[a].add(b)
+        self.tree[b].add(a)
+
+    # ------------------------------------------------------------------
+    # Queries
+
+    def tree_ports(self, nid):
+        """Return the local ports of a switch that are on tree links"""
+        ports = []
+        for peer in self.tree.get(nid, ()):
+            port = self.graph.port_to(nid, peer)
+            if port is not None:
+                ports.append(port)
+        return sorted(ports)
+
+    # ------------------------------------------------------------------
+    # Updates; each returns the set of node ids whose tree ports changed
+
+    def rebuild(self):
+        """Recompute the whole forest with a BFS from every component"""
+        self._grow()
+        changed = {n for n, peers in self.tree.items() if peers}
+        self.tree.clear()
+        self.sizes.clear()
+        for n in range(len(self.comp)):
+            self.comp[n] = NO_COMPONENT
+        for root in range(len(self.graph)):
+            if not self.graph.is_up(root) or self.comp[root] != NO_COMPONENT:
+                continue
+            label = self._label()
+            self.comp[root] = label
+            self.sizes[label] = 1
+            q = collections.deque([root])
+            while q:
+                n = q.popleft()
+                for peer in self.graph.adj[n]:
+                    if self.comp[peer] == NO_COMPONENT:
+                        self.comp[peer] = label
+                        self.sizes[label] += 1
+                        self.tree[n].add(peer)
+                        self.tree[peer].add(n)
+                        changed.update((n, peer))
+                        q.append(peer)
+        return changed
+
+    def switch_added(self, nid):
+        self._grow()
+        if self.comp[nid] == NO_COMPONENT:
+            label = self._label()
+            self.comp[nid] = label
+            self.sizes[label] = 1
+        return set()
+
+    def switch_removed(self, nid):
+        self._grow()
+        changed = set()
+        for peer in list(self.tree.get(nid, ())):
+            changed |= self.link_deleted(nid, peer)
+        label = self.comp[nid]
+        if label in self.sizes:
+            self.sizes[label] -= 1
+            if self.sizes[label] <= 0:
+                del self.sizes[label]
+        self.comp[nid] = NO_COMPONENT
+        self.tree.pop(nid, None)
+        return changed
+
+    def link_added(self, a, b):
+        self._grow()
+        for n in (a, b):
+            if self.comp[n] == NO_COMPONENT and self.graph.is_up(n):
+                self.switch_added(n)
+        if (self.comp[a] == NO_COMPONENT or self.comp[a] == self.comp[b] or
+                self.graph.port_to(a, b) is None):
+            return set()
+        self._join(a, b)
+        return {a, b}
+
+    def link_deleted(self, a, b):
+        self._grow()
+        if b not in self.tree.get(a, ()):
+            return set()
+        if self.graph.port_to(a, b) is not None and self.graph.is_up(a) \
+                and self.graph.is_up(b):
+            # Re-added within the same burst: the tree link still holds
+            return set()
+        self.tree[a].discard(b)
+        self.tree[b].discard(a)
+        changed = {a, b}
+
+        # Search both halves in lockstep and split off the smaller one
+        sides = [({a}, [a]), ({b}, [b])]
+        small = None
+        while small is None:
+            for seen, stack in sides:
+                if not stack:
+                    small = seen
+                    break
+                n = stack.pop()
+                for peer in self.tree[n]:
+                    if peer not in seen:
+                        seen.add(peer)
+                        stack.append(peer)
+        old = self.comp[a]
+        self._relabel(small, self._label())
+
+        # Reconnect the halves over any other link between them
+        for n in small:
+            if not self.graph.is_up(n):
+                continue
+            for peer in self.graph.adj[n]:
+                if self.comp[peer] == old and self.graph.is_up(peer):
+                    self.tree[n].add(peer)
+                    self.tree[peer].add(n)
+                    self._relabel(small, old)
+                    changed.update((n, peer))
+                    return changed
+        return changed
+
+
+class FloodTable(object):
+    """Desired and installed broadcast rules of one datapath
+
+    Rules are keyed by in_port; the value is the tuple of output ports a
+    broadcast arriving there is replicated to.
+    """
+
+    def __init__(self, dpid):
+        self.dpid = dpid
+        self.desired = {}    # in_port -> out ports
+        self.installed = {}  # in_port -> out ports
+
+    def set_ports(self, tree_ports, edge_ports, controller_port):
+        """Flood from tree ports to all other tree and edge ports, and
+        send what arrives on edge ports to the controller"""
+        flood = sorted(set(tree_ports) | set(edge_ports))
+        self.desired = {}
+        for port in tree_ports:
+            self.desired[port] = tuple(p for p in flood if p != port)
+        for port in edge_ports:
+            if port not in self.desired:
+                self.desired[port] = (controller_port,)
+
+    def flood_ports(self, in_port):
+        """Return the ports a broadcast injected at in_port goes out of"""
+        return sorted(p for p in self.desired if p != in_port)
+
+    def clear(self):
+        self.desired.clear()
+        self.installed.clear()
+
+    def sync(self):
+        """
+        Return the (command, in_port, out_ports) operations that turn the
+        installed rules into the desired ones, and record them as
+        installed.
+        """
+        ops = []
+        for port in sorted(set(self.desired) | set(self.installed)):
+            want = self.desired.get(port)
+            have = self.installed.get(port)
+            if want == have:
+                continue
+            if have is None:
+                ops.append((FLOW_ADD, port, want))
+                self.installed[port] = want
+            elif want is None:
+                ops.append((FLOW_DELETE, port, have))
+                del self.installed[port]
+            else:
+                ops.append((FLOW_MODIFY, port, want))
+                self.installed[port] = want
+        return ops
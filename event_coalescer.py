@@ -0,0 +1,87 @@
+"""Topology event coalescing
+
+Switches, links and hosts are announced by Ryu one event at a time, and
+a Mininet start-up produces them in bursts of hundreds.  EventCoalescer
+collects the topology mutations of a burst and hands them over in one
+go once no new event arrived for `window` seconds (or `max_delay`
+seconds after the first one at the latest), so routes are recomputed and
+installed once per burst instead of once per event.
+
+"""
+
+import time
+
+from ryu.lib import hub
+
+
+class EventCoalescer(object):
+    """Debounce topology mutations into bursts
+
+    flush         -- Called with the list of mutations of one burst
+    request_flush -- Called from a timer greenlet when a burst is ready;
+                     it should make the owner call flush() from its own
+                     event loop.  Defaults to calling flush() directly.
+    window        -- Quiet time (seconds) that ends a burst; with 0 every
+                     mutation is flushed immediately, with None only an
+                     explicit flush() ends a burst
+    max_delay     -- Upper bound (seconds) on how long a burst is held
+    """
+
+    def __init__(self, flush, request_flush=None, window=0.05,
+                 max_delay=1.0):
+        super(EventCoalescer, self).__init__()
+        self._flush = flush
+        self._request_flush = request_flush or self.flush
+        self.window = window
+        self.max_delay = max_delay
+        self.pending = []
+        self._timer = None
+        self._first_at = None
+        self._last_at = None
+
+        # Metrics
+        self.events = 0      # mutations received
+        self.bursts = 0      # flushes run
+        self.merged = 0      # mutations that did not cost a recompute
+        self.max_burst = 0
+        self.last_burst = 0
+
+    def add(self, mutation):
+        now = time.time()
+        if not self.pending:
+            self._first_at = now
+        self._last_at = now
+        self.pending.append(mutation)
+        self.events += 1
+        if self.window is None:
+            return
+        if self.window <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = hub.spawn(self._wait_for_quiet)
+
+    def _wait_for_quiet(self):
+        while True:
+            hub.sleep(self.window)
+            now = time.time()
+            if (now - self._last_at >= self.window or
+                    now - self._first_at >= self.max_delay):
+                break
+        self._timer = None
+        self._request_flush()
+
+    def flush(self):
+        """Hand all pending mutations to the flush callback"""
+        mutations, self.pending = self.pending, []
+        if not mutations:
+            return
+        self.bursts += 1
+        self.merged += len(mutations) - 1
+        self.last_burst = len(mutations)
+        self.max_burst = max(self.max_burst, len(mutations))
+        self._flush(mutations)
+
+    def stats(self):
+        return {'events': self.events, 'bursts': self.bursts,
+                'merged': self.merged, 'max_burst': self.max_burst,
+                'last_burst': self.last_burst}
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""Topology event traces
+
+TraceRecorder appends every topology and packet-in event the app
+handles to a compact binary file; the app records one when
+SPS_TRACE_FILE is set.  replay() feeds a trace back into the handlers
+of a fresh app offline, with FakeDatapaths standing in for the switches,
+so a convergence stall seen in production can be reproduced and
+profiled anywhere:
+
+    SPS_TRACE_FILE=/tmp/sps.trace ryu-manager --observe-links \\
+        shortest_paths.py
+    python3 -m cProfile -s cumtime event_trace.py /tmp/sps.trace
+
+Bursts are cut from the recorded timestamps with the app's coalescing
+window, so a replay is deterministic whether it runs as fast as
+possible or in real time (--realtime).
+
+File layout: the magic and a version, then one record per event:
+timestamp (double), kind (byte), payload length and payload.  All
+integers are big-endian.
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import socket
+import struct
+import time
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser
+from ryu.topology import event, switches
+
+TRACE_MAGIC = b'SPSTRACE'
+TRACE_VERSION = 1
+
+# Record kinds
+SWITCH_ENTER = 1
+SWITCH_LEAVE = 2
+LINK_ADD = 3
+LINK_DELETE = 4
+HOST_ADD = 5
+HOST_MOVE = 6
+PORT_ADD = 7
+PORT_DELETE = 8
+PORT_MODIFY = 9
+PACKET_IN = 10
+
+_HEADER = struct.Struct('!8sH')
+_RECORD = struct.Struct('!dBI')
+_SWITCH = struct.Struct('!QH')
+_PORT = struct.Struct('!QH6sII')    # dpid, port_no, hw_addr, config, state
+_HOST = struct.Struct('!6sB')       # mac, IPv4 address count
+_PACKET_IN = struct.Struct('!QIHHB')  # dpid, buffer_id, total_len,
+                                      # in_port, reason
+
+
+def _mac_bin(mac):
+    return bytes.fromhex(mac.replace(':', ''))
+
+
+def _encode_port(port):
+    return _PORT.pack(port.dpid, port.port_no, _mac_bin(port.hw_addr),
+                      getattr(port, '_config', 0), getattr(port, '_state', 0))
+
+
+def _encode_switch(switch):
+    return (_SWITCH.pack(switch.dp.id, len(switch.ports)) +
+            b''.join(_encode_port(p) for p in switch.ports))
+
+
+def _encode_host(host):
+    return (_HOST.pack(_mac_bin(host.mac), len(host.ipv4)) +
+            b''.join(socket.inet_aton(ip) for ip in host.ipv4) +
+            _encode_port(host.port))
+
+
+def _encode_packet_in(msg):
+    if msg.datapath.ofproto.OFP_VERSION == ofproto_v1_0.OFP_VERSION:
+        in_port = msg.in_port
+    else:
+        in_port = msg.match['in_port']
+    return _PACKET_IN.pack(msg.datapath.id, msg.buffer_id, msg.total_len,
+                           in_port, msg.reason) + bytes(msg.data)
+
+
+_ENCODERS = {
+    event.EventSwitchEnter: (SWITCH_ENTER, lambda ev: _encode_switch(
+        ev.switch)),
+    event.EventSwitchLeave: (SWITCH_LEAVE, lambda ev: _encode_switch(
+        ev.switch)),
+    event.EventLinkAdd: (LINK_ADD, lambda ev: (
+        _encode_port(ev.link.src) + _encode_port(ev.link.dst))),
+    event.EventLinkDelete: (LINK_DELETE, lambda ev: (
+        _encode_port(ev.link.src) + _encode_port(ev.link.dst))),
+    event.EventHostAdd: (HOST_ADD, lambda ev: _encode_host(ev.host)),
+    event.EventHostMove: (HOST_MOVE, lambda ev: (
+        _encode_host(ev.src) + _encode_host(ev.dst))),
+    event.EventPortAdd: (PORT_ADD, lambda ev: _encode_port(ev.port)),
+    event.EventPortDelete: (PORT_DELETE, lambda ev: _encode_port(ev.port)),
+    event.EventPortModify: (PORT_MODIFY, lambda ev: _encode_port(ev.port)),
+    ofp_event.EventOFPPacketIn: (PACKET_IN, lambda ev: _encode_packet_in(
+        ev.msg)),
+}
+
+
+class TraceRecorder(object):
+    """Append events to a trace file
+
+    Every record is flushed at once so the trace survives a crash of
+    the controller.
+    """
+
+    def __init__(self, path):
+        super(TraceRecorder, self).__init__()
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.records = 0
+
+    def record(self, ev, timestamp=None):
+        encoder = _ENCODERS.get(type(ev))
+        if encoder is None or self.file is None:
+            return
+        kind, encode = encoder
+        payload = encode(ev)
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(_RECORD.pack(timestamp, kind, len(payload)) +
+                        payload)
+        self.file.flush()
+        self.records += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_trace(path):
+    """Yield the (timestamp, kind, payload) records of a trace file"""
+    with open(path, 'rb') as f:
+        magic, version = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError("%s is not a version %d trace" %
+                             (path, TRACE_VERSION))
+        while True:
+            head = f.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            timestamp, kind, length = _RECORD.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                # Cut short by a crash while recording
+                return
+            yield timestamp, kind, payload
+
+
+class TraceDecoder(object):
+    """
+    Turn trace records back into Ryu events, with one datapath per DPID
+    made by datapath_factory(dpid)
+    """
+
+    def __init__(self, datapath_factory):
+        super(TraceDecoder, self).__init__()
+        self.datapath_factory = datapath_factory
+        self.datapaths = {}  # dpid -> datapath
+
+    def datapath(self, dpid):
+        dp = self.datapaths.get(dpid)
+        if dp is None:
+            dp = self.datapaths[dpid] = self.datapath_factory(dpid)
+        return dp
+
+    def _port(self, buf, offset=0):
+        dpid, port_no, hw_addr, config, state = _PORT.unpack_from(buf, offset)
+        ofpport = ofproto_v1_0_parser.OFPPhyPort(
+            port_no, hw_addr.hex(':'), b'', config, state, 0, 0, 0, 0)
+        return (switches.Port(dpid, ofproto_v1_0, ofpport),
+                offset + _PORT.size)
+
+    def _switch(self, buf):
+        dpid, count = _SWITCH.unpack_from(buf)
+        switch = switches.Switch(self.datapath(dpid))
+        offset = _SWITCH.size
+        for _ in range(count):
+            port, offset = self._port(buf, offset)
+            switch.ports.append(port)
+        return switch
+
+    def _link(self, buf):
+        src, offset = self._port(buf)
+        dst, _ = self._port(buf, offset)
+        return switches.Link(src, dst)
+
+    def _host(self, buf, offset=0):
+        mac, count = _HOST.unpack_from(buf, offset)
+        offset += _HOST.size
+        ips = [socket.inet_ntoa(buf[offset + 4 * i:offset + 4 * i + 4])
+               for i in range(count)]
+        port, offset = self._port(buf, offset + 4 * count)
+        host = switches.Host(mac.hex(':'), port)
+        host.ipv4.extend(ips)
+        return host, offset
+
+    def decode(self, kind, buf):
+        if kind == SWITCH_ENTER:
+            return event.EventSwitchEnter(self._switch(buf))
+        if kind == SWITCH_LEAVE:
+            return event.EventSwitchLeave(self._switch(buf))
+        if kind == LINK_ADD:
+            return event.EventLinkAdd(self._link(buf))
+        if kind == LINK_DELETE:
+            return event.EventLinkDelete(self._link(buf))
+        if kind == HOST_ADD:
+            return event.EventHostAdd(self._host(buf)[0])
+        if kind == HOST_MOVE:
+            src, offset = self._host(buf)
+            return event.EventHostMove(src, self._host(buf, offset)[0])
+        if kind == PORT_ADD:
+            return event.EventPortAdd(self._port(buf)[0])
+        if kind == PORT_DELETE:
+            return event.EventPortDelete(self._port(buf)[0])
+        if kind == PORT_MODIFY:
+            return event.EventPortModify(self._port(buf)[0])
+        if kind == PACKET_IN:
+            dpid, buffer_id, total_len, in_port, reason = \
+                _PACKET_IN.unpack_from(buf)
+            msg = ofproto_v1_0_parser.OFPPacketIn(
+                self.datapath(dpid), buffer_id, total_len, in_port, reason,
+                bytes(buf[_PACKET_IN.size:]))
+            return ofp_event.EventOFPPacketIn(msg)
+        raise ValueError("unknown trace record kind %d" % kind)
+
+
+def replay(path, app, realtime=False, window=0.05, max_delay=1.0):
+    """
+    Feed the events of a trace to the handlers of app, whose datapaths
+    are FakeDatapaths.  A burst of topology mutations is flushed where
+    the recorded timestamps show a gap of `window` seconds, or
+    `max_delay` seconds after its first mutation; with realtime the
+    recorded gaps are also slept.  Returns the decoder and a dict of
+    replay statistics.
+    """
+    from app_benchmark import FakeDatapath
+
+    handlers = {
+        event.EventSwitchEnter: app.handle_switch_add,
+        event.EventSwitchLeave: app.handle_switch_delete,
+        event.EventLinkAdd: app.handle_link_add,
+        event.EventLinkDelete: app.handle_link_delete,
+        event.EventHostAdd: app.handle_host_add,
+        event.EventHostMove: app.handle_host_move,
+        event.EventPortAdd: app.handle_port_add,
+        event.EventPortDelete: app.handle_port_delete,
+        event.EventPortModify: app.handle_port_modify,
+        ofp_event.EventOFPPacketIn: app.packet_in_handler,
+    }
+
+    def on_barrier(dp, xid):
+        reply = ofproto_v1_0_parser.OFPBarrierReply(dp)
+        reply.xid = xid
+        app.barrier_reply_handler(ofp_event.EventOFPBarrierReply(reply))
+
+    decoder = TraceDecoder(lambda dpid: FakeDatapath(dpid, on_barrier))
+    coalescer = app.coalescer
+    coalescer.window = window if window <= 0 else None
+    first_at = last_at = None
+    events = 0
+    start = time.perf_counter()
+    trace_start = None
+    for timestamp, kind, payload in read_trace(path):
+        if trace_start is None:
+            trace_start = timestamp
+        if realtime:
+            delay = (timestamp - trace_start) - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        if coalescer.pending and (timestamp - last_at >= window or
+                                  timestamp - first_at >= max_delay):
+            coalescer.flush()
+        pending = len(coalescer.pending)
+        ev = decoder.decode(kind, payload)
+        handlers[type(ev)](ev)
+        events += 1
+        if len(coalescer.pending) > pending:
+            if not pending:
+                first_at = timestamp
+            last_at = timestamp
+    coalescer.flush()
+    return decoder, {'events': events,
+                     'elapsed': time.perf_counter() - start,
+                     'bursts': coalescer.bursts}
+
+
+def main():
+    import shortest_paths
+
+    parser = argparse.ArgumentParser(description="Replay an event trace")
+    parser.add_argument('trace')
+    parser.add_argument('--realtime', action='store_true',
+                        help="keep the recorded pace")
+    parser.add_argument('--window', type=float,
+                        default=shortest_paths.COALESCE_WINDOW)
+    parser.add_argument('--max-delay', type=float,
+                        default=shortest_paths.COALESCE_MAX_DELAY)
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the app's output")
+    args = parser.parse_args()
+
+    # Do not record the replay: with SPS_TRACE_FILE still set, the app
+    # would truncate the trace before it is read
+    shortest_paths.TRACE_FILE = None
+    app = shortest_paths.ShortestPathSwitching()
+    if not args.verbose:
+        app.logger.setLevel(logging.ERROR)
+    output = contextlib.ExitStack()
+    if not args.verbose:
+        output.enter_context(contextlib.redirect_stdout(io.StringIO()))
+    with output:
+        decoder, stats = replay(args.trace, app, args.realtime,
+                                args.window, args.max_delay)
+    flow_mods = sum(dp.count(ofproto_v1_0.OFPT_FLOW_MOD)
+                    for dp in decoder.datapaths.values())
+    print("%d events, %d bursts, %d FlowMods in %.3f s" %
+          (stats['events'], stats['bursts'], flow_mods, stats['elapsed']))
+
+
+if __name__ == '__main__':
+    main()
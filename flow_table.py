@@ -0,0 +1,454 @@
+"""Desired-state flow tables
+
+The controller keeps, for every datapath, the forwarding rules it wants
+installed (dl_dst -> output port) next to the rules it last sent to the
+switch.  Route recomputations only edit the desired state; sync() then
+returns the FlowMods needed to bring the switch in line, so unchanged
+rules are never resent.
+
+Rules are keyed by what they match:
+
+* dl_dst                    -- all IP traffic to one host
+* SourceRule(dl_dst, nw_src) -- the traffic of one source to one host
+* PrefixRule(nw_dst, length) -- IP traffic to a prefix
+* LabelRule(vlan, dl_dst)    -- IP traffic tagged with the label of an
+                                egress switch (to one of its hosts if
+                                dl_dst is given)
+
+An ECMP route (several equal-cost output ports) is either kept as the
+tuple of its ports, for switches that spread it with a select group, or
+as a rule on its first port plus SourceRules that send some of the
+sources out of the other ports.
+
+Switches with group tables forward a route that has a backup next hop
+(see set_backup()) to Failover(port, backup), a fast-failover group
+that moves to the backup port as soon as the switch sees the primary
+port go down.  Other switches only keep the backups here, for the
+controller to swap rules with.
+
+A table may have a budget of rules.  Once it is full, routes to new
+destinations are not given a dl_dst rule but marked evicted, and so are
+rules the switch removed itself after their idle timeout (expire()).
+Their traffic misses the table and comes to the controller, which
+restore()s the rule, evicting the least recently (re)installed dl_dst
+rules to make room for it.  The routes of evicted destinations are
+still kept up to date, for when they are restored.
+
+After a controller restart the installed state can be preload()ed
+from a snapshot, so that only the rules that changed in the meantime
+are sent again; reconcile() corrects it with the rules the switch
+reports it really has.  sync() holds the deletes of those preloaded
+rules back, so that routes the controller does not know again yet keep
+forwarding, unless they overlap a desired rule, until
+release_preloaded() once the switch got its full set of routes.
+
+compress() replaces the dl_dst rules of the hosts with known IPv4
+addresses by the few prefix rules rule_compiler finds for them, with
+DROP (no output port) as the output of the addresses of no known host.
+
+With label switching, routes lead to egress switches rather than hosts.
+Every switch forwards the traffic tagged with the label (a VLAN id) of
+another switch by one LabelRule (set_label()).  Only switches with
+hosts know hosts (set_labelled_host()): they push the label of a remote
+host's switch onto its traffic, PushLabel(vlan, port), and deliver the
+traffic to their own hosts, untagged or popping their own label.
+
+"""
+
+import collections
+import socket
+import struct
+
+import rule_compiler
+
+FLOW_ADD = 'add'
+FLOW_MODIFY = 'modify'
+FLOW_DELETE = 'delete'
+
+SourceRule = collections.namedtuple('SourceRule', 'dl_dst nw_src')
+PrefixRule = collections.namedtuple('PrefixRule', 'nw_dst length')
+Failover = collections.namedtuple('Failover', 'port backup')
+LabelRule = collections.namedtuple('LabelRule', 'vlan dl_dst')
+PushLabel = collections.namedtuple('PushLabel', 'vlan port')
+
+# Installed output of a rule found on a switch but not known to be wanted
+STALE = 'stale'
+
+# Output of a rule whose traffic is dropped
+DROP = ()
+
+
+def _prefixes_overlap(a, b):
+    """Return whether two PrefixRules match some address in common"""
+    shift = 32 - min(a.length, b.length)
+    if shift == 32:
+        return True
+    addr_a, = struct.unpack('!I', socket.inet_aton(a.nw_dst))
+    addr_b, = struct.unpack('!I', socket.inet_aton(b.nw_dst))
+    return addr_a >> shift == addr_b >> shift
+
+
+class FlowTable(object):
+    """Desired and installed forwarding rules of one datapath"""
+
+    def __init__(self, dpid, select_groups=False, budget=0):
+        self.dpid = dpid
+        self.select_groups = select_groups
+        self.budget = budget  # most rules wanted at once, 0: no limit
+        self.desired = {}    # rule key -> out port(s)
+        self.installed = {}  # rule key -> out port(s)
+        self.dirty = set()   # rule keys whose desired state was touched
+        self.routes = {}     # dl_dst -> out port(s) of its route
+        self.multipath = {}  # dl_dst -> equal-cost out ports
+        self.sources = {}    # dl_dst -> nw_src of its per-source rules
+        self.prefixes = []   # desired PrefixRules
+        self.backups = {}    # dl_dst -> backup out port
+        self.group_ids = {}  # rule key -> id of its installed group
+        self.evicted = set()  # dl_dst whose route has no rule for now
+        # dl_dst with a rule, least recently (re)installed first
+        self.lru = collections.OrderedDict()
+        self.labels = {}     # label -> out port of the traffic tagged with it
+        # dl_dst -> (label of its switch, its port if it is attached here)
+        self.hosts = {}
+        self.tagged = {}     # label -> dl_dst this switch tags with it
+        # Installed keys kept over a restart whose deletes are held back
+        self.preloaded = set()
+        self._next_group_id = 1
+
+    def set_route(self, dl_dst, port):
+        """Set the desired output port for dl_dst (None removes it)"""
+        self.multipath.pop(dl_dst, None)
+        if self.sources:
+            self.set_sources(dl_dst, {})
+        if port is None:
+            self.routes.pop(dl_dst, None)
+            self.evicted.discard(dl_dst)
+            self._drop(dl_dst)
+        else:
+            self.routes[dl_dst] = port
+            self._put(dl_dst, self.output(dl_dst))
+
+    def set_multipath(self, dl_dst, ports, sources=None):
+        """
+        Set the equal-cost output ports of dl_dst.  Without select groups
+        the rule uses ports[0] and `sources` ({nw_src: out port}) gives
+        the per-source exceptions.
+        """
+        self.multipath[dl_dst] = ports
+        self.routes[dl_dst] = ports
+        if self._put(dl_dst, self.output(dl_dst)) and not self.select_groups:
+            self.set_sources(dl_dst, sources or {})
+
+    def set_sources(self, dl_dst, sources):
+        """Replace the per-source rules of dl_dst by {nw_src: out port}"""
+        for nw_src in self.sources.pop(dl_dst, ()):
+            if nw_src not in sources:
+                key = SourceRule(dl_dst, nw_src)
+                self.desired.pop(key, None)
+                self.dirty.add(key)
+        for nw_src, port in sources.items():
+            key = SourceRule(dl_dst, nw_src)
+            self.desired[key] = port
+            self.dirty.add(key)
+        if sources:
+            self.sources[dl_dst] = list(sources)
+
+    def set_backup(self, dl_dst, port):
+        """
+        Set the backup output port for dl_dst (None removes it).  Returns
+        whether the rules of the switch change, which only happens on
+        switches with group tables.
+        """
+        if port is None:
+            self.backups.pop(dl_dst, None)
+        else:
+            self.backups[dl_dst] = port
+        if (not self.select_groups or dl_dst not in self.routes or
+                dl_dst in self.multipath):
+            return False
+        if dl_dst in self.desired:
+            self.desired[dl_dst] = self.output(dl_dst)
+            self.dirty.add(dl_dst)
+        return True
+
+    def set_label(self, vlan, port):
+        """Set the output port of the traffic tagged with a label (None
+        removes it), along with that of the hosts tagged with it here"""
+        key = LabelRule(vlan, None)
+        if port is None:
+            self.labels.pop(vlan, None)
+            self.desired.pop(key, None)
+        else:
+            self.labels[vlan] = port
+            self.desired[key] = port
+        self.dirty.add(key)
+        for dl_dst in self.tagged.get(vlan, ()):
+            self._tag(dl_dst, vlan)
+
+    def set_labelled_host(self, dl_dst, vlan, port=None):
+        """
+        Place host dl_dst behind the switch with label vlan: when it is
+        attached here, on port, its untagged and tagged traffic goes out
+        of port; otherwise this switch tags its traffic and sends it
+        where the label goes.  vlan None forgets the host.
+        """
+        old = self.hosts.pop(dl_dst, None)
+        if old is not None:
+            if old[1] is None:
+                self.tagged[old[0]].discard(dl_dst)
+                if not self.tagged[old[0]]:
+                    del self.tagged[old[0]]
+            else:
+                self.desired.pop(LabelRule(old[0], dl_dst), None)
+                self.dirty.add(LabelRule(old[0], dl_dst))
+            self.desired.pop(dl_dst, None)
+            self.dirty.add(dl_dst)
+        if vlan is None:
+            return
+        self.hosts[dl_dst] = (vlan, port)
+        if port is None:
+            self.tagged.setdefault(vlan, set()).add(dl_dst)
+            self._tag(dl_dst, vlan)
+        else:
+            for key in (dl_dst, LabelRule(vlan, dl_dst)):
+                self.desired[key] = port
+                self.dirty.add(key)
+
+    def _tag(self, dl_dst, vlan):
+        port = self.labels.get(vlan)
+        if port is None:
+            self.desired.pop(dl_dst, None)
+        else:
+            self.desired[dl_dst] = PushLabel(vlan, port)
+        self.dirty.add(dl_dst)
+
+    def _put(self, dl_dst, port):
+        """Want the dl_dst rule to output to port, unless dl_dst is
+        evicted or the table is full (which evicts it); returns whether
+        the rule is wanted"""
+        if dl_dst not in self.desired:
+            if dl_dst in self.evicted or self.full():
+                self.evicted.add(dl_dst)
+                return False
+            self.lru[dl_dst] = None
+        self.desired[dl_dst] = port
+        self.dirty.add(dl_dst)
+        return True
+
+    def _drop(self, dl_dst):
+        if self.desired.pop(dl_dst, None) is not None:
+            self.dirty.add(dl_dst)
+        self.lru.pop(dl_dst, None)
+
+    def full(self):
+        """Return whether the rules wanted use up the budget"""
+        return bool(self.budget) and len(self.desired) >= self.budget
+
+    def evict(self, dl_dst):
+        """Take the rule of dl_dst, and its per-source rules, out of the
+        table; its route is kept for restore()"""
+        self.evicted.add(dl_dst)
+        if self.sources:
+            self.set_sources(dl_dst, {})
+        self._drop(dl_dst)
+
+    def expire(self, dl_dst):
+        """Evict the rule of dl_dst after the switch removed it itself"""
+        self.installed.pop(dl_dst, None)
+        self.evict(dl_dst)
+
+    def restore(self, dl_dst):
+        """
+        Let an evicted dl_dst have its rule again, evicting the least
+        recently installed ones while the table is full.  Returns the
+        evicted dl_dst; the caller sets the route of dl_dst again.
+        """
+        self.evicted.discard(dl_dst)
+        return self.trim(1)
+
+    def trim(self, room=0, keep=None):
+        """
+        Evict the least recently installed dl_dst rules but `keep` until
+        `room` more rules fit in the budget; returns the evicted dl_dst
+        """
+        evicted = []
+        while self.budget and len(self.desired) + room > self.budget:
+            dl_dst = next((d for d in self.lru if d != keep), None)
+            if dl_dst is None:
+                break
+            self.evict(dl_dst)
+            evicted.append(dl_dst)
+        return evicted
+
+    def output(self, dl_dst):
+        """
+        Return what the rule of a route outputs to: its port, its first
+        equal-cost port or, with group tables, the tuple of its
+        equal-cost ports or Failover(port, backup)
+        """
+        port = self.routes[dl_dst]
+        if isinstance(port, tuple):
+            return port if self.select_groups else port[0]
+        backup = self.backups.get(dl_dst)
+        if self.select_groups and backup is not None and backup != port:
+            return Failover(port, backup)
+        return port
+
+    def compress(self, addresses):
+        """
+        Forward the hosts with IPv4 addresses (addresses maps dl_dst to
+        a list of them) by prefix rules instead of a dl_dst rule each,
+        and drop the traffic to other addresses; the other hosts keep
+        their dl_dst rule.  Only the rules that differ from
+        the previous compression are marked for sync.
+        """
+        routes = {}
+        for dl_dst in self.routes:
+            port = self.output(dl_dst)
+            ips = addresses.get(dl_dst)
+            if ips:
+                routes.update(dict.fromkeys(ips, port))
+                self._drop(dl_dst)
+            elif self.desired.get(dl_dst) != port:
+                self._put(dl_dst, port)
+        for key in self.prefixes:
+            del self.desired[key]
+            self.dirty.add(key)
+        self.prefixes = []
+        rules = rule_compiler.compress(routes, unknown=DROP)
+        for (nw_dst, length), port in rules.items():
+            key = PrefixRule(nw_dst, length)
+            self.desired[key] = port
+            self.dirty.add(key)
+            self.prefixes.append(key)
+
+    def compression(self):
+        """Return the routes of the switch per installed rule"""
+        if not self.desired:
+            return 1.0
+        routes = len(self.routes) + len(self.labels) + len(self.hosts)
+        return float(routes) / len(self.desired)
+
+    def group_id(self, key):
+        """Return the group id of a rule and whether it is new"""
+        group_id = self.group_ids.get(key)
+        if group_id is not None:
+            return group_id, False
+        group_id = self.group_ids[key] = self._next_group_id
+        self._next_group_id += 1
+        return group_id, True
+
+    def preload(self, rules):
+        """
+        Take rules ({key: (output, group id or 0)}) a switch kept over a
+        controller restart as installed.  Only the rules whose desired
+        state is touched are compared with them until resync().
+        """
+        for key, (port, group_id) in rules.items():
+            self.installed[key] = port
+            self.preloaded.add(key)
+            if group_id:
+                self.group_ids[key] = group_id
+                self._next_group_id = max(self._next_group_id, group_id + 1)
+
+    def reconcile(self, present):
+        """
+        Correct the installed state with the keys of the rules the switch
+        reports (present): the missing rules are sent again, the unknown
+        ones deleted unless they are wanted.  Returns the number of
+        missing rules.
+        """
+        missing = [key for key in self.installed if key not in present]
+        for key in missing:
+            del self.installed[key]
+            self.group_ids.pop(key, None)
+            self.dirty.add(key)
+        for key in present:
+            if key not in self.installed:
+                self.installed[key] = STALE
+                self.dirty.add(key)
+                if self.preloaded:
+                    self.preloaded.add(key)
+        self.preloaded.difference_update(missing)
+        return len(missing)
+
+    def release_preloaded(self):
+        """Stop holding back the deletes of the preloaded rules: the
+        ones no longer wanted go at the next sync"""
+        self.dirty.update(self.preloaded)
+        self.preloaded.clear()
+
+    def overlaps(self, key):
+        """Return whether an installed rule no longer wanted would take
+        traffic from a desired rule, or compete with one"""
+        if isinstance(key, PrefixRule):
+            return any(_prefixes_overlap(key, prefix)
+                       for prefix in self.prefixes)
+        if isinstance(key, LabelRule):
+            return (key.vlan in self.labels or
+                    any(host[0] == key.vlan for host in self.hosts.values()
+                        if host[1] is not None))
+        if isinstance(key, SourceRule):
+            key = key.dl_dst
+        # Its destination is routed by other rules (prefix rules with
+        # compression), which this one would override
+        return key in self.routes or key in self.hosts
+
+    def resync(self):
+        """Compare every installed rule with its desired state at the
+        next sync, deleting the ones no longer wanted"""
+        self.dirty.update(self.installed)
+
+    def clear(self):
+        """Forget everything, e.g. after the switch disconnected"""
+        self.desired.clear()
+        self.installed.clear()
+        self.dirty.clear()
+        self.routes.clear()
+        self.multipath.clear()
+        self.sources.clear()
+        self.prefixes = []
+        self.backups.clear()
+        self.group_ids.clear()
+        self.evicted.clear()
+        self.lru.clear()
+        self.labels.clear()
+        self.hosts.clear()
+        self.tagged.clear()
+        self.preloaded.clear()
+
+    def sync(self):
+        """
+        Return the (command, key, port) operations that turn the
+        installed state into the desired one, and record them as
+        installed.  Only entries touched since the last sync are compared.
+        Deletes come last, so that a prefix rule replaced by others
+        keeps forwarding until they are in place.  Preloaded rules no
+        longer wanted stay installed, and touched for a later sync,
+        unless they overlap a desired rule.
+        """
+        ops = []
+        removals = []
+        kept = []
+        for key in self.dirty:
+            want = self.desired.get(key)
+            have = self.installed.get(key)
+            if want == have:
+                continue
+            if have is None:
+                ops.append((FLOW_ADD, key, want))
+                self.installed[key] = want
+            elif want is None:
+                if key in self.preloaded:
+                    if not self.overlaps(key):
+                        kept.append(key)
+                        continue
+                    self.preloaded.discard(key)
+                removals.append((FLOW_DELETE, key, have))
+                del self.installed[key]
+            else:
+                ops.append((FLOW_MODIFY, key, want))
+                self.installed[key] = want
+        self.dirty.clear()
+        self.dirty.update(kept)
+        return ops + removals
@@ -0,0 +1,226 @@
+"""Controller metrics
+
+Counters, latency histograms and gauges kept in a MetricsRegistry and
+served in the Prometheus text format by MetricsServer:
+
+    curl http://127.0.0.1:9105/metrics
+
+Labels are positional: a metric declared with labels=('dpid',) is
+updated with counter.inc(dpid).  Gauges are read from a callback when
+the endpoint is scraped, so they cost nothing in between.
+
+"""
+
+import bisect
+
+from ryu.lib import hub
+
+# Upper bounds (seconds) of the latency buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Base class: a named metric with optional labels"""
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        super(Metric, self).__init__()
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self):
+        """Yield the (suffix, label text, value) samples of the metric"""
+        return iter(())
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        _number(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A monotonically increasing count per label combination"""
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = {}  # label values -> count
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield '', _labels(self.labels, labels), value
+
+
+class Histogram(Metric):
+    """Observations counted in fixed buckets per label combination"""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.counts = {}  # label values -> [count per bucket, +Inf last]
+        self.sums = {}    # label values -> sum of the observations
+
+    def observe(self, value, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def count(self, *labels):
+        return sum(self.counts.get(labels, ()))
+
+    def samples(self):
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield ('_bucket',
+                       _labels(self.labels, labels, 'le="%s"' %
+                               _number(bound)),
+                       total)
+            yield '_sum', _labels(self.labels, labels), self.sums[labels]
+            yield '_count', _labels(self.labels, labels), total
+
+
+class Callback(Metric):
+    """
+    A metric read from func() at scrape time: func returns a number, or
+    a dict from label values (tuples) to numbers when labels are given
+    """
+
+    def __init__(self, name, help, func, labels=(), type='gauge'):
+        super(Callback, self).__init__(name, help, labels)
+        self.func = func
+        self.type = type
+
+    def samples(self):
+        value = self.func()
+        if not self.labels:
+            yield '', '', value
+            return
+        for labels, v in sorted(value.items()):
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield '', _labels(self.labels, labels), v
+
+
+class MetricsRegistry(object):
+    """The metrics of one application, in registration order"""
+
+    def __init__(self, prefix=''):
+        super(MetricsRegistry, self).__init__()
+        self.prefix = prefix
+        self.metrics = []
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func, labels=()):
+        return self.register(Callback(name, help, func, labels))
+
+    def callback_counter(self, name, help, func, labels=()):
+        """A counter kept elsewhere and read from func() at scrape time"""
+        return self.register(Callback(name, help, func, labels, 'counter'))
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        return ''.join(m.render() + '\n' for m in self.metrics)
+
+
+class MetricsServer(object):
+    """
+    Minimal HTTP server answering GET /metrics with a registry, and GET
+    on the paths of added admin commands
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=9105):
+        super(MetricsServer, self).__init__()
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.commands = {}  # path -> func(query dict) returning text
+
+    def add_command(self, path, func):
+        """Answer GET path with func(query dict); a ValueError it raises
+        is answered as a bad request, with its message"""
+        self.commands[path.encode()] = func
+
+    def serve_forever(self):
+        server = hub.StreamServer((self.host, self.port), self._handle)
+        server.serve_forever()
+
+    def _handle(self, sock, addr):
+        try:
+            request = b''
+            while b'\r\n\r\n' not in request and len(request) < 8192:
+                data = sock.recv(1024)
+                if not data:
+                    break
+                request += data
+            parts = request.split(b' ', 2)
+            target = parts[1] if len(parts) > 1 else b''
+            path, _, query = target.partition(b'?')
+            if parts[0] != b'GET':
+                status = b'405 Method Not Allowed'
+                body = b'only GET is supported\n'
+            elif path in (b'/', b'/metrics'):
+                status = b'200 OK'
+                body = self.registry.render().encode()
+            elif path in self.commands:
+                args = dict(p.partition('=')[::2] for p in
+                            query.decode('ascii', 'replace').split('&') if p)
+                try:
+                    body = self.commands[path](args).encode()
+                    status = b'200 OK'
+                except ValueError as e:
+                    status = b'400 Bad Request'
+                    body = ('%s\n' % e).encode()
+            else:
+                status = b'404 Not Found'
+                body = b'not found\n'
+            sock.sendall(b'HTTP/1.0 ' + status + b'\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() +
+                         b'\r\n\r\n' + body)
+        finally:
+            sock.close()
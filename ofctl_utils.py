@@ -14,9 +14,12 @@
 # limitations under the License.
 
 
+import collections
+import functools
 import numbers
 import socket
 import struct
+import time
 
 from ryu.exception import OFPUnknownVersion
 from ryu.lib import dpid as dpid_lib
@@ -54,6 +57,21 @@ VLANID_NONE = 0
 VLANID_MIN = 2
 VLANID_MAX = 4094
 
+# Offsets in an OpenFlow 1.0 FlowMod with one output action, for
+# FlowModTemplate: ofp_header.xid, ofp_match.dl_dst, ofp_flow_mod.command
+# and ofp_action_output.port
+_FLOW_MOD_XID = 4
+_FLOW_MOD_DL_DST = ofproto_v1_0.OFP_HEADER_SIZE + 12
+_FLOW_MOD_COMMAND = (ofproto_v1_0.OFP_HEADER_SIZE +
+                     ofproto_v1_0.OFP_MATCH_SIZE + 8)
+_FLOW_MOD_PORT = ofproto_v1_0.OFP_FLOW_MOD_SIZE + 4
+_UINT16 = struct.Struct('!H')
+_UINT32 = struct.Struct('!I')
+_MAC = struct.Struct('!6s')
+
+# Binary form of the MAC addresses FlowModTemplate has encoded
+_mac_bin = functools.lru_cache(maxsize=1 << 16)(addrconv.mac.text_to_bin)
+
 
 class OfCtl(object):
     """
@@ -63,6 +81,9 @@ class OfCtl(object):
     """
     _OF_VERSIONS = {}
 
+    # Whether the OpenFlow version has group tables (OpenFlow 1.1+)
+    select_groups = False
+
     @staticmethod
     def register_of_version(version):
         def _register_of_version(cls):
@@ -91,14 +112,112 @@ class OfCtl(object):
         self.dp = dp
         self.sw_id = {'sw_id': dpid_lib.dpid_to_str(dp.id)}
         self.logger = logger
+        self._batch = None
+
+    def send_msg(self, msg):
+        """
+        Send a message to the datapath, or queue it if a batch is open
+        """
+        if self._batch is not None:
+            self._batch.add(msg)
+        else:
+            self.dp.send_msg(msg)
+
+    def batch(self, waiters=None, callback=None):
+        """
+        Open a FlowMod batch on this datapath
+        While the batch is open, set_flow/delete_flow calls made through
+        this object are queued; closing it writes them to the switch in a
+        single send followed by an OFPBarrierRequest.
+        Arguments:
+        waiters   -- dict (dpid -> {xid: FlowModBatch}) shared with the
+                     app's EventOFPBarrierReply handler, which must call
+                     FlowModBatch.complete(); without it the batch is
+                     sent but never confirmed
+        callback  -- Called with the batch once the barrier reply arrives
+
+        Usage:
+            with ofctl.batch(waiters) as batch:
+                ofctl.set_flow(...)
+                ofctl.set_flow(...)
+            batch.wait()
+        """
+        batch = FlowModBatch(self, waiters)
+        if callback is not None:
+            batch.add_callback(callback)
+        return batch
+
+    def set_flows(self, flows, waiters=None, callback=None):
+        """
+        Install many flows in one batch
+        Arguments:
+        flows     -- Iterable of dicts of set_flow keyword arguments
+        waiters, callback -- See batch()
+        Returns the sent FlowModBatch.
+        """
+        with self.batch(waiters, callback) as batch:
+            for flow in flows:
+                self.set_flow(**flow)
+        return batch
 
     def set_sw_config_for_ttl(self):
         # OpenFlow v1_2/1_3.
         pass
 
+    def build_match(self, dl_type=0, dl_dst=0, dl_vlan=0,
+                    nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
+                    nw_proto=0, in_port=0):
+        """
+        Build an OFPMatch for this datapath's OpenFlow version
+        Arguments are the match criteria described in set_flow;
+        unset (zero) fields are wildcarded.
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def get_match_dl_dst(self, match):
+        """
+        Return the Ethernet destination a received OFPMatch (e.g. of a
+        flow removed message) matches on, as text, or None if it is
+        wildcarded
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def get_match_ipv4(self, match):
+        """
+        Return the IPv4 (source, destination) a received OFPMatch (e.g.
+        of a flow stats reply) matches on, as text without the mask,
+        each None if it is wildcarded
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def get_match_vlan(self, match):
+        """
+        Return the VLAN id a received OFPMatch matches on, or None
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def push_vlan_actions(self, vlan):
+        """
+        Return the actions tagging a packet with a VLAN id
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def pop_vlan_actions(self):
+        """
+        Return the actions removing the VLAN tag of a packet
+        """
+        # Abstract method
+        raise NotImplementedError()
+
     def set_flow(self, cookie, priority, dl_type=0, dl_dst=0, dl_vlan=0,
                  nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
-                 nw_proto=0, idle_timeout=0, actions=None):
+                 nw_proto=0, idle_timeout=0, actions=None, command=None,
+                 in_port=0, flags=0):
         """
         Send a message to install a flow on this datapath
         The following arguments specify match criteria:
@@ -112,14 +231,67 @@ class OfCtl(object):
         nw_dst       -- IP destination
         dst_mask     -- IP destination mask (default /32)
         nw_proto     -- IP protocol value
+        in_port      -- Input port (default 0: any)
         Other arguments:
         idle_timeout  -- Idle timeout (default 0)
+        flags         -- FlowMod flags, e.g. OFPFF_SEND_FLOW_REM to be
+                         told when the switch removes the flow
         actions       -- List of actions to apply on match
+        command       -- FlowMod command (default OFPFC_ADD); use
+                         OFPFC_MODIFY_STRICT to change the actions of
+                         an installed rule in place
         """
         # Abstract method
         raise NotImplementedError()
 
-    def delete_flow(self, cookie=0, priority=0, match=None):
+    def set_forwarding_flow(self, cookie, priority, dl_dst, port,
+                            idle_timeout=0, flags=0, command=None):
+        """
+        Send a message to forward IP traffic to dl_dst out of port, the
+        most common rule by far; arguments as for set_flow().  OpenFlow
+        1.0 encodes it from a FlowModTemplate.
+        """
+        actions = [self.dp.ofproto_parser.OFPActionOutput(port)]
+        self.set_flow(cookie, priority, dl_type=ether.ETH_TYPE_IP,
+                      dl_dst=dl_dst, idle_timeout=idle_timeout, flags=flags,
+                      actions=actions, command=command)
+
+    def set_select_group(self, group_id, ports, command=None):
+        """
+        Send a group mod for a select group: the switch hashes each flow
+        onto one of the buckets, each of which outputs to one port
+        Arguments:
+        group_id     -- Group identifier
+        ports        -- Output ports, one bucket each
+        command      -- Group mod command (default OFPGC_ADD); use
+                        OFPGC_MODIFY to replace the buckets of an
+                        existing group
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def set_failover_group(self, group_id, ports, command=None):
+        """
+        Send a group mod for a fast-failover group: the switch outputs to
+        the first of the ports that is up, without asking the controller
+        Arguments:
+        group_id     -- Group identifier
+        ports        -- Output ports in order of preference, one bucket
+                        each watching its own port
+        command      -- Group mod command (default OFPGC_ADD); use
+                        OFPGC_MODIFY to replace an existing group
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def delete_group(self, group_id):
+        """
+        Delete a group; flows still referring to it are removed with it
+        """
+        # Abstract method
+        raise NotImplementedError()
+
+    def delete_flow(self, cookie=0, priority=0, match=None, strict=False):
         """
         Delete a flow matching the following criteria
         Arguments:
@@ -128,6 +300,8 @@ class OfCtl(object):
         priority     -- Priority value for this flow (default 0)
         match        -- Match criteria for deletion
                         (defaults to all)
+        strict       -- Only delete the flow with exactly this match and
+                        priority, not every more specific one as well
 
         NOTE:  OpenFlow 1.0 does not support deletion based on
         the cookie value.  Instead, match fields must be specified.
@@ -254,9 +428,20 @@ class OfCtl(object):
         self.send_packet_out(in_port, self.dp.ofproto.OFPP_IN_PORT,
                              pkt.data, data_str=str(pkt))
 
-    def send_packet_out(self, in_port, output, data, data_str=None):
-        actions = [self.dp.ofproto_parser.OFPActionOutput(output, 0)]
-        self.dp.send_packet_out(buffer_id=UINT32_MAX, in_port=in_port,
+    def send_packet_out(self, in_port, output, data, data_str=None,
+                        buffer_id=UINT32_MAX):
+        """
+        Send a packet out of one port, or out of each port of a list.
+        With a buffer_id the switch sends the packet it buffered instead
+        of data.
+        """
+        if not isinstance(output, (list, tuple)):
+            output = [output]
+        actions = [self.dp.ofproto_parser.OFPActionOutput(port, 0)
+                   for port in output]
+        if buffer_id != UINT32_MAX:
+            data = None
+        self.dp.send_packet_out(buffer_id=buffer_id, in_port=in_port,
                                 actions=actions, data=data)
         # TODO: Packet library convert to string
         # if data_str is None:
@@ -278,6 +463,11 @@ class OfCtl(object):
                       nw_proto=nw_proto, actions=actions)
 
     def send_stats_request(self, stats, waiters):
+        """
+        Send a stats request and block until its reply arrived (or for
+        OFP_REPLY_TIMER seconds).  To poll many switches at once, use a
+        StatsCollector instead.
+        """
         self.dp.set_xid(stats)
         waiters_per_dp = waiters.setdefault(self.dp.id, {})
         event = hub.Event()
@@ -285,42 +475,374 @@ class OfCtl(object):
         waiters_per_dp[stats.xid] = (event, msgs)
         self.dp.send_msg(stats)
 
-        try:
-            event.wait(timeout=OFP_REPLY_TIMER)
-        except hub.Timeout:
-            del waiters_per_dp[stats.xid]
+        # hub.Event.wait() returns False on timeout instead of raising
+        if not event.wait(timeout=OFP_REPLY_TIMER):
+            waiters_per_dp.pop(stats.xid, None)
 
         return msgs
 
+    def get_all_flow(self, waiters):
+        return self.send_stats_request(self.flow_stats_request(), waiters)
+
+    def get_port_stats(self, waiters):
+        return self.send_stats_request(self.port_stats_request(), waiters)
+
+    def flow_stats_request(self):
+        """Return a request for the stats of every flow"""
+        raise NotImplementedError
+
+    def port_stats_request(self):
+        """Return a request for the stats of every port"""
+        raise NotImplementedError
+
+
+class FlowModBatch(object):
+    """
+    FlowMods queued for one datapath, sent together and confirmed by a
+    barrier.  Created by OfCtl.batch().
+
+    Messages are given their xid and serialized as they are queued.
+
+    Attributes:
+    buf       -- The queued messages, serialized back to back
+    count     -- Number of messages queued
+    xid       -- Transaction id of the barrier request (once sent)
+    sent_at   -- time.time() when the batch was written
+    done_at   -- time.time() when the barrier reply arrived
+    """
+
+    def __init__(self, ofctl, waiters=None):
+        super(FlowModBatch, self).__init__()
+        self.ofctl = ofctl
+        self.waiters = waiters
+        self.buf = bytearray()
+        self.count = 0
+        self.xid = None
+        self.sent_at = None
+        self.done_at = None
+        self._event = hub.Event()
+        self._callbacks = []
+
+    def __enter__(self):
+        self.ofctl._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.ofctl._batch = None
+        if exc_type is None:
+            self.send()
+        return False
+
+    def __len__(self):
+        return self.count
+
+    def add(self, msg):
+        dp = self.ofctl.dp
+        dp.set_xid(msg)
+        msg.serialize()
+        self.buf += msg.buf
+        self.count += 1
+
+    def add_template(self, template, command, dl_dst, port):
+        """Queue the FlowMod of a FlowModTemplate"""
+        template.encode(self.buf, command, dl_dst, port)
+        self.count += 1
+
+    def add_callback(self, callback):
+        if self.done_at is not None:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def send(self):
+        """
+        Append a barrier request to the queued messages and hand them to
+        the datapath with a single send
+        """
+        if not self.count:
+            self.complete()
+            return
+        dp = self.ofctl.dp
+        barrier = dp.ofproto_parser.OFPBarrierRequest(dp)
+        dp.set_xid(barrier)
+        barrier.serialize()
+        self.buf += barrier.buf
+        self.xid = barrier.xid
+        if self.waiters is not None:
+            self.waiters.setdefault(dp.id, {})[self.xid] = self
+        self.sent_at = time.time()
+        dp.send(self.buf)
+
+    def complete(self):
+        """Mark the batch as applied by the switch (barrier replied)"""
+        self.done_at = time.time()
+        if self.sent_at is None:
+            self.sent_at = self.done_at
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def wait(self, timeout=OFP_REPLY_TIMER):
+        """Block until the barrier reply arrived; return True if it did"""
+        if self.done_at is None:
+            try:
+                self._event.wait(timeout=timeout)
+            except hub.Timeout:
+                pass
+        return self.done_at is not None
+
+    @property
+    def latency(self):
+        """Seconds between sending the batch and its barrier reply"""
+        if self.done_at is None:
+            return None
+        return self.done_at - self.sent_at
+
+
+class FlowModTemplate(object):
+    """
+    Pre-encoded OpenFlow 1.0 FlowMod forwarding IP traffic to a dl_dst
+    out of a port
+
+    Ryu serializes the FlowMod once per (cookie, priority, idle_timeout,
+    flags); encode() appends a copy to an output buffer and patches the
+    xid, command, dl_dst and output port in place.
+    """
+
+    def __init__(self, dp, match, cookie, priority, idle_timeout=0,
+                 flags=0):
+        super(FlowModTemplate, self).__init__()
+        ofp_parser = dp.ofproto_parser
+        self.dp = dp
+        self.xid = None
+        msg = ofp_parser.OFPFlowMod(dp, match, cookie, dp.ofproto.OFPFC_ADD,
+                                    idle_timeout=idle_timeout,
+                                    priority=priority, flags=flags,
+                                    actions=[ofp_parser.OFPActionOutput(0)])
+        msg.set_xid(0)
+        msg.serialize()
+        self.data = bytes(msg.buf)
+
+    def set_xid(self, xid):
+        # Datapath.set_xid() hands out the next xid through this
+        self.xid = xid
+
+    def encode(self, buf, command, dl_dst, port):
+        """Append the FlowMod with the given command, dl_dst (text) and
+        output port and the datapath's next xid to bytearray buf"""
+        start = len(buf)
+        buf += self.data
+        self.dp.set_xid(self)
+        _UINT32.pack_into(buf, start + _FLOW_MOD_XID, self.xid)
+        _UINT16.pack_into(buf, start + _FLOW_MOD_COMMAND, command)
+        _MAC.pack_into(buf, start + _FLOW_MOD_DL_DST, _mac_bin(dl_dst))
+        _UINT16.pack_into(buf, start + _FLOW_MOD_PORT, port)
+
+
+class StatsRequest(object):
+    """
+    A stats request sent through a StatsCollector, completed by its
+    (possibly multipart) reply or by a timeout.
+
+    Attributes:
+    dp        -- Datapath the request is for
+    msg       -- The request message
+    xid       -- Transaction id of the request (once sent)
+    replies   -- Reply messages received so far, in order
+    sent_at   -- time.time() when the request was sent
+    done_at   -- time.time() when the last part of the reply arrived, or
+                 the request timed out
+    timed_out -- Whether the request timed out before it was complete
+    """
+
+    def __init__(self, dp, msg):
+        super(StatsRequest, self).__init__()
+        self.dp = dp
+        self.msg = msg
+        self.xid = None
+        self.replies = []
+        self.sent_at = None
+        self.done_at = None
+        self.timed_out = False
+        self._event = hub.Event()
+        self._callbacks = []
+        self._timer = None
+
+    def add_callback(self, callback):
+        if self.done_at is not None:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def complete(self, timed_out=False):
+        self.done_at = time.time()
+        self.timed_out = timed_out
+        if self.sent_at is None:
+            self.sent_at = self.done_at
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def wait(self):
+        """Block until the request completed; return the replies"""
+        self._event.wait()
+        return self.replies
+
+    @property
+    def latency(self):
+        """Seconds between sending the request and its last reply"""
+        if self.done_at is None:
+            return None
+        return self.done_at - self.sent_at
+
+
+class StatsCollector(object):
+    """
+    Stats requests to any number of datapaths, with up to max_in_flight
+    of them outstanding at once; the rest are queued and sent as replies
+    come in.  Replies are matched to their request by (dpid, xid), so
+    the app's stats reply handlers must pass every reply to reply().
+
+    Usage:
+        requests = [collector.request(dp, OfCtl.factory(dp, logger)
+                                      .port_stats_request())
+                    for dp in datapaths]
+        for req in requests:
+            for msg in req.wait():
+                ...
+    """
+
+    def __init__(self, max_in_flight=64, timeout=OFP_REPLY_TIMER):
+        super(StatsCollector, self).__init__()
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self.in_flight = {}  # (dpid, xid) -> StatsRequest
+        self.timeouts = 0
+
+    def request(self, dp, msg, callback=None):
+        """Send (or queue) a stats request message; returns its
+        StatsRequest"""
+        req = StatsRequest(dp, msg)
+        if callback is not None:
+            req.add_callback(callback)
+        if len(self.in_flight) < self.max_in_flight:
+            self._send(req)
+        else:
+            self.queue.append(req)
+        return req
+
+    def reply(self, msg):
+        """
+        Add a stats reply to its request; returns False if it answers no
+        request of this collector
+        """
+        dp = msg.datapath
+        req = self.in_flight.get((dp.id, msg.xid))
+        if req is None:
+            return False
+        req.replies.append(msg)
+        ofp = dp.ofproto
+        more = getattr(ofp, 'OFPMPF_REPLY_MORE', None)
+        if more is None:
+            more = ofp.OFPSF_REPLY_MORE
+        if not msg.flags & more:
+            self._finish(req)
+        return True
+
+    def forget(self, dpid):
+        """Time out every request to a datapath that went away"""
+        for req in [r for r in self.queue if r.dp.id == dpid]:
+            self.queue.remove(req)
+            req.complete(timed_out=True)
+        for key in [k for k in self.in_flight if k[0] == dpid]:
+            self._finish(self.in_flight[key], timed_out=True)
+
+    def _send(self, req):
+        dp = req.dp
+        dp.set_xid(req.msg)
+        req.xid = req.msg.xid
+        self.in_flight[(dp.id, req.xid)] = req
+        req.sent_at = time.time()
+        req._timer = hub.spawn_after(self.timeout, self._expire, req)
+        dp.send_msg(req.msg)
+
+    def _expire(self, req):
+        req._timer = None
+        if self.in_flight.get((req.dp.id, req.xid)) is req:
+            self.timeouts += 1
+            self._finish(req, timed_out=True)
+
+    def _finish(self, req, timed_out=False):
+        del self.in_flight[(req.dp.id, req.xid)]
+        if req._timer is not None:
+            hub.kill(req._timer)
+            req._timer = None
+        while self.queue and len(self.in_flight) < self.max_in_flight:
+            self._send(self.queue.popleft())
+        req.complete(timed_out)
+
 
 @OfCtl.register_of_version(ofproto_v1_0.OFP_VERSION)
 class OfCtl_v1_0(OfCtl):
 
     def __init__(self, dp, logger):
         super(OfCtl_v1_0, self).__init__(dp, logger)
+        self._templates = {}  # (cookie, priority, idle, flags) -> template
 
     def get_packetin_inport(self, msg):
         return msg.in_port
 
-    def get_all_flow(self, waiters):
+    def get_match_dl_dst(self, match):
+        if match.wildcards & self.dp.ofproto.OFPFW_DL_DST:
+            return None
+        return addrconv.mac.bin_to_text(match.dl_dst)
+
+    def get_match_ipv4(self, match):
+        ofp = self.dp.ofproto
+        wildcards = match.wildcards
+        src = dst = None
+        if wildcards & ofp.OFPFW_NW_SRC_MASK < ofp.OFPFW_NW_SRC_ALL:
+            src = ipv4_int_to_text(match.nw_src)
+        if wildcards & ofp.OFPFW_NW_DST_MASK < ofp.OFPFW_NW_DST_ALL:
+            dst = ipv4_int_to_text(match.nw_dst)
+        return src, dst
+
+    def get_match_vlan(self, match):
+        if match.wildcards & self.dp.ofproto.OFPFW_DL_VLAN:
+            return None
+        return match.dl_vlan
+
+    def push_vlan_actions(self, vlan):
+        # Sets the VLAN id of a tagged packet, tags an untagged one
+        return [self.dp.ofproto_parser.OFPActionVlanVid(vlan)]
+
+    def pop_vlan_actions(self):
+        return [self.dp.ofproto_parser.OFPActionStripVlan()]
+
+    def flow_stats_request(self):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         match = ofp_parser.OFPMatch(ofp.OFPFW_ALL, 0, 0, 0,
                                     0, 0, 0, 0, 0, 0, 0, 0, 0)
-        stats = ofp_parser.OFPFlowStatsRequest(self.dp, 0, match,
-                                               0xff, ofp.OFPP_NONE)
-        return self.send_stats_request(stats, waiters)
+        return ofp_parser.OFPFlowStatsRequest(self.dp, 0, match,
+                                              0xff, ofp.OFPP_NONE)
 
-    def set_flow(self, cookie, priority, dl_type=0, dl_dst=0, dl_vlan=0,
-                 nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
-                 nw_proto=0, idle_timeout=0, actions=None):
+    def port_stats_request(self):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+
+        return ofp_parser.OFPPortStatsRequest(self.dp, 0, ofp.OFPP_NONE)
 
+    def build_match(self, dl_type=0, dl_dst=0, dl_vlan=0,
+                    nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
+                    nw_proto=0, in_port=0):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
-        cmd = ofp.OFPFC_ADD
 
-        # Match
         wildcards = ofp.OFPFW_ALL
         if dl_type:
             wildcards &= ~ofp.OFPFW_DL_TYPE
@@ -340,30 +862,70 @@ class OfCtl_v1_0(OfCtl):
             nw_dst = ipv4_text_to_int(nw_dst)
         if nw_proto:
             wildcards &= ~ofp.OFPFW_NW_PROTO
+        if in_port:
+            wildcards &= ~ofp.OFPFW_IN_PORT
+
+        return ofp_parser.OFPMatch(wildcards, in_port, 0, dl_dst, dl_vlan, 0,
+                                   dl_type, 0, nw_proto,
+                                   nw_src, nw_dst, 0, 0)
 
-        match = ofp_parser.OFPMatch(wildcards, 0, 0, dl_dst, dl_vlan, 0,
-                                    dl_type, 0, nw_proto,
-                                    nw_src, nw_dst, 0, 0)
+    def set_flow(self, cookie, priority, dl_type=0, dl_dst=0, dl_vlan=0,
+                 nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
+                 nw_proto=0, idle_timeout=0, actions=None, command=None,
+                 in_port=0, flags=0):
+
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+        cmd = ofp.OFPFC_ADD if command is None else command
+
+        # Match
+        match = self.build_match(dl_type=dl_type, dl_dst=dl_dst,
+                                 dl_vlan=dl_vlan, nw_src=nw_src,
+                                 src_mask=src_mask, nw_dst=nw_dst,
+                                 dst_mask=dst_mask, nw_proto=nw_proto,
+                                 in_port=in_port)
         actions = actions or []
 
         m = ofp_parser.OFPFlowMod(self.dp, match, cookie, cmd,
                                   idle_timeout=idle_timeout,
-                                  priority=priority, actions=actions)
-        self.dp.send_msg(m)
+                                  priority=priority, flags=flags,
+                                  actions=actions)
+        self.send_msg(m)
+
+    def set_forwarding_flow(self, cookie, priority, dl_dst, port,
+                            idle_timeout=0, flags=0, command=None):
+        key = (cookie, priority, idle_timeout, flags)
+        template = self._templates.get(key)
+        if template is None:
+            match = self.build_match(dl_type=ether.ETH_TYPE_IP,
+                                     dl_dst=mac_lib.BROADCAST_STR)
+            template = FlowModTemplate(self.dp, match, cookie, priority,
+                                       idle_timeout, flags)
+            self._templates[key] = template
+        cmd = self.dp.ofproto.OFPFC_ADD if command is None else command
+        if self._batch is not None:
+            self._batch.add_template(template, cmd, dl_dst, port)
+        else:
+            buf = bytearray()
+            template.encode(buf, cmd, dl_dst, port)
+            self.dp.send(buf)
 
-    def delete_flow(self, cookie=0, priority=0, match=None):
-        cmd = self.dp.ofproto.OFPFC_DELETE
+    def delete_flow(self, cookie=0, priority=0, match=None, strict=False):
+        ofp = self.dp.ofproto
+        cmd = ofp.OFPFC_DELETE_STRICT if strict else ofp.OFPFC_DELETE
         actions = []
 
         ofp_parser = self.dp.ofproto_parser
 
         flow_mod = self.dp.ofproto_parser.OFPFlowMod(
             self.dp, match=match, cookie=cookie, command=cmd, priority=priority, actions=actions)
-        self.dp.send_msg(flow_mod)
+        self.send_msg(flow_mod)
 
 
 class OfCtl_after_v1_2(OfCtl):
 
+    select_groups = True
+
     def __init__(self, dp, logger):
         super(OfCtl_after_v1_2, self).__init__(dp, logger)
 
@@ -378,21 +940,47 @@ class OfCtl_after_v1_2(OfCtl):
                 break
         return in_port
 
-    def get_all_flow(self, waiters):
-        pass
-
-    def set_flow(self, cookie, priority, dl_type=0, dl_dst=0, dl_vlan=0,
-                 nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
-                 nw_proto=0, idle_timeout=0, actions=None):
+    def get_match_dl_dst(self, match):
+        return match.get('eth_dst')
+
+    def get_match_ipv4(self, match):
+        fields = []
+        for name in ('ipv4_src', 'ipv4_dst'):
+            value = match.get(name)
+            fields.append(value[0] if isinstance(value, tuple) else value)
+        return tuple(fields)
+
+    def get_match_vlan(self, match):
+        value = match.get('vlan_vid')
+        if isinstance(value, tuple):
+            value = value[0]
+        if value is None or not value & self.dp.ofproto.OFPVID_PRESENT:
+            return None
+        return value & ~self.dp.ofproto.OFPVID_PRESENT
+
+    def push_vlan_actions(self, vlan):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
-        cmd = ofp.OFPFC_ADD
+        return [ofp_parser.OFPActionPushVlan(ether.ETH_TYPE_8021Q),
+                ofp_parser.OFPActionSetField(
+                    vlan_vid=vlan | ofp.OFPVID_PRESENT)]
+
+    def pop_vlan_actions(self):
+        return [self.dp.ofproto_parser.OFPActionPopVlan()]
+
+    def build_match(self, dl_type=0, dl_dst=0, dl_vlan=0,
+                    nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
+                    nw_proto=0, in_port=0):
+        ofp_parser = self.dp.ofproto_parser
 
-        # Match
         match = ofp_parser.OFPMatch()
+        if in_port:
+            match.set_in_port(in_port)
         if dl_type:
             match.set_dl_type(dl_type)
         if dl_dst:
+            if isinstance(dl_dst, str):
+                dl_dst = addrconv.mac.text_to_bin(dl_dst)
             match.set_dl_dst(dl_dst)
         if dl_vlan:
             match.set_vlan_vid(dl_vlan)
@@ -407,6 +995,22 @@ class OfCtl_after_v1_2(OfCtl):
                 match.set_ip_proto(nw_proto)
             elif dl_type == ether.ETH_TYPE_ARP:
                 match.set_arp_opcode(nw_proto)
+        return match
+
+    def set_flow(self, cookie, priority, dl_type=0, dl_dst=0, dl_vlan=0,
+                 nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
+                 nw_proto=0, idle_timeout=0, actions=None, command=None,
+                 in_port=0, flags=0):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+        cmd = ofp.OFPFC_ADD if command is None else command
+
+        # Match
+        match = self.build_match(dl_type=dl_type, dl_dst=dl_dst,
+                                 dl_vlan=dl_vlan, nw_src=nw_src,
+                                 src_mask=src_mask, nw_dst=nw_dst,
+                                 dst_mask=dst_mask, nw_proto=nw_proto,
+                                 in_port=in_port)
 
         # Instructions
         actions = actions or []
@@ -415,8 +1019,40 @@ class OfCtl_after_v1_2(OfCtl):
 
         m = ofp_parser.OFPFlowMod(self.dp, cookie, 0, 0, cmd, idle_timeout,
                                   0, priority, UINT32_MAX, ofp.OFPP_ANY,
-                                  ofp.OFPG_ANY, 0, match, inst)
-        self.dp.send_msg(m)
+                                  ofp.OFPG_ANY, flags, match, inst)
+        self.send_msg(m)
+
+    def set_select_group(self, group_id, ports, command=None):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+        cmd = ofp.OFPGC_ADD if command is None else command
+
+        buckets = [ofp_parser.OFPBucket(1, ofp.OFPP_ANY, ofp.OFPG_ANY,
+                                        [ofp_parser.OFPActionOutput(port, 0)])
+                   for port in ports]
+        m = ofp_parser.OFPGroupMod(self.dp, cmd, ofp.OFPGT_SELECT, group_id,
+                                   buckets)
+        self.send_msg(m)
+
+    def set_failover_group(self, group_id, ports, command=None):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+        cmd = ofp.OFPGC_ADD if command is None else command
+
+        buckets = [ofp_parser.OFPBucket(0, port, ofp.OFPG_ANY,
+                                        [ofp_parser.OFPActionOutput(port, 0)])
+                   for port in ports]
+        m = ofp_parser.OFPGroupMod(self.dp, cmd, ofp.OFPGT_FF, group_id,
+                                   buckets)
+        self.send_msg(m)
+
+    def delete_group(self, group_id):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+
+        m = ofp_parser.OFPGroupMod(self.dp, ofp.OFPGC_DELETE,
+                                   ofp.OFPGT_SELECT, group_id, [])
+        self.send_msg(m)
 
     def set_routing_flow(self, cookie, priority, outport, dl_vlan=0,
                          nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
@@ -441,21 +1077,22 @@ class OfCtl_after_v1_2(OfCtl):
                       nw_dst=nw_dst, dst_mask=dst_mask,
                       idle_timeout=idle_timeout, actions=actions)
 
-    def delete_flow(self, cookie, priority=0, match=None):
+    def delete_flow(self, cookie, priority=0, match=None, strict=False):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         if match is None:
             match = ofp_parser.OFPMatch()
 
-        cmd = ofp.OFPFC_DELETE
+        cmd = ofp.OFPFC_DELETE_STRICT if strict else ofp.OFPFC_DELETE
         cookie_mask = UINT64_MAX
         inst = []
 
         flow_mod = ofp_parser.OFPFlowMod(self.dp, cookie, cookie_mask, 0, cmd,
-                                         0, 0, 0, UINT32_MAX, ofp.OFPP_ANY,
-                                         ofp.OFPG_ANY, 0, match, inst)
-        self.dp.send_msg(flow_mod)
+                                         0, 0, priority, UINT32_MAX,
+                                         ofp.OFPP_ANY, ofp.OFPG_ANY, 0, match,
+                                         inst)
+        self.send_msg(flow_mod)
         self.logger.info('Delete flow [cookie=0x%x]', cookie, extra=self.sw_id)
 
 
@@ -474,14 +1111,19 @@ class OfCtl_v1_2(OfCtl_after_v1_2):
         self.logger.info('Set SW config for TTL error packet in.',
                          extra=self.sw_id)
 
-    def get_all_flow(self, waiters):
+    def flow_stats_request(self):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         match = ofp_parser.OFPMatch()
-        stats = ofp_parser.OFPFlowStatsRequest(self.dp, 0, ofp.OFPP_ANY,
-                                               ofp.OFPG_ANY, 0, 0, match)
-        return self.send_stats_request(stats, waiters)
+        return ofp_parser.OFPFlowStatsRequest(self.dp, 0, ofp.OFPP_ANY,
+                                              ofp.OFPG_ANY, 0, 0, match)
+
+    def port_stats_request(self):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+
+        return ofp_parser.OFPPortStatsRequest(self.dp, ofp.OFPP_ANY, 0)
 
 
 @OfCtl.register_of_version(ofproto_v1_3.OFP_VERSION)
@@ -506,14 +1148,19 @@ class OfCtl_v1_3(OfCtl_after_v1_2):
         self.logger.info('Set SW config for TTL error packet in.',
                          extra=self.sw_id)
 
-    def get_all_flow(self, waiters):
+    def flow_stats_request(self):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         match = ofp_parser.OFPMatch()
-        stats = ofp_parser.OFPFlowStatsRequest(self.dp, 0, 0, ofp.OFPP_ANY,
-                                               ofp.OFPG_ANY, 0, 0, match)
-        return self.send_stats_request(stats, waiters)
+        return ofp_parser.OFPFlowStatsRequest(self.dp, 0, 0, ofp.OFPP_ANY,
+                                              ofp.OFPG_ANY, 0, 0, match)
+
+    def port_stats_request(self):
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+
+        return ofp_parser.OFPPortStatsRequest(self.dp, 0, ofp.OFPP_ANY)
 
 
 def ip_addr_aton(ip_str, err_msg=None):
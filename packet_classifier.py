@@ -0,0 +1,111 @@
+"""Header peeking for packet-ins
+
+packet.Packet() decodes every layer of a frame into objects, which is
+wasted work for the frames the controller only looks at to drop (LLDP,
+IPv6 neighbour discovery left over from Mininet hosts).  PacketClassifier
+reads the few fields the controller acts on from fixed offsets of the
+raw buffer instead, and counts frames per ethertype.
+
+"""
+
+import collections
+import socket
+import struct
+
+from ryu.lib.packet import ether_types
+
+_ETH = struct.Struct('!6s6sH')
+_VLAN = struct.Struct('!HH')
+_ARP = struct.Struct('!HHBBH6s4s6s4s')
+
+
+def _mac_text(mac):
+    # Much cheaper than addrconv.mac.bin_to_text(), which goes through
+    # netaddr
+    return mac.hex(':')
+
+
+ETHERTYPE_NAMES = {
+    ether_types.ETH_TYPE_IP: 'ipv4',
+    ether_types.ETH_TYPE_ARP: 'arp',
+    ether_types.ETH_TYPE_8021Q: 'vlan',
+    ether_types.ETH_TYPE_IPV6: 'ipv6',
+    ether_types.ETH_TYPE_LLDP: 'lldp',
+}
+
+
+class PacketHeaders(object):
+    """Fields peeked from a frame
+
+    ethertype  -- Ethertype after any 802.1Q tag
+    vlan_id    -- VLAN id of the 802.1Q tag, or None if untagged
+    src_mac    -- Ethernet source, as text
+    dst_mac    -- Ethernet destination, as text
+    arp_opcode -- ARP opcode, or None if the frame is not an Ethernet/IPv4
+                  ARP packet
+    arp_src_mac, arp_src_ip, arp_dst_mac, arp_dst_ip -- ARP addresses,
+                  as text
+    """
+    __slots__ = ('ethertype', 'vlan_id', 'src_mac', 'dst_mac', 'arp_opcode',
+                 'arp_src_mac', 'arp_src_ip', 'arp_dst_mac', 'arp_dst_ip')
+
+    def __init__(self, ethertype, vlan_id, src_mac, dst_mac):
+        self.ethertype = ethertype
+        self.vlan_id = vlan_id
+        self.src_mac = src_mac
+        self.dst_mac = dst_mac
+        self.arp_opcode = None
+        self.arp_src_mac = None
+        self.arp_src_ip = None
+        self.arp_dst_mac = None
+        self.arp_dst_ip = None
+
+
+class PacketClassifier(object):
+    """Classify raw frames by their headers and count them per ethertype"""
+
+    def __init__(self):
+        super(PacketClassifier, self).__init__()
+        self.counters = collections.Counter()  # ethertype -> frames
+        self.truncated = 0
+
+    def classify(self, data):
+        """Return the PacketHeaders of a frame, or None if it is too
+        short to hold an Ethernet header"""
+        buf = memoryview(data)
+        if len(buf) < _ETH.size:
+            self.truncated += 1
+            return None
+        dst, src, ethertype = _ETH.unpack_from(buf)
+        offset = _ETH.size
+        vlan_id = None
+        if ethertype == ether_types.ETH_TYPE_8021Q:
+            if len(buf) < offset + _VLAN.size:
+                self.truncated += 1
+                return None
+            tci, ethertype = _VLAN.unpack_from(buf, offset)
+            vlan_id = tci & 0x0fff
+            offset += _VLAN.size
+        self.counters[ethertype] += 1
+
+        headers = PacketHeaders(ethertype, vlan_id,
+                                _mac_text(src), _mac_text(dst))
+        if (ethertype == ether_types.ETH_TYPE_ARP and
+                len(buf) >= offset + _ARP.size):
+            (hwtype, proto, hlen, plen, opcode, src_mac, src_ip,
+             dst_mac, dst_ip) = _ARP.unpack_from(buf, offset)
+            if (hwtype == 1 and proto == ether_types.ETH_TYPE_IP and
+                    hlen == 6 and plen == 4):
+                headers.arp_opcode = opcode
+                headers.arp_src_mac = _mac_text(src_mac)
+                headers.arp_src_ip = socket.inet_ntoa(src_ip)
+                headers.arp_dst_mac = _mac_text(dst_mac)
+                headers.arp_dst_ip = socket.inet_ntoa(dst_ip)
+        return headers
+
+    def stats(self):
+        """Return the frame counts keyed by ethertype name"""
+        stats = {ETHERTYPE_NAMES.get(t, '0x%04x' % t): n
+                 for t, n in self.counters.items()}
+        stats['truncated'] = self.truncated
+        return stats
@@ -0,0 +1,63 @@
+"""Port utilization from port statistics
+
+PortStats turns the transmit byte counters of successive port stats
+replies into smoothed transmit rates, and link_costs() turns those into
+the per-link costs WeightedRouteEngine routes on:
+
+    cost = 1 + weight * utilization
+
+so an idle link costs one hop and a saturated one `weight` hops more.
+Utilization is rounded to `step` before it enters the cost, so that
+counter noise does not reroute anything.
+
+"""
+
+
+class PortStats(object):
+    """
+    Smoothed transmit rate of every switch port
+
+    alpha -- Weight of the newest sample in the moving average
+    """
+
+    def __init__(self, alpha=0.5):
+        super(PortStats, self).__init__()
+        self.alpha = alpha
+        self.counters = {}  # (dpid, port_no) -> (tx_bytes, timestamp)
+        self.rates = {}     # (dpid, port_no) -> bytes/s
+
+    def update(self, dpid, port_no, tx_bytes, timestamp):
+        key = (dpid, port_no)
+        last = self.counters.get(key)
+        self.counters[key] = (tx_bytes, timestamp)
+        if last is None or timestamp <= last[1] or tx_bytes < last[0]:
+            # First sample, or the counters were reset
+            return
+        rate = (tx_bytes - last[0]) / (timestamp - last[1])
+        old = self.rates.get(key)
+        self.rates[key] = (rate if old is None else
+                           old + self.alpha * (rate - old))
+
+    def forget(self, dpid):
+        """Drop the samples of a switch that went away"""
+        for table in (self.counters, self.rates):
+            for key in [k for k in table if k[0] == dpid]:
+                del table[key]
+
+    def utilization(self, dpid, port_no, capacity):
+        """Return the transmit rate of a port as a fraction of capacity
+        (bytes/s), capped at 1"""
+        return min(self.rates.get((dpid, port_no), 0.0) / capacity, 1.0)
+
+    def link_costs(self, graph, capacity, weight=4.0, step=0.05):
+        """
+        Return {(node id, neighbour node id): cost} for every link of a
+        TopoGraph, from the utilization of the port leading to the
+        neighbour
+        """
+        costs = {}
+        for a, dpid in enumerate(graph.dpids):
+            for b, port in zip(graph.adj[a], graph.port[a]):
+                util = self.utilization(dpid, port, capacity)
+                costs[(a, b)] = 1.0 + weight * round(util / step) * step
+        return costs
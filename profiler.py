@@ -0,0 +1,188 @@
+"""On-demand profiling of the running controller
+
+A capture runs for a given number of seconds and collects, at once:
+
+* cProfile statistics of everything the controller runs (all handlers
+  share the main thread, whichever green thread they run in);
+* stack samples of the main thread, taken every `interval` seconds by
+  a helper OS thread;
+* a tracemalloc snapshot taken at the end of the capture.
+
+It is written to a directory of its own under the output directory:
+
+    cprofile.pstats   -- for pstats, snakeviz, flameprof, ...
+    cprofile.txt      -- the top functions by cumulative time
+    stacks.folded     -- stack samples, one "frame;frame;frame count"
+                         line per stack, for flamegraph.pl or speedscope
+    memory.folded     -- bytes still allocated per allocation stack, in
+                         the same format
+    memory.snapshot   -- the tracemalloc snapshot (Snapshot.load())
+
+Captures are started by sending SIGUSR1 to ryu-manager, or from the
+metrics endpoint (GET /profile?seconds=N).
+
+"""
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from ryu.lib import hub
+
+
+def _frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class StackSampler(object):
+    """Count the stacks of one thread, sampled from a helper OS thread"""
+
+    def __init__(self, thread_id, interval=0.005):
+        super(StackSampler, self).__init__()
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()  # folded stack -> samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Ryu only monkey-patches sockets and timing, not threads, so
+        # this is a real OS thread and Event.wait() a real sleep
+        self._thread = threading.Thread(target=self._run,
+                                        name='stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        names = {}  # code -> frame name
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = _frame_name(code)
+                stack.append(name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+class ProfileCapture(object):
+    """One capture: cProfile, stack samples and a tracemalloc snapshot"""
+
+    def __init__(self, interval=0.005, memory_frames=25):
+        super(ProfileCapture, self).__init__()
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.main_thread().ident, interval)
+        self.memory_frames = memory_frames
+        self.snapshot = None
+        self.started_at = None
+        self._own_tracemalloc = False
+
+    def start(self):
+        self.started_at = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+            self._own_tracemalloc = True
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.sampler.stop()
+        self.snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),))
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+
+    def write(self, out_dir):
+        """Write the capture into a new directory under out_dir and
+        return its path"""
+        path = os.path.join(out_dir, time.strftime(
+            'sps-profile-%Y%m%d-%H%M%S', time.localtime(self.started_at)))
+        suffix = 0
+        while os.path.exists(path + ('-%d' % suffix if suffix else '')):
+            suffix += 1
+        path += '-%d' % suffix if suffix else ''
+        os.makedirs(path)
+
+        self.profile.dump_stats(os.path.join(path, 'cprofile.pstats'))
+        text = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(50)
+        with open(os.path.join(path, 'cprofile.txt'), 'w') as f:
+            f.write(text.getvalue())
+
+        with open(os.path.join(path, 'stacks.folded'), 'w') as f:
+            for stack, count in self.sampler.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+        self.snapshot.dump(os.path.join(path, 'memory.snapshot'))
+        with open(os.path.join(path, 'memory.folded'), 'w') as f:
+            for stat in self.snapshot.statistics('traceback'):
+                stack = ';'.join('%s:%d' % (os.path.basename(fr.filename),
+                                            fr.lineno)
+                                 for fr in stat.traceback)
+                f.write('%s %d\n' % (stack, stat.size))
+        return path
+
+
+class Profiler(object):
+    """
+    Run captures on request, one at a time
+
+    out_dir -- Directory the captures are written to
+    seconds -- Default capture length
+    """
+
+    def __init__(self, out_dir, seconds=30, logger=None):
+        super(Profiler, self).__init__()
+        self.out_dir = out_dir
+        self.seconds = seconds
+        self.logger = logger
+        self.running = False
+        self.last_path = None
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        """Start a capture whenever the process receives signum"""
+        signal.signal(signum, lambda signum, frame: self.trigger())
+
+    def trigger(self, seconds=None):
+        """Start a capture in its own green thread; returns False if one
+        is already running"""
+        if self.running:
+            return False
+        self.running = True
+        hub.spawn(self._run, seconds or self.seconds)
+        return True
+
+    def _run(self, seconds):
+        capture = ProfileCapture()
+        try:
+            if self.logger:
+                self.logger.info("Profiling for %d seconds", seconds)
+            capture.start()
+            try:
+                hub.sleep(seconds)
+            finally:
+                capture.stop()
+            self.last_path = capture.write(self.out_dir)
+            if self.logger:
+                self.logger.info("Profile written to %s", self.last_path)
+        finally:
+            self.running = False
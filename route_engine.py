@@ -0,0 +1,1149 @@
+"""Incremental shortest path engine
+
+Keeps one shortest path tree per destination host over the switch graph
+of a TopoManager.  Topology changes repair only the trees they touch:
+
+* a new link can only shorten paths, so distances are relaxed outwards
+  from its endpoints;
+* a deleted link or switch only invalidates the subtree hanging below
+  it, which is regrown from the surviving part of the tree.
+
+Trees are flat array('i') rows indexed by the dense node ids of the
+TopoGraph, so a tree over N switches costs 12 bytes per switch.
+
+MatrixRouteEngine offers the same interface for large topologies: it
+recomputes the full switch x destination next-hop matrix with a batched
+BFS in NumPy whenever the topology changes, optionally sharding the
+batches over a pool of worker processes.
+
+Every operation returns the next hops that actually changed as a dict
+{(dpid, destination): out_port}, with out_port None when the switch can
+no longer reach the destination.
+
+With ecmp=True both engines report every equal-cost next hop: where a
+switch has several neighbours one hop closer to the destination, its
+out_port is the sorted tuple of the ports towards them instead of a
+single port.
+
+With backups=True both engines also keep a loop-free backup next hop
+for every switch and destination: a neighbour other than the next hop
+that is no farther from the destination, or one hop farther but not
+routing through the switch.  Either way the neighbour's own path does
+not lead back through the switch, so it survives the loss of the
+switch's primary link.  backup_changes() returns the backups that
+changed since it was last called, {(dpid, destination): out_port}.
+ECMP routes get no backup: their other ports already are.
+
+WeightedRouteEngine routes on link costs instead of hop counts (see
+port_stats.py), with hysteresis against flapping between paths of
+similar cost.
+
+"""
+
+import collections
+import concurrent.futures
+import heapq
+import multiprocessing
+import os
+import tempfile
+from array import array
+
+from ryu.lib import hub
+
+try:
+    import numpy as np
+except ImportError:  # only MatrixRouteEngine needs numpy
+    np = None
+
+UNREACHABLE = -1
+
+# Where MatrixRouteEngine leaves the topology for its worker processes
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class RouteTree(object):
+    """Shortest path tree towards one destination
+
+    root      -- Node id of the switch the destination is attached to
+    root_port -- Port on the root switch leading to the destination
+    dist      -- node id -> hop count to the root switch (-1: unreachable)
+    parent    -- node id -> next node towards the root (-1 at the root)
+    port      -- node id -> output port towards the destination
+    groups    -- node id -> equal-cost output ports, for the nodes that
+                 have more than one (ECMP only)
+    backups   -- node id -> (neighbour node id, port) of its backup next
+                 hop (backups only)
+    """
+    __slots__ = ('root', 'root_port', 'dist', 'parent', 'port', 'groups',
+                 'backups')
+
+    def __init__(self, root, root_port, size):
+        self.root = root
+        self.root_port = root_port
+        self.dist = array('i', [UNREACHABLE]) * size
+        self.parent = array('i', [UNREACHABLE]) * size
+        self.port = array('i', [UNREACHABLE]) * size
+        self.groups = {}
+        self.backups = {}
+
+    def grow(self, size):
+        missing = size - len(self.dist)
+        if missing > 0:
+            pad = array('i', [UNREACHABLE]) * missing
+            self.dist.extend(pad)
+            self.parent.extend(pad)
+            self.port.extend(pad)
+
+    def members(self):
+        return [n for n, d in enumerate(self.dist) if d != UNREACHABLE]
+
+
+class RouteEngine(object):
+    """Per-destination shortest path trees with incremental repair"""
+
+    # Topology changes are repaired one by one rather than by rebuild()
+    incremental = True
+
+    def __init__(self, tm, ecmp=False, backups=False):
+        self.tm = tm
+        self.graph = tm.graph
+        self.ecmp = ecmp
+        self.backups = backups
+        self.trees = {}  # destination -> RouteTree
+        self._backup_changes = {}
+
+    def _trees(self):
+        """Iterate over the trees, sized for the current graph"""
+        size = len(self.graph)
+        for dst, tree in self.trees.items():
+            tree.grow(size)
+            yield dst, tree
+
+    # ------------------------------------------------------------------
+    # Queries
+
+    def next_hop(self, dpid, dst):
+        tree = self.trees.get(dst)
+        nid = self.graph.nodes.get(dpid)
+        if tree is None or nid is None or nid >= len(tree.port):
+            return None
+        port = tree.port[nid]
+        return None if port == UNREACHABLE else port
+
+    def path(self, dpid, dst):
+        """Return the list of DPIDs from a switch to a destination"""
+        tree = self.trees.get(dst)
+        nid = self.graph.nodes.get(dpid)
+        if (tree is None or nid is None or nid >= len(tree.dist) or
+                tree.dist[nid] == UNREACHABLE):
+            return []
+        path = [nid]
+        while tree.parent[path[-1]] != UNREACHABLE:
+            path.append(tree.parent[path[-1]])
+        return [self.graph.dpids[n] for n in path]
+
+    def routes(self, dpid):
+        """Return {destination: out_port} for every destination reachable
+        from a switch"""
+        nid = self.graph.nodes.get(dpid)
+        if nid is None:
+            return {}
+        return {dst: tree.groups.get(nid, tree.port[nid])
+                for dst, tree in self._trees()
+                if tree.port[nid] != UNREACHABLE}
+
+    def backup_routes(self, dpid):
+        """Return {destination: backup out_port} for every destination a
+        switch has a backup next hop for"""
+        nid = self.graph.nodes.get(dpid)
+        return {dst: tree.backups[nid][1] for dst, tree in self.trees.items()
+                if nid in tree.backups}
+
+    def backup_changes(self):
+        """Return the backup next hops that changed since the last call,
+        as {(dpid, destination): out_port} (None: no backup)"""
+        changes, self._backup_changes = self._backup_changes, {}
+        return changes
+
+    # ------------------------------------------------------------------
+    # Destinations
+
+    def add_destination(self, dst, dpid, port):
+        """Add (or re-attach) a destination on switch port dpid/port"""
+        changes = self.remove_destination(dst)
+        root = self.graph.node(dpid)
+        tree = RouteTree(root, port, len(self.graph))
+        self.trees[dst] = tree
+        if self.graph.is_up(root):
+            old = {}
+            self._set(tree, root, 0, UNREACHABLE, port, old)
+            self._relax(tree, [root], old)
+            self._collect(tree, dst, old, changes)
+        return changes
+
+    def add_destinations(self, dests):
+        """Add several destinations given as (dst, dpid, port) tuples"""
+        changes = {}
+        for dst, dpid, port in dests:
+            changes.update(self.add_destination(dst, dpid, port))
+        return changes
+
+    def remove_destination(self, dst):
+        tree = self.trees.pop(dst, None)
+        if tree is None:
+            return {}
+        dpids = self.graph.dpids
+        for n in tree.backups:
+            self._backup_changes[(dpids[n], dst)] = None
+        return {(dpids[n], dst): None for n in tree.members()}
+
+    # ------------------------------------------------------------------
+    # Topology
+
+    def rebuild(self):
+        """Recompute every tree from scratch against the current topology;
+        cheaper than replaying a long burst of changes one by one"""
+        changes = {}
+        for dst, tree in self._trees():
+            old = {}
+            for n in tree.members():
+                self._unset(tree, n, old)
+            if self.graph.is_up(tree.root):
+                self._set(tree, tree.root, 0, UNREACHABLE, tree.root_port,
+                          old)
+                self._relax(tree, [tree.root], old)
+            self._collect(tree, dst, old, changes, list(tree.groups))
+        return changes
+
+    def switch_added(self, dpid):
+        """Regrow trees whose destination hangs off a returning switch"""
+        changes = {}
+        nid = self.graph.nodes.get(dpid)
+        if nid is None:
+            return changes
+        for dst, tree in self._trees():
+            if tree.root == nid and tree.dist[nid] == UNREACHABLE:
+                old = {}
+                self._set(tree, nid, 0, UNREACHABLE, tree.root_port, old)
+                self._relax(tree, [nid], old)
+                self._collect(tree, dst, old, changes)
+        return changes
+
+    def switch_removed(self, dpid):
+        """Repair trees after a switch (and all its links) went away"""
+        changes = {}
+        nid = self.graph.nodes.get(dpid)
+        if nid is None:
+            return changes
+        for dst, tree in self._trees():
+            if tree.dist[nid] == UNREACHABLE:
+                continue
+            old = {}
+            if nid == tree.root:
+                for n in tree.members():
+                    self._unset(tree, n, old)
+            else:
+                orphans = [n for n, p in enumerate(tree.parent) if p == nid]
+                self._unset(tree, nid, old)
+                self._repair(tree, orphans, old)
+            # The switch's links are gone from the graph, so its former
+            # neighbours cannot be found from it; any of them that kept
+            # its distance but lost an equal-cost port is in a group, or
+            # lost the backup it had through the switch
+            extra = list(tree.groups)
+            extra.extend(n for n, (peer, _) in tree.backups.items()
+                         if peer == nid)
+            self._collect(tree, dst, old, changes, extra)
+        return changes
+
+    def link_added(self, dpid1, dpid2):
+        """Relax every tree that the new link dpid1 <-> dpid2 shortens"""
+        changes = {}
+        n1 = self.graph.nodes.get(dpid1)
+        n2 = self.graph.nodes.get(dpid2)
+        if n1 is None or n2 is None:
+            return changes
+        for dst, tree in self._trees():
+            d1 = tree.dist[n1]
+            d2 = tree.dist[n2]
+            if d1 == UNREACHABLE and d2 == UNREACHABLE:
+                continue
+            if d1 != UNREACHABLE and (d2 == UNREACHABLE or d1 + 1 < d2):
+                near, far = n1, n2
+            elif d2 != UNREACHABLE and (d1 == UNREACHABLE or d2 + 1 < d1):
+                near, far = n2, n1
+            else:
+                if self.ecmp and abs(d1 - d2) == 1 or self.backups:
+                    # An extra equal-cost next hop for the farther end,
+                    # or a new backup for either end
+                    self._collect(tree, dst, {}, changes, (n1, n2))
+                continue
+            port = self.graph.port_to(far, near)
+            if port is None:
+                continue
+            old = {}
+            self._set(tree, far, tree.dist[near] + 1, near, port, old)
+            self._relax(tree, [far], old)
+            self._collect(tree, dst, old, changes)
+        return changes
+
+    def link_deleted(self, dpid1, dpid2):
+        """Repair every tree that routed over the link dpid1 <-> dpid2"""
+        changes = {}
+        n1 = self.graph.nodes.get(dpid1)
+        n2 = self.graph.nodes.get(dpid2)
+        if n1 is None or n2 is None:
+            return changes
+        for dst, tree in self._trees():
+            if tree.parent[n1] == n2:
+                cut = n1
+            elif tree.parent[n2] == n1:
+                cut = n2
+            else:
+                if (n1 in tree.groups or n2 in tree.groups or
+                        n1 in tree.backups or n2 in tree.backups):
+                    # One equal-cost next hop or backup less, the tree is
+                    # unchanged
+                    self._collect(tree, dst, {}, changes, (n1, n2))
+                continue
+            old = {}
+            self._repair(tree, [cut], old)
+            self._collect(tree, dst, old, changes, (n1, n2))
+        return changes
+
+    # ------------------------------------------------------------------
+    # Tree maintenance
+
+    def _set(self, tree, n, dist, parent, port, old):
+        if n not in old:
+            old[n] = tree.port[n]
+        tree.dist[n] = dist
+        tree.parent[n] = parent
+        tree.port[n] = port
+
+    def _unset(self, tree, n, old):
+        if n not in old:
+            old[n] = tree.port[n]
+        tree.dist[n] = UNREACHABLE
+        tree.parent[n] = UNREACHABLE
+        tree.port[n] = UNREACHABLE
+
+    def _relax(self, tree, seeds, old):
+        """Propagate shortened distances outwards from the seed switches"""
+        adj = self.graph.adj
+        peer_port = self.graph.peer_port
+        dist = tree.dist
+        q = collections.deque(seeds)
+        while q:
+            n = q.popleft()
+            d = dist[n] + 1
+            for peer, port in zip(adj[n], peer_port[n]):
+                if dist[peer] == UNREACHABLE or dist[peer] > d:
+                    self._set(tree, peer, d, n, port, old)
+                    q.append(peer)
+
+    def _repair(self, tree, cuts, old):
+        """Drop the subtrees below the cut switches and regrow them from
+        the switches that kept their path"""
+        adj = self.graph.adj
+        peer_port = self.graph.peer_port
+        dist = tree.dist
+        children = collections.defaultdict(list)
+        for n, p in enumerate(tree.parent):
+            if p != UNREACHABLE:
+                children[p].append(n)
+        lost = set()
+        stack = [n for n in cuts if dist[n] != UNREACHABLE]
+        while stack:
+            n = stack.pop()
+            if n not in lost:
+                lost.add(n)
+                stack.extend(children.get(n, ()))
+        prev = {n: tree.parent[n] for n in lost}
+        for n in lost:
+            self._unset(tree, n, old)
+
+        # Dijkstra over the lost region, seeded from its boundary.  Ties
+        # keep the previous parent so that equal-cost paths do not churn.
+        heap = []
+        for n in lost:
+            for peer, port in zip(adj[n], self.graph.port[n]):
+                if dist[peer] != UNREACHABLE:
+                    heap.append((dist[peer] + 1, peer != prev[n],
+                                 n, peer, port))
+        heapq.heapify(heap)
+        regrown = []
+        while heap:
+            d, _, n, peer, port = heapq.heappop(heap)
+            if dist[n] != UNREACHABLE:
+                continue
+            self._set(tree, n, d, peer, port, old)
+            regrown.append(n)
+            for nxt, nxt_port in zip(adj[n], peer_port[n]):
+                if nxt in lost and dist[nxt] == UNREACHABLE:
+                    heapq.heappush(heap, (d + 1, n != prev[nxt],
+                                          nxt, n, nxt_port))
+        # The regrown region may offer shortcuts to its surroundings when
+        # links were added since the tree was last repaired
+        self._relax(tree, regrown, old)
+
+    def _collect(self, tree, dst, old, changes, extra=()):
+        """Add the next hops of the nodes in `old` (node -> previous port)
+        that changed to `changes`.  With ECMP, the equal-cost ports of
+        their neighbours and of the `extra` nodes are compared as well,
+        and so are their backups."""
+        dpids = self.graph.dpids
+        if not self.ecmp:
+            for n, port in old.items():
+                new = tree.port[n]
+                if new != port:
+                    changes[(dpids[n], dst)] = (None if new == UNREACHABLE
+                                                else new)
+            if not self.backups:
+                return
+        # A node's equal-cost ports and backup depend on its neighbours'
+        # distances
+        nodes = set(old)
+        nodes.update(extra)
+        adj = self.graph.adj
+        for n in old:
+            nodes.update(adj[n])
+        if self.ecmp:
+            self._collect_groups(tree, dst, old, changes, nodes)
+        if self.backups:
+            for n in nodes:
+                before = tree.backups.pop(n, None)
+                after = self._backup(tree, n)
+                if after is not None:
+                    tree.backups[n] = after
+                if after != before:
+                    self._backup_changes[(dpids[n], dst)] = (
+                        None if after is None else after[1])
+
+    def _collect_groups(self, tree, dst, old, changes, nodes):
+        """Compare the equal-cost ports of `nodes` to their previous next
+        hops (from `old`, or their previous group)"""
+        dpids = self.graph.dpids
+        for n in nodes:
+            before = tree.groups.pop(n, None)
+            if before is None:
+                before = old.get(n, tree.port[n])
+                if before == UNREACHABLE:
+                    before = None
+            after = self._group(tree, n)
+            if isinstance(after, tuple):
+                tree.groups[n] = after
+            if after != before:
+                changes[(dpids[n], dst)] = after
+
+    def _group(self, tree, n):
+        """Return the sorted tuple of the ports of n towards neighbours one
+        hop closer to the root, or its single port (None: unreachable)"""
+        port = tree.port[n]
+        if port == UNREACHABLE:
+            return None
+        closer = tree.dist[n] - 1
+        if closer < 0:
+            return port
+        dist = tree.dist
+        ports = [p for peer, p in zip(self.graph.adj[n], self.graph.port[n])
+                 if dist[peer] == closer]
+        return tuple(sorted(ports)) if len(ports) > 1 else port
+
+    def _backup(self, tree, n):
+        """Return the (neighbour, port) of the backup next hop of n: the
+        lowest (distance, port) neighbour other than its parent that is
+        no farther from the root, or one hop farther with another parent
+        than n"""
+        dist = tree.dist
+        d = dist[n]
+        if d == UNREACHABLE or d == 0 or n in tree.groups:
+            return None
+        parent = tree.parent
+        best = None
+        for peer, port in zip(self.graph.adj[n], self.graph.port[n]):
+            dp = dist[peer]
+            if (dp == UNREACHABLE or peer == parent[n] or dp > d + 1 or
+                    dp == d + 1 and parent[peer] == n):
+                continue
+            if best is None or (dp, port) < best[0]:
+                best = ((dp, port), peer)
+        return None if best is None else (best[1], best[0][1])
+
+
+class WeightedRouteEngine(RouteEngine):
+    """
+    Per-destination least-cost trees over weighted links
+
+    costs      -- (node id, neighbour node id) -> cost of forwarding from
+                  the node to the neighbour (1.0 if missing)
+    hysteresis -- A tree is only regrown once one of its paths costs this
+                  fraction more than the least-cost path
+
+    Any change of the topology or of the costs recomputes every tree, and
+    only the next hops that actually moved are reported.  ECMP is not
+    supported: paths of equal weighted cost are rare.
+    """
+
+    incremental = False
+
+    def __init__(self, tm, ecmp=False, backups=False, hysteresis=0.2):
+        super(WeightedRouteEngine, self).__init__(tm, backups=backups)
+        self.hysteresis = hysteresis
+        self.costs = {}  # (node id, neighbour node id) -> cost
+
+    def reweight(self, costs):
+        """Route on new link costs; returns the next hops that changed"""
+        self.costs = costs
+        return self.rebuild()
+
+    def add_destination(self, dst, dpid, port):
+        changes = self.remove_destination(dst)
+        root = self.graph.node(dpid)
+        tree = RouteTree(root, port, len(self.graph))
+        self.trees[dst] = tree
+        old = {}
+        self._dijkstra(tree, old)
+        self._collect(tree, dst, old, changes)
+        return changes
+
+    def rebuild(self):
+        changes = {}
+        # A kept tree may still have gained or lost backups
+        extra = range(len(self.graph)) if self.backups else ()
+        for dst, tree in self._trees():
+            old = {}
+            self._dijkstra(tree, old)
+            self._collect(tree, dst, old, changes, extra)
+        return changes
+
+    def switch_added(self, dpid):
+        return self.rebuild()
+
+    def switch_removed(self, dpid):
+        return self.rebuild()
+
+    def link_added(self, dpid1, dpid2):
+        return self.rebuild()
+
+    def link_deleted(self, dpid1, dpid2):
+        return self.rebuild()
+
+    def _dijkstra(self, tree, old):
+        """Regrow a tree along the least-cost paths, unless the current
+        tree is still within the hysteresis of them everywhere"""
+        adj = self.graph.adj
+        peer_port = self.graph.peer_port
+        costs = self.costs
+        prev = tree.parent
+        cost = {}
+        best = {}  # node id -> (parent, port)
+        if self.graph.is_up(tree.root):
+            # Ties keep the previous parent
+            heap = [(0.0, False, tree.root, UNREACHABLE, tree.root_port)]
+            while heap:
+                c, _, n, parent, port = heapq.heappop(heap)
+                if n in cost:
+                    continue
+                cost[n] = c
+                best[n] = (parent, port)
+                for peer, p in zip(adj[n], peer_port[n]):
+                    if peer not in cost:
+                        # Rounded so that equal-cost paths tie whatever
+                        # the order their costs were summed in
+                        heapq.heappush(heap, (
+                            round(c + costs.get((peer, n), 1.0), 9),
+                            prev[peer] != n, peer, n, p))
+        if self._keep(tree, cost):
+            return
+        for n in tree.members():
+            self._unset(tree, n, old)
+        # Parents are settled before their children in heap order
+        for n, (parent, port) in best.items():
+            self._set(tree, n, 0 if parent == UNREACHABLE
+                      else tree.dist[parent] + 1, parent, port, old)
+
+    def _keep(self, tree, cost):
+        """Return whether every path of the current tree still exists and
+        costs at most (1 + hysteresis) times the least cost"""
+        members = tree.members()
+        if len(members) != len(cost):
+            return False
+        costs = self.costs
+        slack = 1.0 + self.hysteresis
+        path = {tree.root: 0.0}
+        for n in sorted(members, key=tree.dist.__getitem__):
+            if n not in cost:
+                return False
+            if n == tree.root:
+                continue
+            parent = tree.parent[n]
+            if self.graph.port_to(n, parent) != tree.port[n]:
+                return False
+            path[n] = path[parent] + costs.get((n, parent), 1.0)
+            if path[n] > cost[n] * slack + 1e-9:
+                return False
+        return True
+
+class MatrixRouteEngine(object):
+    """All-pairs next hops computed in one pass with NumPy
+
+    ports[n, c] is the output port of node n towards destination dsts[c]
+    (-1 when unreachable).  Columns are filled by a BFS that runs from up
+    to `batch` destination switches at once: the frontier is a boolean
+    (destinations x nodes) matrix, and each level expands it over the CSR
+    edge list of the TopoGraph in one vectorized step.  A node's next hop
+    is its lowest-numbered neighbour on the previous level.
+
+    Any topology change triggers rebuild(); the returned changes are the
+    difference between the old and the new matrix.
+
+    With ECMP the BFS levels of a batch give every node's equal-cost
+    ports; those of the nodes with more than one are kept in `groups`.
+    With backups, they also give the backup ports, kept in the matrix
+    backup_ports.
+
+    With workers > 1 the batches are sharded over a pool of that many
+    processes.  The CSR arrays are written to a file the workers map
+    read-only; each worker returns the next hops of its batches and the
+    controller merges them into the matrix.
+    """
+
+    incremental = False
+
+    # Smallest batch worth shipping to a worker process
+    MIN_SHARD = 16
+    # Seconds between checks on the results of the worker processes
+    POLL_INTERVAL = 0.002
+
+    def __init__(self, tm, batch=256, ecmp=False, backups=False, workers=0):
+        if np is None:
+            raise ImportError("MatrixRouteEngine needs numpy")
+        self.tm = tm
+        self.graph = tm.graph
+        self.batch = batch
+        self.ecmp = ecmp
+        self.backups = backups
+        self.workers = workers
+        self.groups = {}    # destination -> {node id: equal-cost ports}
+        self.dsts = []      # column -> destination
+        self.columns = {}   # destination -> column
+        self.roots = []     # column -> (root node id, root port)
+        self.ports = np.full((0, 0), UNREACHABLE, np.int32)
+        self.backup_ports = np.full((0, 0), UNREACHABLE, np.int32)
+        self._backup_changes = {}
+        self._csr_cache = None
+        self._pool = None
+
+    def _reserve(self, rows, cols):
+        old_rows, old_cols = self.ports.shape
+        if rows <= old_rows and cols <= old_cols:
+            return
+        new_cols = max(cols, old_cols * 2) if cols > old_cols else old_cols
+        shape = (max(rows, old_rows), new_cols)
+        ports = np.full(shape, UNREACHABLE, np.int32)
+        ports[:old_rows, :old_cols] = self.ports
+        self.ports = ports
+        backup_ports = np.full(shape, UNREACHABLE, np.int32)
+        backup_ports[:old_rows, :old_cols] = self.backup_ports
+        self.backup_ports = backup_ports
+
+    # ------------------------------------------------------------------
+    # Queries
+
+    def matrix(self):
+        """Return (dpids, destinations, ports) with ports the next-hop
+        port matrix indexed [node id, destination column]"""
+        n = len(self.graph)
+        self._reserve(n, len(self.dsts))
+        return self.graph.dpids, self.dsts, self.ports[:n, :len(self.dsts)]
+
+    def next_hop(self, dpid, dst):
+        nid = self.graph.nodes.get(dpid)
+        col = self.columns.get(dst)
+        if nid is None or col is None or nid >= self.ports.shape[0]:
+            return None
+        port = int(self.ports[nid, col])
+        return None if port == UNREACHABLE else port
+
+    def path(self, dpid, dst):
+        """Return the list of DPIDs from a switch to a destination"""
+        col = self.columns.get(dst)
+        nid = self.graph.nodes.get(dpid)
+        if col is None or nid is None or nid >= self.ports.shape[0]:
+            return []
+        root = self.roots[col][0]
+        path = []
+        while self.ports[nid, col] != UNREACHABLE:
+            path.append(nid)
+            if nid == root or len(path) > len(self.graph):
+                break
+            port = self.ports[nid, col]
+            row = self.graph.port[nid]
+            nid = next(self.graph.adj[nid][i] for i in range(len(row))
+                       if row[i] == port)
+        return [self.graph.dpids[n] for n in path]
+
+    def routes(self, dpid):
+        """Return {destination: out_port} for every destination reachable
+        from a switch"""
+        nid = self.graph.nodes.get(dpid)
+        if nid is None or nid >= self.ports.shape[0]:
+            return {}
+        row = self.ports[nid, :len(self.dsts)]
+        routes = {self.dsts[c]: int(row[c])
+                  for c in np.flatnonzero(row != UNREACHABLE)}
+        for dst, groups in self.groups.items():
+            if nid in groups:
+                routes[dst] = groups[nid]
+        return routes
+
+    def backup_routes(self, dpid):
+        """Return {destination: backup out_port} for every destination a
+        switch has a backup next hop for"""
+        nid = self.graph.nodes.get(dpid)
+        if nid is None or nid >= self.backup_ports.shape[0]:
+            return {}
+        row = self.backup_ports[nid, :len(self.dsts)]
+        return {self.dsts[c]: int(row[c])
+                for c in np.flatnonzero(row != UNREACHABLE)}
+
+    def backup_changes(self):
+        """Return the backup next hops that changed since the last call,
+        as {(dpid, destination): out_port} (None: no backup)"""
+        changes, self._backup_changes = self._backup_changes, {}
+        return changes
+
+    # ------------------------------------------------------------------
+    # Destinations
+
+    def add_destination(self, dst, dpid, port):
+        """Add (or re-attach) a destination on switch port dpid/port"""
+        return self.add_destinations([(dst, dpid, port)])
+
+    def add_destinations(self, dests):
+        """Add several destinations given as (dst, dpid, port) tuples;
+        their columns are computed in shared BFS batches"""
+        changes = {}
+        cols = []
+        for dst, dpid, port in dests:
+            changes.update(self.remove_destination(dst))
+            self.columns[dst] = len(self.dsts)
+            self.dsts.append(dst)
+            self.roots.append((self.graph.node(dpid), port))
+            cols.append(self.columns[dst])
+        self._compute(cols, changes)
+        return changes
+
+    def remove_destination(self, dst):
+        col = self.columns.pop(dst, None)
+        if col is None:
+            return {}
+        dpids = self.graph.dpids
+        column = self.ports[:len(self.graph), col]
+        changes = {(dpids[n], dst): None
+                   for n in np.flatnonzero(column != UNREACHABLE)}
+        backups = self.backup_ports[:len(self.graph), col]
+        for n in np.flatnonzero(backups != UNREACHABLE):
+            self._backup_changes[(dpids[n], dst)] = None
+        self.groups.pop(dst, None)
+        # Move the last column into the hole to keep the matrix dense
+        last = len(self.dsts) - 1
+        if col != last:
+            moved = self.dsts[last]
+            self.dsts[col] = moved
+            self.roots[col] = self.roots[last]
+            self.columns[moved] = col
+            self.ports[:, col] = self.ports[:, last]
+            self.backup_ports[:, col] = self.backup_ports[:, last]
+        self.dsts.pop()
+        self.roots.pop()
+        self.ports[:, last] = UNREACHABLE
+        self.backup_ports[:, last] = UNREACHABLE
+        return changes
+
+    # ------------------------------------------------------------------
+    # Topology
+
+    def rebuild(self):
+        """Recompute the whole next-hop matrix"""
+        changes = {}
+        self._compute(list(range(len(self.dsts))), changes)
+        return changes
+
+    def switch_added(self, dpid):
+        return self.rebuild()
+
+    def switch_removed(self, dpid):
+        return self.rebuild()
+
+    def link_added(self, dpid1, dpid2):
+        return self.rebuild()
+
+    def link_deleted(self, dpid1, dpid2):
+        return self.rebuild()
+
+    # ------------------------------------------------------------------
+    # Computation
+
+    def _compute(self, cols, changes):
+        n = len(self.graph)
+        self._reserve(n, len(self.dsts))
+        dpids = np.array(self.graph.dpids, object)
+        chunks = self._shards(cols)
+        for chunk, (new, backups, groups) in zip(chunks,
+                                                 self._solve(chunks, n)):
+            new = new.T
+            old = self.ports[:n, chunk]
+            rows, idx = np.nonzero(old != new)
+            # Build the change dict in bulk; it dominates on large graphs
+            ports = new[rows, idx].astype(object)
+            ports[ports == UNREACHABLE] = None
+            dsts = self._dst_array(chunk)
+            changes.update(zip(zip(dpids[rows].tolist(), dsts[idx].tolist()),
+                               ports.tolist()))
+            self.ports[:n, chunk] = new
+            if self.ecmp:
+                self._update_groups(chunk, new, groups, changes)
+            if self.backups:
+                self._update_backups(chunk, backups.T)
+
+    def _shards(self, cols):
+        """Split columns into BFS batches: of `batch` columns, or fewer so
+        that every worker process gets a share"""
+        size = self.batch
+        if self.workers > 1:
+            share = -(-len(cols) // self.workers)
+            size = min(size, max(share, self.MIN_SHARD))
+        return [cols[i:i + size] for i in range(0, len(cols), size)]
+
+    def _solve(self, chunks, n):
+        """Yield (next-hop ports, backup ports, equal-cost groups) of every
+        chunk of columns, as CsrGraph.solve() returns them, computed in
+        this process or by the worker pool"""
+        csr = self._csr()
+        roots = [[self._root(c) for c in chunk] for chunk in chunks]
+        if self.workers <= 1 or len(chunks) < 2:
+            for batch in roots:
+                yield csr.solve(batch, n, self.ecmp, self.backups)
+            return
+        # The workers map the topology from a file, removed again once
+        # all of their results are in
+        fd, path = tempfile.mkstemp(prefix='sps-csr-', dir=SHARED_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                csr.write(f)
+            pool = self._executor()
+            futures = [pool.submit(_solve_shard, path, batch, n, self.ecmp,
+                                   self.backups) for batch in roots]
+            for batch, future in zip(roots, futures):
+                try:
+                    # ryu-manager does not monkey patch threading, so
+                    # future.result() would block every green thread:
+                    # poll, sleeping in between, so that they run
+                    while not future.done():
+                        hub.sleep(self.POLL_INTERVAL)
+                    result = future.result()
+                except concurrent.futures.BrokenExecutor:
+                    # A worker died (killed, out of memory): finish here
+                    # and start a new pool next time
+                    self._pool = None
+                    result = csr.solve(batch, n, self.ecmp, self.backups)
+                yield result
+        finally:
+            os.unlink(path)
+
+    def _root(self, col):
+        """Return the (node id, port) BFS root of a column, with node id
+        -1 while its switch is down"""
+        nid, port = self.roots[col]
+        return (nid if self.graph.is_up(nid) else UNREACHABLE), port
+
+    def _dst_array(self, chunk):
+        """Return the destinations of chunk as an object array (filled
+        one by one: NumPy would unpack tuple destinations)"""
+        dsts = np.empty(len(chunk), object)
+        for i, c in enumerate(chunk):
+            dsts[i] = self.dsts[c]
+        return dsts
+
+    def _update_backups(self, chunk, backups):
+        """Store the (nodes x chunk) backup ports of the destinations in
+        chunk, except for the nodes with equal-cost ports, and record the
+        ones that changed"""
+        n = backups.shape[0]
+        for i, c in enumerate(chunk):
+            for nid in self.groups.get(self.dsts[c], ()):
+                backups[nid, i] = UNREACHABLE
+        old = self.backup_ports[:n, chunk]
+        rows, idx = np.nonzero(old != backups)
+        if len(rows):
+            dpids = np.array(self.graph.dpids, object)
+            dsts = self._dst_array(chunk)
+            ports = backups[rows, idx].astype(object)
+            ports[ports == UNREACHABLE] = None
+            self._backup_changes.update(zip(
+                zip(dpids[rows].tolist(), dsts[idx].tolist()),
+                ports.tolist()))
+        self.backup_ports[:n, chunk] = backups
+
+    def _update_groups(self, chunk, new, groups, changes):
+        """Replace the equal-cost port groups of the destinations in chunk
+        by `groups`, as CsrGraph.groups() returns them, and report the
+        nodes whose group changed.  A node that enters, leaves or keeps a
+        group while its primary port changed is reported with its
+        group."""
+        dpids = self.graph.dpids
+        for i, c in enumerate(chunk):
+            dst = self.dsts[c]
+            before = self.groups.pop(dst, {})
+            after = groups[i]
+            if after:
+                self.groups[dst] = after
+            for nid, group in after.items():
+                key = (dpids[nid], dst)
+                if key in changes or before.get(nid) != group:
+                    changes[key] = group
+            for nid in before:
+                if nid not in after:
+                    port = int(new[nid, i])
+                    changes[(dpids[nid], dst)] = (None if port == UNREACHABLE
+                                                  else port)
+
+    def _csr(self):
+        cache = self._csr_cache
+        if cache is None or cache[0] != self.graph.version:
+            self._csr_cache = (self.graph.version,
+                               CsrGraph.from_graph(self.graph))
+        return self._csr_cache[1]
+
+    # ------------------------------------------------------------------
+    # Worker processes
+
+    def _executor(self):
+        if self._pool is None:
+            # Forked workers need nothing of the controller but this
+            # module; Ryu's green sockets rule out a fork server
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('fork'))
+        return self._pool
+
+    def close(self):
+        """Stop the worker processes"""
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+class CsrGraph(object):
+    """
+    Read-only CSR form of the links of a TopoGraph, as NumPy arrays with
+    every row sorted by neighbour id so that ties always go to the lowest
+    node id whichever direction the BFS runs in
+
+    MatrixRouteEngine runs its BFS batches on it, either in the
+    controller or in worker processes that map a copy written to a file.
+    Everything a batch needs comes from the CSR arrays and the roots, so
+    the batches of one computation are independent of each other.
+    """
+
+    # Upper bound on the (destinations x edges) cells compared at once
+    # when looking for equal-cost or backup ports
+    GROUP_CELLS = 1 << 24
+
+    def __init__(self, offsets, targets, ports, peer_ports):
+        self.offsets = offsets
+        self.deg = np.diff(offsets)
+        self.targets = targets
+        self.ports = ports
+        self.peer_ports = peer_ports
+
+    @classmethod
+    def from_graph(cls, graph):
+        offsets, targets, ports, peer_ports = (
+            np.frombuffer(a, np.intc) for a in graph.csr())
+        deg = np.diff(offsets)
+        rows = np.repeat(np.arange(len(deg)), deg)
+        order = np.lexsort((targets, rows))
+        return cls(offsets, targets[order], ports[order], peer_ports[order])
+
+    def write(self, f):
+        """Write the node count, the edge count and the four arrays to a
+        file as native int32"""
+        np.array([len(self.deg), len(self.targets)], np.int32).tofile(f)
+        for a in (self.offsets, self.targets, self.ports, self.peer_ports):
+            a.astype(np.int32, copy=False).tofile(f)
+
+    @classmethod
+    def map(cls, path):
+        """Return the CsrGraph of a file written by write(), memory-mapped
+        read-only"""
+        data = np.memmap(path, np.int32, 'r').view(np.ndarray)
+        n, edges = int(data[0]), int(data[1])
+        start = 2 + n + 1
+        return cls(data[2:start],
+                   *(data[start + i * edges:start + (i + 1) * edges]
+                     for i in range(3)))
+
+    def solve(self, roots, n, ecmp=False, backups=False):
+        """
+        Return the (roots x nodes) next-hop ports of a BFS batch, its
+        (roots x nodes) backup ports when `backups` (else None) and its
+        equal-cost groups, as groups() returns them, when `ecmp` (else
+        None)
+        """
+        out, dist = self.bfs(roots, n)
+        return (out, self.backups(out, dist) if backups else None,
+                self.groups(dist) if ecmp else None)
+
+    def backups(self, out, dist):
+        """
+        Return the (roots x nodes) backup ports of a BFS batch, given its
+        next-hop ports and levels: per node, the lowest (level, port)
+        edge to a neighbour other than the next hop on the same or a
+        lower level, or on the next level when that neighbour's next hop
+        is not the node (-1 when there is none)
+        """
+        n = dist.shape[1]
+        backups = np.full(dist.shape, UNREACHABLE, np.int32)
+        offsets, deg = self.offsets, self.deg
+        edges = int(offsets[n])
+        if not edges:
+            return backups
+        sources = np.repeat(np.arange(n), deg[:n])
+        targets = self.targets[:edges]
+        ports = self.ports[:edges].astype(np.int64)
+        peer_ports = self.peer_ports[:edges]
+        linked = np.flatnonzero(deg[:n])
+        starts = offsets[linked]
+        none = np.iinfo(np.int64).max
+        step = max(1, self.GROUP_CELLS // edges)
+        for r0 in range(0, len(dist), step):
+            level = dist[r0:r0 + step]
+            primary = out[r0:r0 + step]
+            near = level[:, sources]
+            far = level[:, targets]
+            ok = ((far != UNREACHABLE) & (near > 0) &
+                  (ports != primary[:, sources]) &
+                  ((far <= near) |
+                   (far == near + 1) & (primary[:, targets] != peer_ports)))
+            score = np.where(ok, far.astype(np.int64) << 32 | ports, none)
+            best = np.minimum.reduceat(score, starts, axis=1)
+            backups[r0:r0 + step, linked] = np.where(
+                best != none, best & 0xffffffff, UNREACHABLE)
+        return backups
+
+    def groups(self, dist):
+        """
+        Return, for each row of the (roots x nodes) BFS levels `dist`, a
+        dict {node id: sorted tuple of equal-cost ports} of the nodes
+        with more than one edge to the previous level
+        """
+        n = dist.shape[1]
+        edges = int(self.offsets[n])
+        sources = np.repeat(np.arange(n), self.deg[:n])
+        targets = self.targets[:edges]
+        ports = self.ports[:edges]
+        result = []
+        step = max(1, self.GROUP_CELLS // max(edges, 1))
+        for r0 in range(0, len(dist), step):
+            level = dist[r0:r0 + step]
+            near = level[:, sources]
+            # Rows come out of nonzero() sorted by (root, edge), and the
+            # edges of a node are contiguous
+            r, e = np.nonzero((level[:, targets] == near - 1) & (near > 0))
+            key = r.astype(np.int64) * n + sources[e]
+            _, start, count = np.unique(key, return_index=True,
+                                        return_counts=True)
+            multi = np.repeat(count > 1, count)
+            r, key, p = r[multi], key[multi], ports[e[multi]]
+            order = np.lexsort((p, key))
+            r, key, p = r[order], key[order], p[order]
+            count = count[count > 1]
+            first = np.cumsum(count) - count
+            found = [{} for _ in range(len(level))]
+            for row, node, group in zip(
+                    r[first].tolist(), (key[first] % n).tolist(),
+                    np.split(p, first[1:])):
+                found[row][node] = tuple(group.tolist())
+            result.extend(found)
+        return result
+
+    @staticmethod
+    def _expand(offsets, deg, nodes):
+        """Return the edge indexes of the given nodes and, for each edge,
+        the position of its node in `nodes`"""
+        counts = deg[nodes]
+        pair = np.repeat(np.arange(len(nodes)), counts)
+        starts = np.cumsum(counts) - counts
+        edges = (np.arange(counts.sum()) - starts[pair] +
+                 offsets[nodes][pair])
+        return edges, pair, starts
+
+    def bfs(self, roots, n):
+        """
+        Return the (roots x nodes) next-hop ports and BFS levels (hop
+        counts, -1 when unreachable) of a BFS batch.  Roots are (node id,
+        port) pairs; a root with node id -1 reaches nothing.
+
+        Each level either pushes from the frontier along its edges or
+        pulls into the unreached nodes from theirs, whichever touches
+        fewer edges: dense graphs are settled in a level or two of pushes
+        and pulls, sparse ones never scan more than the frontier.
+        """
+        targets, ports, peer_ports = self.targets, self.ports, self.peer_ports
+        offsets = self.offsets[:n + 1]
+        deg = self.deg[:n]
+        out = np.full((len(roots), n), UNREACHABLE, np.int32)
+        dist = np.full((len(roots), n), UNREACHABLE, np.int32)
+        reached = np.zeros((len(roots), n), bool)
+        frontier = np.zeros((len(roots), n), bool)
+        for r, (nid, root_port) in enumerate(roots):
+            if nid != UNREACHABLE:
+                out[r, nid] = root_port
+                dist[r, nid] = 0
+                frontier[r, nid] = True
+        reached |= frontier
+        linked = deg > 0
+        level = 0
+        while True:
+            fr_r, fr_n = np.nonzero(frontier)
+            if not len(fr_r):
+                break
+            un_r, un_n = np.nonzero(~reached & linked)
+            if not len(un_r):
+                break
+            if deg[fr_n].sum() <= deg[un_n].sum():
+                # Push: rows come out of nonzero() sorted by (root, node),
+                # so the first hit of a node is its lowest frontier peer
+                edges, pair, _ = self._expand(offsets, deg, fr_n)
+                r = fr_r[pair]
+                v = targets[edges]
+                fresh = ~reached[r, v]
+                r, v, edges = r[fresh], v[fresh], edges[fresh]
+                _, first = np.unique(r.astype(np.int64) * n + v,
+                                     return_index=True)
+                r, v = r[first], v[first]
+                port = peer_ports[edges[first]]
+            else:
+                # Pull: the first frontier peer in a sorted row
+                edges, pair, starts = self._expand(offsets, deg, un_n)
+                hit = frontier[un_r[pair], targets[edges]]
+                none = len(targets)
+                first = np.minimum.reduceat(np.where(hit, edges, none),
+                                            starts)
+                found = first < none
+                r, v = un_r[found], un_n[found]
+                port = ports[first[found]]
+            level += 1
+            out[r, v] = port
+            dist[r, v] = level
+            reached[r, v] = True
+            frontier[:] = False
+            frontier[r, v] = True
+        return out, dist
+
+
+def _solve_shard(path, roots, n, ecmp, backups):
+    """Worker process: solve one BFS batch over the CSR file at path"""
+    return CsrGraph.map(path).solve(roots, n, ecmp, backups)
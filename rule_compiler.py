@@ -0,0 +1,112 @@
+"""Prefix rule compiler
+
+compress() turns the next hops of individual IPv4 addresses into the
+fewest longest-prefix-match rules that forward every address the same
+way, with the ORTC algorithm (Draves et al., "Constructing Optimal IP
+Routing Tables", 1999):
+
+1. build a binary trie of the addresses; going up, each node gets the
+   set of next hops that could serve its whole subtree: the
+   intersection of its children's sets if they share one, their union
+   otherwise;
+2. going down, a node inherits the next hop of the nearest rule above
+   it when that hop is in its set, and gets a rule of its own
+   otherwise.
+
+The root always gets a rule, the /0 default, on the most common next
+hop.  Addresses without a next hop are "don't care": traffic to them
+follows whichever rule covers them, so they must be addresses that
+carry no traffic (unassigned ones) or be matched by more specific
+rules elsewhere.  Given an `unknown` next hop (a drop, say), they get
+that one instead: the trie then also holds the empty halves of its
+nodes, as leaves with the unknown hop.  The /0 default is then the
+unknown hop, and the most common next hop the default of the prefixes
+that hold the addresses.
+
+"""
+
+import bisect
+import collections
+import socket
+import struct
+
+
+def _aton(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def _ntoa(addr):
+    return socket.inet_ntoa(struct.pack('!I', addr))
+
+
+def _build(addrs, hops, lo, hi, prefix, depth, unknown):
+    """Return the trie node (prefix, length, next hop set, children) of
+    the sorted addresses addrs[lo:hi], all under prefix/depth"""
+    if hi - lo == 1:
+        leaf = addrs[lo], 32, frozenset((hops[lo],)), ()
+        if unknown is None or depth == 32:
+            return leaf
+        empty = frozenset((unknown,))
+        if depth == 31:
+            return (prefix, 31, leaf[2] | empty,
+                    (leaf, (addrs[lo] ^ 1, 32, empty, ())))
+        # A lone address among unknown ones: the chain of nodes down to
+        # it only ever needs an unknown rule here and its own /32
+        return prefix, depth, empty, (leaf,)
+    bit = 1 << (31 - depth)
+    mid = bisect.bisect_left(addrs, prefix | bit, lo, hi)
+    if unknown is None:
+        if mid == lo:
+            return _build(addrs, hops, lo, hi, prefix | bit, depth + 1,
+                          unknown)
+        if mid == hi:
+            return _build(addrs, hops, lo, hi, prefix, depth + 1, unknown)
+    empty = frozenset((unknown,))
+    if mid == lo:
+        left = prefix, depth + 1, empty, ()
+    else:
+        left = _build(addrs, hops, lo, mid, prefix, depth + 1, unknown)
+    if mid == hi:
+        right = prefix | bit, depth + 1, empty, ()
+    else:
+        right = _build(addrs, hops, mid, hi, prefix | bit, depth + 1,
+                       unknown)
+    common = left[2] & right[2]
+    return prefix, depth, common or (left[2] | right[2]), (left, right)
+
+
+def compress(routes, unknown=None):
+    """
+    Return the prefix rules {(network, prefix length): next hop} that
+    forward every address of routes ({IPv4 address: next hop}) to its
+    next hop under longest prefix match, and every other address to
+    unknown if given.  Next hops may be any hashable value.
+    """
+    if not routes:
+        return {}
+    items = sorted((_aton(ip), hop) for ip, hop in routes.items())
+    addrs = [a for a, _ in items]
+    hops = [h for _, h in items]
+    # Prefer the most common next hops, so the default covers the most,
+    # and the unknown hop last
+    counts = collections.Counter(hops)
+    rank = {hop: (-count, repr(hop)) for hop, count in counts.items()}
+    rank.setdefault(unknown, (0, repr(unknown)))
+
+    # Everything outside the root's subtree is don't care (or has the
+    # unknown hop, like its empty halves), so the root rule can always
+    # be the /0 default
+    _, _, candidates, children = _build(addrs, hops, 0, len(addrs), 0, 0,
+                                        unknown)
+    rules = {}
+    stack = [((0, 0, candidates, children), None)]
+    while stack:
+        (prefix, length, candidates, children), inherited = stack.pop()
+        if inherited in candidates:
+            hop = inherited
+        else:
+            hop = min(candidates, key=rank.__getitem__)
+            rules[(_ntoa(prefix), length)] = hop
+        for child in children:
+            stack.append((child, hop))
+    return rules
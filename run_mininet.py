@@ -5,6 +5,7 @@ Custom topologies for project SDN
 
 import sys
 import time
+import random
 import argparse
 
 from mininet.cli import CLI
@@ -109,6 +110,167 @@ class MeshTopo(Topo):
                 self.addLink(switches[i], switches[j])
 
 
+class DataCenterTopo(Topo):
+    """
+    Base of the parameterized topologies: switches and hosts are named
+    s1, s2, ... and h1, h2, ... in the order they are added, so the
+    DPIDs follow the construction
+    """
+    def __init__(self, **opts):
+        Topo.__init__(self, **opts)
+        self.n_switches = 0
+        self.n_hosts = 0
+
+    def add_switch(self):
+        self.n_switches += 1
+        return self.addSwitch('s%d' % self.n_switches)
+
+    def add_hosts(self, switch, count):
+        for _ in range(count):
+            self.n_hosts += 1
+            h = self.addHost('h%d' % self.n_hosts)
+            self.addLink(h, switch)
+
+
+class FatTreeTopo(DataCenterTopo):
+    """
+    k-ary fat tree: k pods of k/2 edge and k/2 aggregation switches, and
+    (k/2)^2 core switches.  Every edge switch has `hosts` hosts (k/2 by
+    default, k^3/4 in total).
+    """
+    def __init__(self, k=4, hosts=None, **opts):
+        DataCenterTopo.__init__(self, **opts)
+        half = k // 2
+        if hosts is None:
+            hosts = half
+        cores = [self.add_switch() for _ in range(half * half)]
+        for pod in range(k):
+            aggs = [self.add_switch() for _ in range(half)]
+            for i, agg in enumerate(aggs):
+                # Aggregation switch i links to the i-th group of cores
+                for core in cores[i * half:(i + 1) * half]:
+                    self.addLink(agg, core)
+            for _ in range(half):
+                edge = self.add_switch()
+                for agg in aggs:
+                    self.addLink(edge, agg)
+                self.add_hosts(edge, hosts)
+
+
+class LeafSpineTopo(DataCenterTopo):
+    """Two-tier Clos: every leaf switch links to every spine switch, and
+    the hosts hang off the leaves"""
+    def __init__(self, leaves=4, spines=2, hosts=2, **opts):
+        DataCenterTopo.__init__(self, **opts)
+        spine_switches = [self.add_switch() for _ in range(spines)]
+        for _ in range(leaves):
+            leaf = self.add_switch()
+            for spine in spine_switches:
+                self.addLink(leaf, spine)
+            self.add_hosts(leaf, hosts)
+
+
+class JellyfishTopo(DataCenterTopo):
+    """
+    Jellyfish: a random regular graph of n switches with `degree` links
+    each (one port stays free when n * degree is odd), built by stub
+    pairing: shuffle every free port and pair them off, then use up the
+    ports of the self-loops and duplicate links by breaking up random
+    links.  The same seed builds the same graph.
+    """
+    def __init__(self, n=8, degree=3, hosts=1, seed=0, **opts):
+        DataCenterTopo.__init__(self, **opts)
+        rnd = random.Random(seed)
+        switches = [self.add_switch() for _ in range(n)]
+        stubs = [s for s in switches for _ in range(degree)]
+        rnd.shuffle(stubs)
+        # A list keeps the random picks below reproducible; the set
+        # answers "already linked?" in O(1)
+        links = []
+        linked = set()
+
+        def join(a, b):
+            links.append((a, b))
+            linked.add((a, b))
+            linked.add((b, a))
+
+        def split(i):
+            a, b = links[i]
+            links[i] = links[-1]
+            links.pop()
+            linked.discard((a, b))
+            linked.discard((b, a))
+
+        def fits(s, t, x, y):
+            return (x not in (s, t) and y not in (s, t) and
+                    (s, x) not in linked and (t, y) not in linked)
+
+        left = []
+        for a, b in zip(stubs[::2], stubs[1::2]):
+            if a != b and (a, b) not in linked:
+                join(a, b)
+            else:
+                left += [a, b]
+        left += stubs[len(stubs) & ~1:]
+        # Pair off what the self-loops and duplicates left over where
+        # that makes a new link
+        pending, left = left, []
+        for s in pending:
+            for i, t in enumerate(left):
+                if s != t and (s, t) not in linked:
+                    join(s, t)
+                    del left[i]
+                    break
+            else:
+                left.append(s)
+        # The rest take the place of a random link x-y: s-x and t-y.
+        # Random picks almost always fit; only small, dense graphs need
+        # the full search
+        while len(left) >= 2:
+            s, t = left.pop(), left.pop()
+            found = None
+            for _ in range(len(links)):
+                i = rnd.randrange(len(links))
+                x, y = links[i]
+                if rnd.random() < 0.5:
+                    x, y = y, x
+                if fits(s, t, x, y):
+                    found = i, (x, y)
+                    break
+            if found is None:
+                candidates = [(i, (x, y)) for i, (a, b) in enumerate(links)
+                              for x, y in ((a, b), (b, a))
+                              if fits(s, t, x, y)]
+                if not candidates:
+                    break
+                found = rnd.choice(candidates)
+            i, (x, y) = found
+            split(i)
+            join(s, x)
+            join(t, y)
+        for a, b in sorted(links):
+            self.addLink(a, b)
+        for s in switches:
+            self.add_hosts(s, hosts)
+
+
+class TorusTopo(DataCenterTopo):
+    """2D torus: a rows x cols grid whose rows and columns wrap around,
+    with `hosts` hosts on every switch"""
+    def __init__(self, rows=4, cols=4, hosts=1, **opts):
+        DataCenterTopo.__init__(self, **opts)
+        grid = [[self.add_switch() for _ in range(cols)]
+                for _ in range(rows)]
+        for r in range(rows):
+            for c in range(cols):
+                # A dimension of two would wrap onto the same link again
+                if c + 1 < cols or cols > 2:
+                    self.addLink(grid[r][c], grid[r][(c + 1) % cols])
+                if r + 1 < rows or rows > 2:
+                    self.addLink(grid[r][c], grid[(r + 1) % rows][c])
+                self.add_hosts(grid[r][c], hosts)
+
+
 ALL_TOPOLOGIES = {
     "single": SingleSwitchTopo,
     "tree": TreeTopo,
@@ -117,6 +279,10 @@ ALL_TOPOLOGIES = {
     "triangle": TriangleTopo,
     "mesh": MeshTopo,
     "someloops": SomeLoopsTopo,
+    "fattree": FatTreeTopo,
+    "leafspine": LeafSpineTopo,
+    "jellyfish": JellyfishTopo,
+    "torus": TorusTopo,
 }
 
 
@@ -166,6 +332,23 @@ def main():
     sp_cmds["tree"].add_argument("depth", type=int)
     sp_cmds["linear"].add_argument("nodes", type=int)
     sp_cmds["mesh"].add_argument("nodes", type=int)
+    sp_cmds["fattree"].add_argument("k", type=int)
+    sp_cmds["fattree"].add_argument("--hosts", type=int, default=None,
+                                    help="hosts per edge switch (k/2)")
+    sp_cmds["leafspine"].add_argument("leaves", type=int)
+    sp_cmds["leafspine"].add_argument("spines", type=int)
+    sp_cmds["leafspine"].add_argument("--hosts", type=int, default=2,
+                                      help="hosts per leaf switch")
+    sp_cmds["jellyfish"].add_argument("switches", type=int)
+    sp_cmds["jellyfish"].add_argument("degree", type=int,
+                                      help="switch links per switch")
+    sp_cmds["jellyfish"].add_argument("--hosts", type=int, default=1,
+                                      help="hosts per switch")
+    sp_cmds["jellyfish"].add_argument("--seed", type=int, default=0)
+    sp_cmds["torus"].add_argument("rows", type=int)
+    sp_cmds["torus"].add_argument("cols", type=int)
+    sp_cmds["torus"].add_argument("--hosts", type=int, default=1,
+                                  help="hosts per switch")
 
     args = parser.parse_args()
 
@@ -179,6 +362,20 @@ def main():
         topo = ALL_TOPOLOGIES["linear"](args.nodes)
     elif args.command == "mesh":
         topo = ALL_TOPOLOGIES["mesh"](args.nodes)
+    elif args.command == "fattree":
+        if args.k < 2 or args.k % 2:
+            parser.error("k must be even")
+        topo = ALL_TOPOLOGIES["fattree"](args.k, args.hosts)
+    elif args.command == "leafspine":
+        topo = ALL_TOPOLOGIES["leafspine"](args.leaves, args.spines,
+                                           args.hosts)
+    elif args.command == "jellyfish":
+        if not 0 < args.degree < args.switches:
+            parser.error("degree must be between 1 and switches - 1")
+        topo = ALL_TOPOLOGIES["jellyfish"](args.switches, args.degree,
+                                           args.hosts, args.seed)
+    elif args.command == "torus":
+        topo = ALL_TOPOLOGIES["torus"](args.rows, args.cols, args.hosts)
     else:
         topo = ALL_TOPOLOGIES[args.command]()
 
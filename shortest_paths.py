@@ -12,50 +12,1299 @@ path switching.
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
+from ryu.controller.event import EventBase
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
-from ryu.ofproto import ofproto_v1_0
+from ryu.ofproto import ofproto_v1_0, ofproto_v1_3
 
 from ryu.topology import event, switches
+from ryu.lib import hub
 import ryu.topology.api as topo
 
 from ryu.lib.packet import packet, ether_types
 from ryu.lib.packet import ethernet, arp, icmp
 
-from ofctl_utils import OfCtl, VLANID_NONE
+from ofctl_utils import OfCtl, StatsCollector, VLANID_NONE
+from ofctl_utils import VLANID_MIN, VLANID_MAX
 
 from topo_manager_example import *
-import queue
+from route_engine import RouteEngine, MatrixRouteEngine, WeightedRouteEngine
+from flow_table import FlowTable, FLOW_ADD, FLOW_MODIFY, FLOW_DELETE
+from flow_table import SourceRule, PrefixRule, Failover, DROP
+from flow_table import LabelRule, PushLabel
+from event_coalescer import EventCoalescer
+from arp_cache import ArpReplyCache
+from packet_classifier import PacketClassifier
+from broadcast_tree import SpanningTree, FloodTable
+from event_trace import TraceRecorder
+from metrics import MetricsRegistry, MetricsServer
+from profiler import Profiler
+from port_stats import PortStats
+from snapshot import Snapshot
+import collections
+import functools
+import heapq
+import os
+import tempfile
+import time
+import zlib
 
 DEFAULT_COOKIE = 0
-DEFAULT_PRIORITY = 0
+# Rule priorities, lowest first: ARP to the controller (OpenFlow 1.3),
+# compressed nw_dst prefix rules (plus the prefix length, so the longest
+# prefix wins), dl_dst rules, broadcast rules, per-source ECMP rules and
+# label rules (above the dl_dst rules, which match any VLAN tag)
+CONTROLLER_PRIORITY = 0
+PREFIX_PRIORITY = 0x100
+DEFAULT_PRIORITY = 0x200
+BROADCAST_PRIORITY = 0x201
+ECMP_PRIORITY = 0x202
+LABEL_PRIORITY = 0x203
+BROADCAST_MAC = 'ff:ff:ff:ff:ff:ff'
+
+# Topology events are coalesced into bursts: routes are recomputed once no
+# event arrived for COALESCE_WINDOW seconds, or COALESCE_MAX_DELAY seconds
+# after the first one at the latest.  Both can be set from the environment
+# of ryu-manager.
+COALESCE_WINDOW = float(os.environ.get('SPS_COALESCE_WINDOW', 0.05))
+COALESCE_MAX_DELAY = float(os.environ.get('SPS_COALESCE_MAX_DELAY', 1.0))
+
+# Route engine: 'incremental' repairs per-destination trees on every
+# change, 'matrix' recomputes all next hops at once with NumPy (faster on
+# large topologies, needs numpy installed), 'weighted' routes around busy
+# links using port statistics.
+ROUTE_ENGINE = os.environ.get('SPS_ROUTE_ENGINE', 'incremental')
+ROUTE_ENGINES = {
+    'incremental': RouteEngine,
+    'matrix': MatrixRouteEngine,
+    'weighted': WeightedRouteEngine,
+}
+
+# The matrix engine shards its recomputes over ROUTE_WORKERS processes
+# (0: computes in the controller).  Packet-ins are still handled while
+# the workers run.
+ROUTE_WORKERS = int(os.environ.get('SPS_ROUTE_WORKERS', 0))
+
+# With the weighted engine, port statistics are polled every
+# STATS_INTERVAL seconds (0: never).  A link costs 1 plus
+# UTILIZATION_WEIGHT times its utilization out of LINK_CAPACITY Mbit/s,
+# and a switch only moves to a path ROUTE_HYSTERESIS cheaper than its
+# current one.
+STATS_INTERVAL = float(os.environ.get('SPS_STATS_INTERVAL', 10))
+LINK_CAPACITY = float(os.environ.get('SPS_LINK_CAPACITY', 1000))
+UTILIZATION_WEIGHT = float(os.environ.get('SPS_UTILIZATION_WEIGHT', 4))
+ROUTE_HYSTERESIS = float(os.environ.get('SPS_ROUTE_HYSTERESIS', 0.2))
+
+# Stats requests outstanding at once, over all switches; further requests
+# of a poll round wait for replies to make room
+STATS_CONCURRENCY = int(os.environ.get('SPS_STATS_CONCURRENCY', 512))
+
+# ECMP spreads traffic over every equal-cost shortest path.  OpenFlow 1.3
+# switches hash flows onto the paths with select groups; OpenFlow 1.0
+# switches get a rule per (destination, source host IP) that hashes onto
+# another path than the default one, up to hosts x hosts rules each.
+ECMP = os.environ.get('SPS_ECMP', '0') not in ('', '0')
+
+# Also accept OpenFlow 1.3 switches (needed for select and fast-failover
+# groups)
+OPENFLOW13 = os.environ.get('SPS_OPENFLOW13', '0') not in ('', '0')
+
+# Precompute a loop-free backup next hop for every route.  OpenFlow 1.3
+# switches get fast-failover groups and move to the backup on their own
+# when a port goes down; for OpenFlow 1.0 switches the controller swaps
+# the rules of a failed port to their backups before recomputing.
+FAST_FAILOVER = os.environ.get('SPS_FAST_FAILOVER', '0') not in ('', '0')
+
+# Forward the hosts with known IPv4 addresses by aggregated nw_dst prefix
+# rules, with the most common port as the default of the prefixes of the
+# known hosts, instead of one dl_dst rule each.  IP traffic to addresses
+# of no known host is dropped by the same rules (a /0 one for the rest of
+# the address space): a port default would have it bounce between
+# neighbours defaulting at each other.
+COMPRESS = os.environ.get('SPS_COMPRESS', '0') not in ('', '0')
+
+# Label switching: every switch gets a label (a VLAN id) and routes lead
+# to switches instead of hosts.  The switch a host is attached to pushes
+# the label of the destination's switch, the others forward on the label
+# alone and the destination's switch pops it, so that only switches with
+# hosts hold a rule per host.  Not combined with ECMP, FAST_FAILOVER,
+# COMPRESS or a TABLE_BUDGET/IDLE_TIMEOUT, which work on dl_dst rules.
+LABEL_SWITCHING = os.environ.get('SPS_LABEL_SWITCHING', '0') not in ('', '0')
+
+# Flow table capacity.  Switches get at most TABLE_BUDGET forwarding
+# rules; routes to further destinations are installed once their traffic
+# reaches the controller, evicting the least recently installed dl_dst
+# rules.  dl_dst rules idle for IDLE_TIMEOUT seconds are removed by the
+# switch and come back the same way.  0 disables either.
+TABLE_BUDGET = int(os.environ.get('SPS_TABLE_BUDGET', 0))
+IDLE_TIMEOUT = int(os.environ.get('SPS_IDLE_TIMEOUT', 0))
+REACTIVE = bool(TABLE_BUDGET or IDLE_TIMEOUT)
+
+# Hosts not heard from for HOST_MAX_AGE seconds are forgotten (0: never).
+# Packet-ins from a host count, and with IDLE_TIMEOUT so does its dl_dst
+# rule still being installed on its own switch, i.e. traffic to it.
+HOST_MAX_AGE = float(os.environ.get('SPS_HOST_MAX_AGE', 0))
+
+# Warm restart: the topology, hosts and installed rules are saved to
+# SNAPSHOT_FILE every SNAPSHOT_INTERVAL seconds and on shutdown.  A
+# controller started with a snapshot routes over the saved links and
+# hosts as soon as their switches connect, and a switch keeps the saved
+# rules no route wants only until it got its own routes (or those rules
+# overlap them).  SNAPSHOT_GRACE seconds later the controller drops the
+# links LLDP did not confirm.
+SNAPSHOT_FILE = os.environ.get('SPS_SNAPSHOT_FILE')
+SNAPSHOT_INTERVAL = float(os.environ.get('SPS_SNAPSHOT_INTERVAL', 30))
+SNAPSHOT_GRACE = float(os.environ.get('SPS_SNAPSHOT_GRACE', 15))
+
+# An ARP request the controller floods for an unknown IP may come back to
+# it through edge ports that are really undiscovered switch links; the
+# same (requester, target) pair is not flooded again for this long.
+BROADCAST_HOLDDOWN = float(os.environ.get('SPS_BROADCAST_HOLDDOWN', 1.0))
+
+# When set, every topology and packet-in event is recorded to this file
+# for offline replay with event_trace.py.
+TRACE_FILE = os.environ.get('SPS_TRACE_FILE')
+
+# Debug dumps (every rule installed, paths, the adjacency table) are only
+# printed with SPS_TRACE=1; production runs skip building them entirely.
+TRACE = os.environ.get('SPS_TRACE', '0') not in ('', '0')
+
+# Metrics are served in the Prometheus text format on this address;
+# port 0 disables the endpoint.
+METRICS_HOST = os.environ.get('SPS_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('SPS_METRICS_PORT', 9105))
+
+# SIGUSR1 (or GET /profile?seconds=N on the metrics endpoint) profiles
+# the controller for PROFILE_SECONDS and writes the capture to PROFILE_DIR.
+PROFILE_DIR = os.environ.get('SPS_PROFILE_DIR', tempfile.gettempdir())
+PROFILE_SECONDS = float(os.environ.get('SPS_PROFILE_SECONDS', 30))
+
+# Topology mutations queued in the coalescer
+SWITCH_ADDED = 'switch_added'
+SWITCH_REMOVED = 'switch_removed'
+LINK_ADDED = 'link_added'
+LINK_DELETED = 'link_deleted'
+HOST_CHANGED = 'host_changed'
+PORT_CHANGED = 'port_changed'
+
+
+class EventTopologyFlush(EventBase):
+    """Internal event: a burst of topology events is ready to be applied"""
+
+
+class EventAgeHosts(EventBase):
+    """Internal event: time to forget the hosts not heard from"""
+
+
+class EventWarmStartDone(EventBase):
+    """Internal event: discovery had time to confirm the snapshot"""
+
+
+class EventLinkCosts(EventBase):
+    """Internal event: link costs changed with the port statistics"""
+
+    def __init__(self, costs):
+        super(EventLinkCosts, self).__init__()
+        self.costs = costs
+
+
+def timed(handler):
+    """Observe the run time of an event handler in handler_seconds"""
+    @functools.wraps(handler)
+    def wrapper(self, ev):
+        start = time.perf_counter()
+        try:
+            return handler(self, ev)
+        finally:
+            self.handler_seconds.observe(time.perf_counter() - start,
+                                         handler.__name__)
+    return wrapper
 
 
 class ShortestPathSwitching(app_manager.RyuApp):
-    OFP_VERSIONS = [ofproto_v1_0.OFP_VERSION]
+    OFP_VERSIONS = [ofproto_v1_0.OFP_VERSION] + (
+        [ofproto_v1_3.OFP_VERSION] if OPENFLOW13 else [])
 
     def __init__(self, *args, **kwargs):
         super(ShortestPathSwitching, self).__init__(*args, **kwargs)
 
         self.tm = TopoManager()
+        if ROUTE_ENGINE == 'weighted':
+            self.routes = WeightedRouteEngine(self.tm, backups=FAST_FAILOVER,
+                                              hysteresis=ROUTE_HYSTERESIS)
+        elif ROUTE_ENGINE == 'matrix':
+            self.routes = MatrixRouteEngine(self.tm, ecmp=ECMP,
+                                            backups=FAST_FAILOVER,
+                                            workers=ROUTE_WORKERS)
+        else:
+            self.routes = ROUTE_ENGINES[ROUTE_ENGINE](
+                self.tm, ecmp=ECMP, backups=FAST_FAILOVER)
+        self.flow_tables = {}  # dpid -> FlowTable
+        self.label_switching = LABEL_SWITCHING and not (
+            ECMP or FAST_FAILOVER or COMPRESS or REACTIVE)
+        if LABEL_SWITCHING and not self.label_switching:
+            self.logger.warning("Label switching does not combine with "
+                                "ECMP, fast failover, compression or "
+                                "reactive rules; forwarding by dl_dst")
+        self.labels = {}  # dpid -> label
+        self.label_dpids = {}  # label -> dpid
+        self.free_labels = list(range(VLANID_MIN, VLANID_MAX + 1))
+        self.edge_dpids = set()  # switches with hosts, which know hosts
+        self.ofctls = {}  # dpid -> OfCtl of the switch's connection
+        self.barrier_waiters = {}  # dpid -> {xid: FlowModBatch}
+        self.stats = StatsCollector(STATS_CONCURRENCY)
+        self.failed_over = {}  # (dpid, dl_dst) -> failed port
+        self.port_stats = PortStats()
+        self.arp_cache = ArpReplyCache()
+        self.classifier = PacketClassifier()
+        self.spanning_tree = SpanningTree(self.tm.graph)
+        self.flood_tables = {}  # dpid -> FloodTable
+        self.recent_floods = {}  # (requester mac, target ip) -> time
+        self.tm.add_arp_listener(self.arp_cache.invalidate)
+        self.coalescer = EventCoalescer(
+            self.recompute_routes,
+            lambda: self.send_event(self.name, EventTopologyFlush()),
+            window=COALESCE_WINDOW, max_delay=COALESCE_MAX_DELAY)
+        # Green thread of a recompute waiting for the route workers, and
+        # whether another burst became ready meanwhile
+        self.recompute_thread = None
+        self.flush_deferred = False
+        self.trace = TraceRecorder(TRACE_FILE) if TRACE_FILE else None
+        self.snapshot = None
+        # Links only the snapshot knows of, keyed by their sorted ends
+        # (dpid, port_no), until LLDP reports them
+        self.provisional_links = {}
+        if SNAPSHOT_FILE and os.path.exists(SNAPSHOT_FILE):
+            try:
+                self.snapshot = Snapshot.load(SNAPSHOT_FILE)
+            except (OSError, ValueError) as e:
+                self.logger.warning("Not warm-starting: %s", e)
+            else:
+                self.logger.info("Warm-starting from %s: %d switches, %d "
+                                 "links, %d hosts", SNAPSHOT_FILE,
+                                 len(self.snapshot.switches),
+                                 len(self.snapshot.links),
+                                 len(self.snapshot.hosts))
+
+        self.metrics = MetricsRegistry('sps_')
+        self.handler_seconds = self.metrics.histogram(
+            'handler_seconds', "Event handler run time", ('handler',))
+        self.recompute_seconds = self.metrics.histogram(
+            'route_recompute_seconds',
+            "Time to apply a burst of topology events")
+        self.barrier_seconds = self.metrics.histogram(
+            'flowmod_batch_seconds',
+            "Time from sending a FlowMod batch to its barrier reply")
+        self.flow_mods = self.metrics.counter(
+            'flow_mods_total', "FlowMods sent", ('dpid',))
+        self.packet_outs = self.metrics.counter(
+            'packet_outs_total', "Packet-outs sent", ('dpid',))
+        self.evictions = self.metrics.counter(
+            'flow_evictions_total',
+            "dl_dst rules taken out of a flow table", ('dpid', 'reason'))
+        self.reinstalls = self.metrics.counter(
+            'flow_reinstalls_total',
+            "Evicted dl_dst rules reinstalled on a packet-in", ('dpid',))
+        self.failovers = self.metrics.counter(
+            'failover_routes_total',
+            "Routes the controller moved to a backup next hop", ('dpid',))
+        self.metrics.gauge('coalescer_pending',
+                           "Topology mutations waiting for a recompute",
+                           lambda: len(self.coalescer.pending))
+        self.metrics.gauge('barrier_waiters',
+                           "FlowMod batches waiting for a barrier reply",
+                           lambda: sum(len(w) for w in
+                                       self.barrier_waiters.values()))
+        self.metrics.gauge('stats_requests_in_flight',
+                           "Stats requests waiting for their reply",
+                           lambda: len(self.stats.in_flight))
+        self.metrics.callback_counter('stats_timeouts_total',
+                                      "Stats requests that timed out",
+                                      lambda: self.stats.timeouts)
+        self.metrics.gauge('event_queue_depth',
+                           "Events queued for the app",
+                           lambda: self.events.qsize())
+        self.metrics.callback_counter(
+            'arp_cache_lookups_total', "ARP reply cache lookups",
+            lambda: {('hit',): self.arp_cache.hits,
+                     ('miss',): self.arp_cache.misses}, ('result',))
+        self.metrics.gauge('switches', "Known switches",
+                           lambda: len(self.tm.switches))
+        self.metrics.gauge('hosts', "Known hosts",
+                           lambda: len(self.tm.hosts))
+        self.metrics.callback_counter(
+            'packet_ins_total', "Packet-ins received",
+            lambda: self.classifier.stats(), ('ethertype',))
+        self.metrics.gauge('flow_rules', "Forwarding rules wanted",
+                           lambda: {dpid: len(t.desired) for dpid, t in
+                                    self.flow_tables.items()}, ('dpid',))
+        self.metrics.gauge('flow_compression_ratio',
+                           "Routes per forwarding rule",
+                           lambda: {dpid: t.compression() for dpid, t in
+                                    self.flow_tables.items()}, ('dpid',))
+        self.profiler = Profiler(PROFILE_DIR, PROFILE_SECONDS, self.logger)
+        self.metrics_server = None
+        if METRICS_PORT:
+            self.metrics_server = MetricsServer(self.metrics, METRICS_HOST,
+                                                METRICS_PORT)
+            self.metrics_server.add_command('/profile', self.start_profile)
+
+    def start_profile(self, args):
+        """Admin command: start a profiler capture"""
+        seconds = args.get('seconds') or PROFILE_SECONDS
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            seconds = None
+        if seconds is None or not 0 < seconds < float('inf'):
+            raise ValueError("seconds must be a positive number")
+        if not self.profiler.trigger(seconds):
+            return "a capture is already running\n"
+        return "profiling for %g seconds into %s\n" % (seconds, PROFILE_DIR)
+
+    def start(self):
+        super(ShortestPathSwitching, self).start()
+        self.profiler.install_signal()
+        if self.metrics_server is not None:
+            self.threads.append(hub.spawn(self.metrics_server.serve_forever))
+        if hasattr(self.routes, 'reweight') and STATS_INTERVAL > 0:
+            self.threads.append(hub.spawn(self.poll_port_stats))
+        if HOST_MAX_AGE > 0:
+            self.threads.append(hub.spawn(self.age_hosts))
+        if self.snapshot is not None:
+            self.threads.append(hub.spawn_after(
+                SNAPSHOT_GRACE, self.send_event, self.name,
+                EventWarmStartDone()))
+        if SNAPSHOT_FILE:
+            self.threads.append(hub.spawn(self.save_snapshots))
+
+    def record(self, ev):
+        """Append an event to the trace, if one is being recorded"""
+        if self.trace is not None:
+            self.trace.record(ev)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+        if hasattr(self.routes, 'close'):
+            self.routes.close()
+        if SNAPSHOT_FILE:
+            self.save_snapshot()
+
+    def save_snapshots(self):
+        """Green thread: save a snapshot every SNAPSHOT_INTERVAL seconds"""
+        while True:
+            hub.sleep(SNAPSHOT_INTERVAL)
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        if self.snapshot is not None:
+            # Still warm-starting: the state is not complete yet
+            return
+        start = time.perf_counter()
+        snapshot = Snapshot.capture(self.tm, self.flow_tables)
+        try:
+            snapshot.write(SNAPSHOT_FILE)
+        except OSError as e:
+            self.logger.warning("Could not save the snapshot: %s", e)
+            return
+        self.logger.debug("Saved a snapshot of %d switches and %d hosts in "
+                          "%.1f ms", len(snapshot.switches),
+                          len(snapshot.hosts),
+                          (time.perf_counter() - start) * 1000)
+
+    def preload_flows(self, datapath):
+        """Take the rules the snapshot has for a switch that connected as
+        installed, and check them against its flow table"""
+        rules = self.snapshot.rules.pop(datapath.id, None)
+        if rules:
+            table = self.flow_tables[datapath.id]
+            table.preload(rules)
+            ofctl = self.get_ofctl(datapath)
+            self.stats.request(datapath, ofctl.flow_stats_request(),
+                               functools.partial(self.reconcile_flows,
+                                                 table))
+
+    def warm_start(self, tm_switch):
+        """
+        Restore what the snapshot knows of a switch that connected: its
+        links to the switches already connected and its hosts
+        """
+        dpid = tm_switch.get_dpid()
+        ports = {p.port_no: p for p in tm_switch.get_ports()}
+        graph = self.tm.graph
+        for a, port_a, b, port_b in self.snapshot.links_of(dpid):
+            if a != dpid:
+                a, port_a, b, port_b = b, port_b, a, port_a
+            peer = self.tm.find_tmswitch_by_dpid(b)
+            if peer is None or port_a not in ports:
+                continue
+            if graph.port_to(tm_switch.nid, peer.nid) == port_a:
+                # LLDP was faster
+                continue
+            for dst in peer.get_ports():
+                if dst.port_no == port_b:
+                    break
+            else:
+                continue
+            src = ports[port_a]
+            self.tm.add_link(src, dst)
+            self.provisional_links[self.link_key(src, dst)] = (src, dst)
+            self.coalescer.add((LINK_ADDED, a, b))
+        for mac, _, port_no, ips in self.snapshot.hosts_of(dpid):
+            if mac in self.tm.hosts or port_no not in ports:
+                continue
+            host = switches.Host(mac, ports[port_no])
+            host.ipv4.extend(ips)
+            self.add_host(host)
+
+    @staticmethod
+    def link_key(src, dst):
+        return tuple(sorted([(src.dpid, src.port_no),
+                             (dst.dpid, dst.port_no)]))
 
-    def add_forwarding_rule(self, datapath, dl_dst, port):
-        ofctl = OfCtl.factory(datapath, self.logger)
+    def reconcile_flows(self, table, req):
+        """
+        Stats callback: correct the rules preloaded from the snapshot
+        with the ones the switch really has (none if it did not answer)
+        """
+        if self.flow_tables.get(table.dpid) is not table:
+            return
+        ofctl = self.get_ofctl(req.dp)
+        present = set()
+        for msg in req.replies if not req.timed_out else ():
+            for stat in msg.body:
+                key = self.rule_key(ofctl, stat.priority, stat.match)
+                if key is not None:
+                    present.add(key)
+        missing = table.reconcile(present)
+        self.logger.info("switch%s: %d rules kept over the restart, %d "
+                         "missing", table.dpid, len(table.installed),
+                         missing)
+        self.sync_flows([table.dpid])
+
+    def rule_key(self, ofctl, priority, match):
+        """Return the FlowTable key of a forwarding rule from its
+        priority and match, or None for other rules"""
+        if priority == DEFAULT_PRIORITY:
+            return ofctl.get_match_dl_dst(match)
+        if priority == LABEL_PRIORITY:
+            return LabelRule(ofctl.get_match_vlan(match),
+                             ofctl.get_match_dl_dst(match))
+        nw_src, nw_dst = ofctl.get_match_ipv4(match)
+        if priority == ECMP_PRIORITY:
+            return SourceRule(ofctl.get_match_dl_dst(match), nw_src)
+        if PREFIX_PRIORITY <= priority <= PREFIX_PRIORITY + 32:
+            return PrefixRule(nw_dst or '0.0.0.0', priority - PREFIX_PRIORITY)
+        return None
+
+    @set_ev_cls(EventWarmStartDone)
+    @timed
+    def handle_warm_start_done(self, ev):
+        """
+        Drop what only the snapshot claimed: the links LLDP did not
+        report, and the installed rules no route wants
+        """
+        for src, dst in self.provisional_links.values():
+            tm_src = self.tm.find_switch_by_port(src)
+            tm_dst = self.tm.find_switch_by_port(dst)
+            if (tm_src is not None and tm_dst is not None and
+                    self.tm.graph.remove_link(tm_src.nid, tm_dst.nid,
+                                              src.port_no)):
+                self.coalescer.add((LINK_DELETED, src.dpid, dst.dpid))
+        self.logger.info("Warm start done: %d links were not confirmed",
+                         len(self.provisional_links))
+        self.provisional_links.clear()
+        self.snapshot = None
+        for table in self.flow_tables.values():
+            table.release_preloaded()
+            table.resync()
+        self.sync_flows(list(self.flow_tables))
+
+    def get_ofctl(self, datapath):
+        """Return the OfCtl of a datapath, made once per connection"""
+        ofctl = self.ofctls.get(datapath.id)
+        if ofctl is None or ofctl.dp is not datapath:
+            ofctl = OfCtl.factory(datapath, self.logger)
+            self.ofctls[datapath.id] = ofctl
+        return ofctl
+
+    def add_forwarding_rule(self, datapath, dl_dst, port, command=None,
+                            ofctl=None, nw_src=0):
+        """
+        Forward IP traffic to dl_dst (only from nw_src if given) out of
+        port, or over a group when port is a tuple (of equal-cost ports,
+        or a Failover), or tagged with a label for a PushLabel.  With
+        IDLE_TIMEOUT the dl_dst rule expires when idle, and the switch
+        reports it.
+        """
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        idle_timeout = flags = 0
+        if IDLE_TIMEOUT and not nw_src:
+            idle_timeout = IDLE_TIMEOUT
+            flags = datapath.ofproto.OFPFF_SEND_FLOW_REM
+        if isinstance(port, PushLabel):
+            actions = ofctl.push_vlan_actions(port.vlan)
+            actions.append(datapath.ofproto_parser.OFPActionOutput(port.port))
+            ofctl.set_flow(cookie=DEFAULT_COOKIE, priority=DEFAULT_PRIORITY,
+                           dl_type=ether_types.ETH_TYPE_IP,
+                           dl_vlan=VLANID_NONE, dl_dst=dl_dst,
+                           actions=actions, command=command)
+        elif isinstance(port, tuple) or nw_src:
+            actions = self.output_actions(datapath, dl_dst, port, ofctl)
+            ofctl.set_flow(cookie=DEFAULT_COOKIE,
+                           priority=ECMP_PRIORITY if nw_src
+                           else DEFAULT_PRIORITY,
+                           dl_type=ether_types.ETH_TYPE_IP,
+                           dl_vlan=VLANID_NONE,
+                           dl_dst=dl_dst, nw_src=nw_src,
+                           idle_timeout=idle_timeout, flags=flags,
+                           actions=actions, command=command)
+        else:
+            ofctl.set_forwarding_flow(DEFAULT_COOKIE, DEFAULT_PRIORITY,
+                                      dl_dst, port,
+                                      idle_timeout=idle_timeout,
+                                      flags=flags, command=command)
+        if not isinstance(port, tuple):
+            self.release_group(datapath, dl_dst, ofctl)
+        if TRACE:
+            print('forwarding_rule:\nswitch:%s\ndl_dst: %s\nnw_src: %s\n'
+                  'port: %s' % (datapath.id, dl_dst, nw_src or '*', port))
 
-        actions = [datapath.ofproto_parser.OFPActionOutput(port)]
-        ofctl.set_flow(cookie=DEFAULT_COOKIE, priority=DEFAULT_PRIORITY,
+    def remove_forwarding_rule(self, datapath, dl_dst, ofctl=None,
+                               nw_src=0):
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        match = ofctl.build_match(dl_type=ether_types.ETH_TYPE_IP,
+                                  dl_vlan=VLANID_NONE,
+                                  dl_dst=dl_dst, nw_src=nw_src)
+        ofctl.delete_flow(cookie=DEFAULT_COOKIE,
+                          priority=ECMP_PRIORITY if nw_src else
+                          DEFAULT_PRIORITY,
+                          match=match, strict=True)
+        if not nw_src:
+            self.release_group(datapath, dl_dst, ofctl)
+        if TRACE:
+            print('remove forwarding_rule:\nswitch:%s\ndl_dst: %s\n'
+                  'nw_src: %s' % (datapath.id, dl_dst, nw_src or '*'))
+
+    def add_prefix_rule(self, datapath, prefix, port, command=None,
+                        ofctl=None):
+        """Forward IP traffic to a PrefixRule's prefix out of port (or
+        over a group for a tuple of ports, or drop it for DROP)"""
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        actions = self.output_actions(datapath, prefix, port, ofctl)
+        ofctl.set_flow(cookie=DEFAULT_COOKIE,
+                       priority=PREFIX_PRIORITY + prefix.length,
                        dl_type=ether_types.ETH_TYPE_IP,
                        dl_vlan=VLANID_NONE,
-                       dl_dst=dl_dst,
-                       actions=actions)
-        print('forwarding_rule:\nswitch:%s\ndl_dst: %s\nport: %s' %
-              (datapath.id, dl_dst, port))
+                       nw_dst=prefix.nw_dst if prefix.length else 0,
+                       dst_mask=prefix.length,
+                       actions=actions, command=command)
+        if port == DROP or not isinstance(port, tuple):
+            self.release_group(datapath, prefix, ofctl)
+        if TRACE:
+            print('prefix_rule:\nswitch:%s\nnw_dst: %s/%d\nport: %s' %
+                  (datapath.id, prefix.nw_dst, prefix.length, port))
+
+    def remove_prefix_rule(self, datapath, prefix, ofctl=None):
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        match = ofctl.build_match(dl_type=ether_types.ETH_TYPE_IP,
+                                  dl_vlan=VLANID_NONE,
+                                  nw_dst=prefix.nw_dst if prefix.length
+                                  else 0,
+                                  dst_mask=prefix.length)
+        # Strict: a shorter prefix must not take the longer ones with it
+        ofctl.delete_flow(cookie=DEFAULT_COOKIE,
+                          priority=PREFIX_PRIORITY + prefix.length,
+                          match=match, strict=True)
+        self.release_group(datapath, prefix, ofctl)
+        if TRACE:
+            print('remove prefix_rule:\nswitch:%s\nnw_dst: %s/%d' %
+                  (datapath.id, prefix.nw_dst, prefix.length))
+
+    def add_label_rule(self, datapath, key, port, command=None,
+                       ofctl=None):
+        """Forward IP traffic tagged with a LabelRule's label out of
+        port; the rule of a host (key.dl_dst) pops the label first"""
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        actions = ofctl.pop_vlan_actions() if key.dl_dst else []
+        actions.append(datapath.ofproto_parser.OFPActionOutput(port))
+        ofctl.set_flow(cookie=DEFAULT_COOKIE, priority=LABEL_PRIORITY,
+                       dl_type=ether_types.ETH_TYPE_IP,
+                       dl_vlan=key.vlan, dl_dst=key.dl_dst or 0,
+                       actions=actions, command=command)
+        if TRACE:
+            print('label_rule:\nswitch:%s\nvlan: %d\ndl_dst: %s\nport: %s' %
+                  (datapath.id, key.vlan, key.dl_dst or '*', port))
+
+    def remove_label_rule(self, datapath, key, ofctl=None):
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        match = ofctl.build_match(dl_type=ether_types.ETH_TYPE_IP,
+                                  dl_vlan=key.vlan, dl_dst=key.dl_dst or 0)
+        # Strict: the label rule must not take the host rules with it
+        ofctl.delete_flow(cookie=DEFAULT_COOKIE, priority=LABEL_PRIORITY,
+                          match=match, strict=True)
+        if TRACE:
+            print('remove label_rule:\nswitch:%s\nvlan: %d\ndl_dst: %s' %
+                  (datapath.id, key.vlan, key.dl_dst or '*'))
+
+    def output_actions(self, datapath, key, port, ofctl):
+        """Return the actions sending the traffic of a rule out of port,
+        or over the group of the rule (created or updated here): a
+        fast-failover group for a Failover, a select group for a tuple
+        of equal-cost ports, none for DROP"""
+        if port == DROP:
+            return []
+        if not isinstance(port, tuple):
+            return [datapath.ofproto_parser.OFPActionOutput(port)]
+        table = self.flow_tables[datapath.id]
+        group_id, new = table.group_id(key)
+        command = None if new else datapath.ofproto.OFPGC_MODIFY
+        if isinstance(port, Failover):
+            ofctl.set_failover_group(group_id, port, command=command)
+        else:
+            ofctl.set_select_group(group_id, port, command=command)
+        return [datapath.ofproto_parser.OFPActionGroup(group_id)]
+
+    def release_group(self, datapath, key, ofctl):
+        """Delete the group of a rule that no longer uses it"""
+        table = self.flow_tables.get(datapath.id)
+        if table is not None and table.group_ids:
+            group_id = table.group_ids.pop(key, None)
+            if group_id is not None:
+                ofctl.delete_group(group_id)
+
+    def split_sources(self, dpid, dl_dst, ports):
+        """
+        Spread the known source hosts of dl_dst over its equal-cost ports
+        by a hash of (source IP, dl_dst, switch).  Returns the sources
+        that do not hash onto ports[0], the port of the destination rule,
+        as {nw_src: out port}.
+        """
+        sources = {}
+        for ip, mac in self.tm.ARPTable.items():
+            if mac == dl_dst:
+                continue
+            key = ('%s %s %x' % (ip, dl_dst, dpid)).encode()
+            port = ports[zlib.crc32(key) % len(ports)]
+            if port != ports[0]:
+                sources[ip] = port
+        return sources
+
+    def split_all_sources(self):
+        """
+        Spread the ECMP routes of the switches without select groups
+        again, after the set of known host IPs changed.  Returns the
+        DPIDs of those switches.
+        """
+        dpids = set()
+        for dpid, table in self.flow_tables.items():
+            if table.select_groups or not table.multipath:
+                continue
+            for dl_dst, ports in table.multipath.items():
+                if dl_dst in table.evicted:
+                    continue
+                table.set_sources(dl_dst,
+                                  self.split_sources(dpid, dl_dst, ports))
+            dpids.add(dpid)
+        return dpids
+
+    def add_broadcast_rule(self, datapath, in_port, ports, command=None,
+                           ofctl=None):
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        actions = [datapath.ofproto_parser.OFPActionOutput(port)
+                   for port in ports]
+        ofctl.set_flow(cookie=DEFAULT_COOKIE, priority=BROADCAST_PRIORITY,
+                       dl_dst=BROADCAST_MAC, in_port=in_port,
+                       actions=actions, command=command)
+        if TRACE:
+            print('broadcast_rule:\nswitch:%s\nin_port: %s\nports: %s' %
+                  (datapath.id, in_port, list(ports)))
+
+    def remove_broadcast_rule(self, datapath, in_port, ofctl=None):
+        ofctl = ofctl or self.get_ofctl(datapath)
+
+        match = ofctl.build_match(dl_dst=BROADCAST_MAC, in_port=in_port)
+        ofctl.delete_flow(cookie=DEFAULT_COOKIE,
+                          priority=BROADCAST_PRIORITY, match=match)
+        if TRACE:
+            print('remove broadcast_rule:\nswitch:%s\nin_port: %s' %
+                  (datapath.id, in_port))
+
+    @set_ev_cls(EventTopologyFlush)
+    @timed
+    def handle_topology_flush(self, ev):
+        if self.recompute_thread is not None:
+            self.flush_deferred = True
+        elif getattr(self.routes, 'workers', 0) > 1:
+            # Wait for the route workers in a green thread of its own, so
+            # the event loop goes on handling packet-ins meanwhile
+            self.recompute_thread = hub.spawn(self.flush_in_background)
+        else:
+            self.coalescer.flush()
+
+    def flush_in_background(self):
+        try:
+            self.coalescer.flush()
+        finally:
+            self.recompute_thread = None
+            if self.flush_deferred:
+                self.flush_deferred = False
+                self.send_event(self.name, EventTopologyFlush())
+
+    def recompute_routes(self, mutations):
+        """
+        Apply one burst of coalesced topology mutations to the route
+        engine and install the resulting next hops.  Removals are applied
+        before additions; a burst larger than the switch count is cheaper
+        to handle with a full rebuild than by replaying it, and so is
+        any burst for an engine that is not incremental.
+        """
+        start = time.perf_counter()
+        removals = [m for m in mutations
+                    if m[0] in (SWITCH_REMOVED, LINK_DELETED)]
+        additions = [m for m in mutations
+                     if m[0] in (SWITCH_ADDED, LINK_ADDED)]
+        hosts = []
+        for m in mutations:
+            if m[0] == HOST_CHANGED and m[1] not in hosts:
+                hosts.append(m[1])
+
+        changes = {}
+        topology = removals + additions
+        if topology and (not self.routes.incremental or
+                         len(topology) > len(self.tm.switches)):
+            changes.update(self.routes.rebuild())
+        else:
+            for m in topology:
+                if m[0] == SWITCH_REMOVED:
+                    changes.update(self.routes.switch_removed(m[1]))
+                elif m[0] == LINK_DELETED:
+                    changes.update(self.routes.link_deleted(m[1], m[2]))
+                elif m[0] == SWITCH_ADDED:
+                    changes.update(self.routes.switch_added(m[1]))
+                elif m[0] == LINK_ADDED:
+                    changes.update(self.routes.link_added(m[1], m[2]))
+        if self.label_switching:
+            relabelled = self.label_destinations(mutations, changes)
+        else:
+            dests = []
+            for mac in hosts:
+                tm_host = self.tm.find_host_by_mac(mac)
+                if tm_host is None:
+                    changes.update(self.routes.remove_destination(mac))
+                    continue
+                port = tm_host.get_port()
+                dests.append((mac, port.dpid, port.port_no))
+            changes.update(self.routes.add_destinations(dests))
+        # A (re)connected switch starts with an empty flow table, so it
+        # needs all of its routes even where the engine saw no change
+        for m in additions:
+            if m[0] == SWITCH_ADDED:
+                for dst, port in self.routes.routes(m[1]).items():
+                    changes[(m[1], dst)] = port
+                table = self.flow_tables.get(m[1])
+                if FAST_FAILOVER and table is not None:
+                    for dst, port in self.routes.backup_routes(m[1]).items():
+                        table.set_backup(dst, port)
+                if table is not None:
+                    # Its full set of routes goes out now, and with it
+                    # the deletes of the rules it kept over a restart
+                    # that no route wants
+                    table.release_preloaded()
+
+        if self.failed_over:
+            self.restore_routes(changes)
+        self.logger.info("Recomputed routes for %d coalesced topology "
+                         "events (%d next hops changed, %d events merged "
+                         "in %d bursts so far)",
+                         len(mutations), len(changes),
+                         self.coalescer.merged, self.coalescer.bursts)
+        flood_dpids = self.update_broadcast(mutations, topology)
+        if hosts and ECMP:
+            flood_dpids |= self.split_all_sources()
+        if self.label_switching:
+            added = {m[1] for m in additions if m[0] == SWITCH_ADDED}
+            flood_dpids |= self.place_hosts(hosts, added, relabelled)
+        self.install_routes(changes, flood_dpids, bool(hosts), backups=True)
+        self.recompute_seconds.observe(time.perf_counter() - start)
+
+        if TRACE:
+            for mac in hosts:
+                tm_host = self.tm.find_host_by_mac(mac)
+                for other in self.tm.hosts.values():
+                    if tm_host is not None and other is not tm_host:
+                        self.show_path(other, tm_host)
+            if hosts:
+                self.show_adjacent_table()
+
+    def update_broadcast(self, mutations, topology):
+        """
+        Apply a burst of topology mutations to the spanning tree and
+        recompute the broadcast rules of the switches it touched.
+        Returns the DPIDs whose flood tables changed.
+        """
+        nodes = self.tm.graph.nodes
+        tree = self.spanning_tree
+        changed = set()
+        if len(topology) > len(self.tm.switches):
+            changed |= tree.rebuild()
+        else:
+            for m in topology:
+                if m[0] == SWITCH_REMOVED:
+                    changed |= tree.switch_removed(nodes[m[1]])
+                elif m[0] == LINK_DELETED:
+                    changed |= tree.link_deleted(nodes[m[1]], nodes[m[2]])
+                elif m[0] == SWITCH_ADDED:
+                    changed |= tree.switch_added(nodes[m[1]])
+                elif m[0] == LINK_ADDED:
+                    changed |= tree.link_added(nodes[m[1]], nodes[m[2]])
+        dpids = {self.tm.graph.dpids[n] for n in changed}
+        # Link and port changes also move ports in or out of the edge set
+        for m in mutations:
+            if m[0] in (SWITCH_ADDED, LINK_ADDED, LINK_DELETED, PORT_CHANGED):
+                dpids.update(m[1:])
+
+        for dpid in dpids:
+            table = self.flood_tables.get(dpid)
+            tm_switch = self.tm.find_tmswitch_by_dpid(dpid)
+            if table is None or tm_switch is None:
+                continue
+            table.set_ports(self.spanning_tree.tree_ports(tm_switch.nid),
+                            self.tm.get_edge_ports(tm_switch),
+                            tm_switch.get_dp().ofproto.OFPP_CONTROLLER)
+        return dpids
+
+    def label_destinations(self, mutations, changes):
+        """
+        Label switching: label the switches that came up and release the
+        labels of those that went away, adding or removing them as
+        destinations of the route engine (the next hops go into changes).
+        Returns the DPIDs whose label changed.
+        """
+        dpids = sorted({m[1] for m in mutations
+                        if m[0] in (SWITCH_ADDED, SWITCH_REMOVED)})
+        relabelled = set()
+        dests = []
+        for dpid in dpids:
+            vlan = self.labels.get(dpid)
+            if dpid in self.tm.switches:
+                if vlan is not None:
+                    continue
+                vlan = self.allocate_label(dpid)
+                if vlan is None:
+                    continue
+                dests.append((LabelRule(vlan, None), dpid, 0))
+            elif vlan is not None:
+                changes.update(
+                    self.routes.remove_destination(LabelRule(vlan, None)))
+                del self.labels[dpid]
+                del self.label_dpids[vlan]
+                heapq.heappush(self.free_labels, vlan)
+            else:
+                continue
+            relabelled.add(dpid)
+        changes.update(self.routes.add_destinations(dests))
+        return relabelled
+
+    def allocate_label(self, dpid):
+        """
+        Give a switch the lowest free label, or the one its rules kept
+        over a warm restart pop; returns None when all are taken
+        """
+        table = self.flow_tables.get(dpid)
+        kept = sorted(key.vlan for key in (table.installed if table else ())
+                      if isinstance(key, LabelRule) and key.dl_dst)
+        for vlan in kept:
+            if (VLANID_MIN <= vlan <= VLANID_MAX and
+                    vlan not in self.label_dpids):
+                break
+        else:
+            vlan = None
+            while self.free_labels and vlan is None:
+                vlan = heapq.heappop(self.free_labels)
+                if vlan in self.label_dpids:
+                    # Taken by a warm-started switch
+                    vlan = None
+        if vlan is None:
+            self.logger.error("switch%s: out of labels, its hosts are "
+                              "unreachable", dpid)
+            return None
+        self.labels[dpid] = vlan
+        self.label_dpids[vlan] = dpid
+        return vlan
+
+    def place_hosts(self, macs, added=(), relabelled=()):
+        """
+        Label switching: tell the switches with hosts where the given
+        hosts, and those of the relabelled switches, are now.  Switches
+        that just got their first host, or came up, learn every host;
+        those that lost their last one forget them all.  Returns the
+        DPIDs whose tables changed.
+        """
+        hosts = self.tm.hosts
+        macs = set(macs)
+        if relabelled:
+            macs.update(mac for mac, tm_host in hosts.items()
+                        if tm_host.get_port().dpid in relabelled)
+        edges = {tm_host.get_port().dpid for tm_host in hosts.values()}
+        edges.intersection_update(self.flow_tables)
+        touched = set()
+        for dpid in self.edge_dpids - edges:
+            table = self.flow_tables.get(dpid)
+            if table is not None:
+                for mac in list(table.hosts):
+                    table.set_labelled_host(mac, None)
+                touched.add(dpid)
+        for dpid in edges:
+            table = self.flow_tables[dpid]
+            if dpid in self.edge_dpids and dpid not in added:
+                todo = macs
+            else:
+                todo = list(hosts)
+            for mac in todo:
+                tm_host = hosts.get(mac)
+                if tm_host is None:
+                    table.set_labelled_host(mac, None)
+                    continue
+                port = tm_host.get_port()
+                table.set_labelled_host(
+                    mac, self.labels.get(port.dpid),
+                    port.port_no if port.dpid == dpid else None)
+            if todo:
+                touched.add(dpid)
+        self.edge_dpids = edges
+        return touched
+
+    def install_routes(self, changes, dpids=(), hosts_changed=False,
+                       backups=False):
+        """
+        Record the next hops returned by the route engine in the desired
+        flow tables and push the difference to the switches, along with
+        the broadcast rules of the given extra switches.  With
+        FAST_FAILOVER and `backups` the backup next hops are recomputed
+        as well.  With COMPRESS the prefix rules of the switches whose
+        routes changed (of all switches if hosts changed) are compiled
+        again.  Tables over their TABLE_BUDGET evict their least
+        recently installed dl_dst rules.
+        """
+        for (dpid, dl_dst), port in changes.items():
+            table = self.flow_tables.get(dpid)
+            if table is not None:
+                self.set_table_route(table, dl_dst, port)
+        touched = {dpid for dpid, _ in changes}
+        if FAST_FAILOVER and backups:
+            touched |= self.update_backups()
+        if COMPRESS:
+            if hosts_changed:
+                touched.update(self.flow_tables)
+            addresses = collections.defaultdict(list)
+            for ip, mac in self.tm.ARPTable.items():
+                addresses[mac].append(ip)
+            for dpid in touched:
+                table = self.flow_tables.get(dpid)
+                if table is not None:
+                    table.compress(addresses)
+                    self.logger.debug("switch%s: %d routes in %d rules",
+                                      dpid, len(table.routes),
+                                      len(table.desired))
+        touched |= set(dpids)
+        if TABLE_BUDGET:
+            # Per-source rules can take a table over its budget
+            for dpid in touched:
+                table = self.flow_tables.get(dpid)
+                evicted = table.trim() if table is not None else ()
+                if evicted:
+                    self.evictions.inc(dpid, 'lru', amount=len(evicted))
+        self.sync_flows(touched)
+
+    def set_table_route(self, table, dl_dst, port):
+        """Record one next hop of the route engine in a flow table"""
+        if isinstance(dl_dst, LabelRule):
+            # The switch with the label delivers by host instead
+            if self.label_dpids.get(dl_dst.vlan) != table.dpid:
+                table.set_label(dl_dst.vlan, port)
+        elif not isinstance(port, tuple):
+            table.set_route(dl_dst, port)
+        elif table.select_groups:
+            table.set_multipath(dl_dst, port)
+        else:
+            table.set_multipath(dl_dst, port,
+                                self.split_sources(table.dpid, dl_dst, port))
+
+    def update_backups(self):
+        """
+        Record the backup next hops that changed in the route engine in
+        the flow tables; returns the DPIDs whose desired rules changed
+        """
+        dpids = set()
+        for (dpid, dl_dst), port in self.routes.backup_changes().items():
+            table = self.flow_tables.get(dpid)
+            if table is not None and table.set_backup(dl_dst, port):
+                dpids.add(dpid)
+        return dpids
+
+    def fail_over(self, dpid, port_no):
+        """
+        Move the routes of an OpenFlow 1.0 switch off a port that went
+        down at once: onto their backup next hops, or onto their other
+        equal-cost ports.  The coalesced recompute that follows replaces
+        them with the new shortest paths.
+        """
+        table = self.flow_tables.get(dpid)
+        if table is None or table.select_groups:
+            # Fast-failover groups already moved in the data plane
+            return
+        changes = {}
+        for dl_dst, port in table.routes.items():
+            if isinstance(port, tuple):
+                if port_no in port:
+                    rest = tuple(p for p in port if p != port_no)
+                    changes[(dpid, dl_dst)] = (rest if len(rest) > 1
+                                               else rest[0])
+            elif port == port_no and dl_dst in table.backups:
+                changes[(dpid, dl_dst)] = table.backups[dl_dst]
+        if not changes:
+            return
+        for key in changes:
+            self.failed_over[key] = port_no
+        self.logger.info("switch%s: port %d down, %d routes moved to their "
+                         "backups", dpid, port_no, len(changes))
+        self.failovers.inc(dpid, amount=len(changes))
+        self.install_routes(changes)
+
+    def restore_routes(self, changes, port=None):
+        """
+        Add to `changes` the engine's routes for the failed-over routes
+        that it did not change, unless they still use the failed port
+        (the engine has not seen the failure yet); with `port` given as
+        (dpid, port_no), restore those of a port that came back up.
+        """
+        routes = {}
+        for key, failed in list(self.failed_over.items()):
+            dpid, dl_dst = key
+            if port is not None and port != (dpid, failed):
+                continue
+            if key in changes:
+                del self.failed_over[key]
+                continue
+            if dpid not in routes:
+                routes[dpid] = self.routes.routes(dpid)
+            route = routes[dpid].get(dl_dst)
+            if (port is None and (route == failed or
+                                  isinstance(route, tuple) and
+                                  failed in route)):
+                continue
+            changes[key] = route
+            del self.failed_over[key]
+
+    def sync_flows(self, dpids):
+        """
+        Send only the adds, modifies and deletes that differ from what
+        was last installed on each of the given switches.  The FlowMods
+        of one switch go out as a single batch closed by a barrier.
+        """
+        for dpid in dpids:
+            table = self.flow_tables.get(dpid)
+            flood_table = self.flood_tables.get(dpid)
+            tm_switch = self.tm.find_tmswitch_by_dpid(dpid)
+            if table is None or tm_switch is None:
+                continue
+            ops = table.sync()
+            flood_ops = flood_table.sync() if flood_table else []
+            if not ops and not flood_ops:
+                continue
+            datapath = tm_switch.get_dp()
+            ofctl = self.get_ofctl(datapath)
+            with ofctl.batch(self.barrier_waiters,
+                             self.flows_confirmed) as batch:
+                for command, in_port, ports in flood_ops:
+                    if command == FLOW_ADD:
+                        self.add_broadcast_rule(datapath, in_port, ports,
+                                                ofctl=ofctl)
+                    elif command == FLOW_MODIFY:
+                        self.add_broadcast_rule(
+                            datapath, in_port, ports,
+                            command=datapath.ofproto.OFPFC_MODIFY_STRICT,
+                            ofctl=ofctl)
+                    elif command == FLOW_DELETE:
+                        self.remove_broadcast_rule(datapath, in_port,
+                                                   ofctl=ofctl)
+                for command, dl_dst, port in ops:
+                    if isinstance(dl_dst, PrefixRule):
+                        self.sync_prefix_rule(datapath, command, dl_dst,
+                                              port, ofctl)
+                        continue
+                    if isinstance(dl_dst, LabelRule):
+                        self.sync_label_rule(datapath, command, dl_dst,
+                                             port, ofctl)
+                        continue
+                    nw_src = 0
+                    if isinstance(dl_dst, SourceRule):
+                        dl_dst, nw_src = dl_dst
+                    if command == FLOW_ADD:
+                        self.add_forwarding_rule(datapath, dl_dst, port,
+                                                 ofctl=ofctl, nw_src=nw_src)
+                    elif command == FLOW_MODIFY:
+                        self.add_forwarding_rule(
+                            datapath, dl_dst, port,
+                            command=datapath.ofproto.OFPFC_MODIFY_STRICT,
+                            ofctl=ofctl, nw_src=nw_src)
+                    elif command == FLOW_DELETE:
+                        self.remove_forwarding_rule(datapath, dl_dst,
+                                                    ofctl=ofctl,
+                                                    nw_src=nw_src)
+            self.flow_mods.inc(dpid, amount=len(batch))
+
+    def sync_prefix_rule(self, datapath, command, prefix, port, ofctl):
+        if command == FLOW_ADD:
+            self.add_prefix_rule(datapath, prefix, port, ofctl=ofctl)
+        elif command == FLOW_MODIFY:
+            self.add_prefix_rule(
+                datapath, prefix, port,
+                command=datapath.ofproto.OFPFC_MODIFY_STRICT, ofctl=ofctl)
+        elif command == FLOW_DELETE:
+            self.remove_prefix_rule(datapath, prefix, ofctl=ofctl)
+
+    def sync_label_rule(self, datapath, command, key, port, ofctl):
+        if command == FLOW_ADD:
+            self.add_label_rule(datapath, key, port, ofctl=ofctl)
+        elif command == FLOW_MODIFY:
+            self.add_label_rule(
+                datapath, key, port,
+                command=datapath.ofproto.OFPFC_MODIFY_STRICT, ofctl=ofctl)
+        elif command == FLOW_DELETE:
+            self.remove_label_rule(datapath, key, ofctl=ofctl)
+
+    def flows_confirmed(self, batch):
+        self.barrier_seconds.observe(batch.latency)
+        self.logger.debug("switch%s: %d FlowMods confirmed in %.2f ms",
+                          batch.ofctl.dp.id, len(batch),
+                          batch.latency * 1000)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    @timed
+    def barrier_reply_handler(self, ev):
+        """
+        EventHandler for barrier replies closing a FlowMod batch
+        """
+        msg = ev.msg
+        waiters = self.barrier_waiters.get(msg.datapath.id, {})
+        batch = waiters.pop(msg.xid, None)
+        if batch is not None:
+            batch.complete()
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    @timed
+    def flow_removed_handler(self, ev):
+        """
+        EventHandler for flows a switch removed: a dl_dst rule that was
+        idle for IDLE_TIMEOUT is evicted until its traffic comes back
+        """
+        msg = ev.msg
+        datapath = msg.datapath
+        if (msg.reason != datapath.ofproto.OFPRR_IDLE_TIMEOUT or
+                msg.priority != DEFAULT_PRIORITY):
+            return
+        table = self.flow_tables.get(datapath.id)
+        ofctl = self.get_ofctl(datapath)
+        dl_dst = ofctl.get_match_dl_dst(msg.match)
+        if table is None or dl_dst not in table.routes:
+            return
+        table.expire(dl_dst)
+        self.evictions.inc(datapath.id, 'idle')
+        self.release_group(datapath, dl_dst, ofctl)
+        # Its per-source rules go with it
+        self.sync_flows([datapath.id])
+
+    def reinstall_route(self, datapath, in_port, dl_dst, msg):
+        """
+        Give an evicted destination its rule back on the switch its
+        traffic missed on, and send the packet through the table again
+        """
+        table = self.flow_tables.get(datapath.id)
+        if table is None or dl_dst not in table.evicted:
+            return
+        evicted = table.restore(dl_dst)
+        self.set_table_route(table, dl_dst, table.routes[dl_dst])
+        # Its per-source rules may need more room, but not its own
+        evicted += table.trim(keep=dl_dst)
+        if evicted:
+            self.evictions.inc(datapath.id, 'lru', amount=len(evicted))
+        self.sync_flows([datapath.id])
+        if dl_dst not in table.desired:
+            # No room even so (the budget is taken by prefix rules)
+            return
+        self.reinstalls.inc(datapath.id)
+        ofctl = self.get_ofctl(datapath)
+        ofctl.send_packet_out(in_port, datapath.ofproto.OFPP_TABLE,
+                              msg.data, buffer_id=msg.buffer_id)
+        self.packet_outs.inc(datapath.id)
+
+    @set_ev_cls([ofp_event.EventOFPPortStatsReply,
+                 ofp_event.EventOFPFlowStatsReply], MAIN_DISPATCHER)
+    @timed
+    def stats_reply_handler(self, ev):
+        """
+        EventHandler for stats replies, matched to their request by the
+        stats collector
+        """
+        self.stats.reply(ev.msg)
+
+    def poll_port_stats(self):
+        """
+        Green thread: poll the port statistics of all switches at once
+        and route on the resulting link costs whenever they change
+        """
+        capacity = LINK_CAPACITY * 1e6 / 8
+        costs = {}
+        while True:
+            hub.sleep(STATS_INTERVAL)
+            requests = []
+            for dpid, tm_switch in list(self.tm.switches.items()):
+                datapath = tm_switch.get_dp()
+                ofctl = self.get_ofctl(datapath)
+                requests.append((dpid, self.stats.request(
+                    datapath, ofctl.port_stats_request())))
+            for dpid, req in requests:
+                replies = req.wait()
+                if req.timed_out:
+                    continue
+                for msg in replies:
+                    for stat in msg.body:
+                        self.port_stats.update(dpid, stat.port_no,
+                                               stat.tx_bytes, req.done_at)
+            new = self.port_stats.link_costs(self.tm.graph, capacity,
+                                             UTILIZATION_WEIGHT)
+            if new != costs:
+                costs = new
+                self.send_event(self.name, EventLinkCosts(costs))
+
+    @set_ev_cls(EventLinkCosts)
+    @timed
+    def handle_link_costs(self, ev):
+        changes = self.routes.reweight(ev.costs)
+        if self.failed_over:
+            self.restore_routes(changes)
+        busy = sum(1 for c in ev.costs.values() if c > 1)
+        self.logger.info("Rerouted on new link costs (%d busy links, %d "
+                         "next hops changed)", busy, len(changes))
+        self.install_routes(changes, backups=True)
 
     @set_ev_cls(event.EventSwitchEnter)
+    @timed
     def handle_switch_add(self, ev):
         """
         Event handler indicating a switch has come online.
         """
+        self.record(ev)
         switch = ev.switch
 
         self.logger.warn("Added Switch switch%d with ports:", switch.dp.id)
@@ -66,113 +1315,196 @@ class ShortestPathSwitching(app_manager.RyuApp):
         sw_name = "switch_{}".format(switch.dp.id)
         tm_switch = TMSwitch(sw_name, switch)
         self.tm.add_switch(tm_switch)
+        ofctl = self.get_ofctl(switch.dp)
+        self.flow_tables[switch.dp.id] = FlowTable(switch.dp.id,
+                                                   ofctl.select_groups,
+                                                   TABLE_BUDGET)
+        if switch.dp.ofproto.OFP_VERSION != ofproto_v1_0.OFP_VERSION:
+            # From OpenFlow 1.3 on table misses are dropped; send ARP (and
+            # IP to evicted destinations) to the controller as an
+            # OpenFlow 1.0 table miss would
+            ofctl.set_packetin_flow(DEFAULT_COOKIE, CONTROLLER_PRIORITY,
+                                    dl_type=ether_types.ETH_TYPE_ARP)
+            if REACTIVE:
+                ofctl.set_packetin_flow(DEFAULT_COOKIE, CONTROLLER_PRIORITY,
+                                        dl_type=ether_types.ETH_TYPE_IP)
+        self.flood_tables[switch.dp.id] = FloodTable(switch.dp.id)
         # test
         # self.add_forwarding_rule(switch.dp,'00:00:00:00:00:01',1)
         # self.add_forwarding_rule(switch.dp,'00:00:00:00:00:02',2)
         # ---------------------------------------------------------------------------
-        self.updateAll()
-
-    def updateAll(self):
-        for device in self.tm.all_devices:
-            if isinstance(device, TMHost):
-                self.bfsUpdate(device)
+        if self.snapshot is not None:
+            # Before the routes of the switch, which release them
+            self.preload_flows(switch.dp)
+        self.coalescer.add((SWITCH_ADDED, switch.dp.id))
+        if self.snapshot is not None:
+            self.warm_start(tm_switch)
 
     @set_ev_cls(event.EventSwitchLeave)
+    @timed
     def handle_switch_delete(self, ev):
         """
         Event handler indicating a switch has been removed
         """
+        self.record(ev)
         switch = ev.switch
 
         self.logger.warn("Removed Switch switch%d with ports:", switch.dp.id)
         for port in switch.ports:
             self.logger.warn("\t%d:  %s", port.port_no, port.hw_addr)
 
-        print("switch: %s" % (switch))
-        for device in self.tm.all_devices:
-            print("device: %s" % (device))
+        if TRACE:
+            print("switch: %s" % (switch))
 
         # Update network topology and flow rules
         tm_switch = self.tm.find_tmswitch_by_dpid(switch.dp.id)
-        self.tm.deleteSwitch(tm_switch)
-        self.updateAll()
+        neighbors = []
+        if tm_switch is not None:
+            neighbors = [n.get_dpid() for n in tm_switch.get_neighbors()
+                         if isinstance(n, TMSwitch)]
+            self.tm.deleteSwitch(tm_switch)
+        self.flow_tables.pop(switch.dp.id, None)
+        self.flood_tables.pop(switch.dp.id, None)
+        self.ofctls.pop(switch.dp.id, None)
+        self.barrier_waiters.pop(switch.dp.id, None)
+        self.stats.forget(switch.dp.id)
+        for key in [k for k in self.failed_over if k[0] == switch.dp.id]:
+            del self.failed_over[key]
+        self.port_stats.forget(switch.dp.id)
+        self.coalescer.add((SWITCH_REMOVED, switch.dp.id))
+        # The ports of the neighbours facing this switch become edge ports
+        for dpid in neighbors:
+            self.coalescer.add((PORT_CHANGED, dpid))
 
     @set_ev_cls(event.EventHostAdd)
+    @timed
     def handle_host_add(self, ev):
         """
         Event handler indiciating a host has joined the network
         This handler is automatically triggered when a host sends an ARP response.
         """
+        self.record(ev)
         host = ev.host
         self.logger.warn("Host Added:  %s (IPs:  %s) on switch%s/%s (%s)",
                          host.mac, host.ipv4,
                          host.port.dpid, host.port.port_no, host.port.hw_addr)
+        self.add_host(host)
 
+    def add_host(self, host):
+        """Add a Ryu host to the topology and route to it"""
         # Update network topology
         tm_switch = self.tm.find_switch_by_port(host.port)
         h_name = "host_{}".format(host.mac)
         tm_host = TMHost(h_name, host)
-        tm_host.add_neighbor(tm_switch)
-        tm_switch.add_neighbor(tm_host)
         self.tm.add_host(tm_host)
-        tm_switch.set_pm_table(host.port.port_no, tm_host.get_mac())
-        # TODO: update flow rules
-        self.updateAll()
-
-    def bfsGenerateTree(host):
-        print("-------Broadcast update-------")
-        visited = []
-        q = queue.Queue()
-        q.put(host)
-        visited.append(host)
-        dst_ip = '0.0.0.0'
-
-    def bfsUpdate(self, host):
-        # ouput host
-        print("-------BFS Update-------")
-        host.cleanFather()
-        visited = []
-        q = queue.Queue()
-        q.put(host)
-        visited.append(host)
-        dst_mac = host.get_mac()  # every switch on the way will set it as dst
-
-        while(not q.empty()):
-            # print("queue size: %d"%q.qsize())
-            device = q.get()
-            # print("dequeue: %s" % device)
-
-            for n in device.get_neighbors():
-                # print("neighbors num: %d"%len(device.get_neighbors()))
-                if n in visited:
-                    continue
-                visited.append(n)
-                q.put(n)
-                # print("%s enqueue"%n)
-                if isinstance(n, TMSwitch):
-                    if isinstance(device, TMHost):
-                        h_mac = device.get_mac()
-                        s_port = n.get_link_port(h_mac)
-                        # set flow table and father node
-                        self.add_forwarding_rule(n.get_dp(), dst_mac, s_port)
-                        n.setFather(device)
-                    elif isinstance(device, TMSwitch):
-                        ports = device.get_ports()
-                        for d_port in ports:
-                            #  get number
-                            if d_port.hw_addr in n.pm_table.keys():
-                                s_port = n.get_link_port(d_port.hw_addr)
-                                # set flow table and father node
-                                # print("\n-------------------set switch flow table---------------------\n")
-                                self.add_forwarding_rule(
-                                    n.get_dp(), dst_mac, s_port)
-                                n.setFather(device)
-                                break
-                elif isinstance(n, TMHost):
-                    n.setFather(device)  # add Father
-                    # show the path from init host to this host
-                    self.show_path(host, n)
-                    self.show_adjacent_table()
+        if tm_switch is not None:
+            self.tm.attach_host(tm_host, tm_switch)
+
+        # Update flow rules
+        self.coalescer.add((HOST_CHANGED, host.mac))
+
+    def age_hosts(self):
+        """
+        Green thread: have the hosts not heard from for HOST_MAX_AGE
+        seconds forgotten
+        """
+        while True:
+            hub.sleep(HOST_MAX_AGE / 2)
+            self.send_event(self.name, EventAgeHosts())
+
+    @set_ev_cls(EventAgeHosts)
+    @timed
+    def handle_age_hosts(self, ev):
+        now = time.time()
+        if IDLE_TIMEOUT:
+            # Traffic to a host keeps its rule on its own switch alive
+            for mac, tm_host in self.tm.hosts.items():
+                table = self.flow_tables.get(tm_host.get_port().dpid)
+                if table is not None and mac in table.installed:
+                    self.tm.host_seen(mac, now)
+        for tm_host in self.tm.stale_hosts(HOST_MAX_AGE, now):
+            self.logger.warn("Host Expired:  %s (IPs:  %s)",
+                             tm_host.get_mac(), tm_host.get_ips())
+            self.tm.delete_host(tm_host)
+            self.coalescer.add((HOST_CHANGED, tm_host.get_mac()))
+
+    def refresh_host(self, datapath, in_port, headers):
+        """
+        Note that the sender of a packet-in was heard from.  Ryu only
+        reports a host the first time it sees it, so one that was aged
+        out is learnt again here from its next ARP packet.
+        """
+        mac = headers.src_mac
+        if mac in self.tm.hosts:
+            self.tm.host_seen(mac)
+            return
+        if headers.arp_opcode is None:
+            return
+        tm_switch = self.tm.find_tmswitch_by_dpid(datapath.id)
+        if (tm_switch is None or
+                in_port not in self.tm.get_edge_ports(tm_switch)):
+            return
+        for port in tm_switch.get_ports():
+            if port.port_no == in_port:
+                break
+        else:
+            return
+        host = switches.Host(mac, port)
+        if headers.arp_src_ip != '0.0.0.0':
+            host.ipv4.append(headers.arp_src_ip)
+        self.logger.warn("Host Relearned:  %s (IPs:  %s) on switch%s/%s",
+                         mac, host.ipv4, port.dpid, port.port_no)
+        self.add_host(host)
+
+    @set_ev_cls(event.EventHostMove)
+    @timed
+    def handle_host_move(self, ev):
+        """
+        Event handler indicating a known host showed up on another switch port
+        """
+        self.record(ev)
+        src, dst = ev.src, ev.dst
+        self.logger.warn("Host Moved:  %s from switch%s/%s to switch%s/%s",
+                         dst.mac, src.port.dpid, src.port.port_no,
+                         dst.port.dpid, dst.port.port_no)
+
+        tm_host = self.tm.find_host_by_mac(dst.mac)
+        tm_switch = self.tm.find_switch_by_port(dst.port)
+        if tm_host is None:
+            tm_host = TMHost("host_{}".format(dst.mac), dst)
+            self.tm.add_host(tm_host)
+            if tm_switch is not None:
+                self.tm.attach_host(tm_host, tm_switch)
+        else:
+            self.tm.move_host(tm_host, dst, tm_switch)
+        self.coalescer.add((HOST_CHANGED, dst.mac))
+
+    def flood_broadcast(self, datapath, in_port, data, key):
+        """
+        Inject a broadcast received on an edge port into the spanning
+        tree: it leaves the switch on every tree and edge port but
+        in_port, and the other switches replicate it with their
+        broadcast rules.  The same key is flooded at most once per
+        BROADCAST_HOLDDOWN seconds.
+        """
+        now = time.time()
+        if now - self.recent_floods.get(key, 0) < BROADCAST_HOLDDOWN:
+            return
+        if len(self.recent_floods) > 1024:
+            self.recent_floods = {
+                k: t for k, t in self.recent_floods.items()
+                if now - t < BROADCAST_HOLDDOWN}
+        self.recent_floods[key] = now
+
+        if TRACE:
+            print("-------Broadcast update-------")
+        table = self.flood_tables.get(datapath.id)
+        ports = table.flood_ports(in_port) if table else []
+        if ports:
+            ofctl = self.get_ofctl(datapath)
+            ofctl.send_packet_out(datapath.ofproto.OFPP_CONTROLLER, ports,
+                                  data)
+            self.packet_outs.inc(datapath.id)
 
     def show_adjacent_table(self):
         print("------------adjacent table-------------------")
@@ -183,35 +1515,28 @@ class ShortestPathSwitching(app_manager.RyuApp):
             print()
         print()
 
-    # show the path to the device(each update will generate a path from start device to every other devices)
-    def show_path(self, from_device, to_device):
-        stack = queue.LifoQueue()
-        mark = {}  # mark which device has enter
-        stack.put(to_device)
+    # show the path taken from one host to another
+    def show_path(self, from_host, to_host):
+        dst = to_host.get_mac()
+        if self.label_switching:
+            vlan = self.labels.get(to_host.get_port().dpid)
+            dst = LabelRule(vlan, None)
+        dpids = self.routes.path(from_host.get_port().dpid, dst)
         print("-----The shortest path from %s to %s is-----" %
-              (from_device, to_device))
-        while not stack.empty():
-            head_device = stack.get()
-            if head_device.father != None:
-                if head_device in mark.keys():
-                    if not stack.empty():
-                        print("|%s|->" % head_device, end=' ')
-                    else:
-                        print("|%s|" % head_device)  # the last one
-                        print("--------------------------------------------------")
-                else:
-                    father_device = head_device.father
-                    stack.put(head_device)
-                    stack.put(father_device)
-                mark[head_device] = True
-            else:
-                print("|%s|->" % head_device, end=' ')
+              (from_host, to_host))
+        hops = ["|%s|" % from_host]
+        hops += ["|switch%s|" % dpid for dpid in dpids]
+        hops += ["|%s|" % to_host]
+        print("->".join(hops))
+        print("--------------------------------------------------")
 
     @set_ev_cls(event.EventLinkAdd)
+    @timed
     def handle_link_add(self, ev):
         """
         Event handler indicating a link between two switches has been added
         """
+        self.record(ev)
         link = ev.link
         src_port = ev.link.src
         dst_port = ev.link.dst
@@ -220,28 +1545,25 @@ class ShortestPathSwitching(app_manager.RyuApp):
                          dst_port.dpid, dst_port.port_no, dst_port.hw_addr)
 
         # Update network topology and flow rules
-        tm_switch1 = self.tm.find_switch_by_port(src_port)
-        tm_switch2 = self.tm.find_switch_by_port(dst_port)
-        # print("+++++++++Switch Link++++++++++")
-        # print("switch1:%s\nswitch2:%s"%(tm_switch1,tm_switch2))
-
-        tm_switch1.add_neighbor(tm_switch2)
-        tm_switch2.add_neighbor(tm_switch1)
-        tm_switch1.set_pm_table(src_port.port_no, dst_port.hw_addr)
-        tm_switch2.set_pm_table(dst_port.port_no, src_port.hw_addr)
-
+        if self.tm.add_link(src_port, dst_port) is None:
+            return
+        if self.provisional_links:
+            self.provisional_links.pop(self.link_key(src_port, dst_port),
+                                       None)
         # print("------------------Show PM Table------------------")
         # print("switch%s neighbor: %s"%(tm_switch1.get_dpid(),tm_switch1.get_neighbors()))
         # print("switch%s pm_table: %s"%(tm_switch1.get_dpid(),tm_switch1.pm_table))
         # print("switch%s neighbor: %s"%(tm_switch2.get_dpid(),tm_switch2.get_neighbors()))
         # print("switch%s pm_table: %s"%(tm_switch2.get_dpid(),tm_switch2.pm_table))
-        self.updateAll()
+        self.coalescer.add((LINK_ADDED, src_port.dpid, dst_port.dpid))
 
     @set_ev_cls(event.EventLinkDelete)
+    @timed
     def handle_link_delete(self, ev):
         """
         Event handler indicating when a link between two switches has been deleted
         """
+        self.record(ev)
         link = ev.link
         src_port = link.src
         dst_port = link.dst
@@ -250,76 +1572,134 @@ class ShortestPathSwitching(app_manager.RyuApp):
                          src_port.dpid, src_port.port_no, src_port.hw_addr,
                          dst_port.dpid, dst_port.port_no, dst_port.hw_addr)
 
-        # TODO:  Update network topology and flow rules
-        tm_switch_src = self.tm.find_switch_by_port(src_port)
-        tm_switch_dst = self.tm.find_switch_by_port(dst_port)
+        # Update network topology and flow rules
+        if self.tm.delete_link(src_port, dst_port) is None:
+            return
+        if self.provisional_links:
+            self.provisional_links.pop(self.link_key(src_port, dst_port),
+                                       None)
+        if FAST_FAILOVER:
+            self.fail_over(src_port.dpid, src_port.port_no)
+        self.coalescer.add((LINK_DELETED, src_port.dpid, dst_port.dpid))
 
-        if tm_switch_dst in self.tm.all_devices and tm_switch_src in self.tm.all_devices:
-            tm_switch_src.remove_neighbor(tm_switch_dst)
-            tm_switch_dst.remove_neighbor(tm_switch_src)
+    @set_ev_cls(event.EventPortAdd)
+    @timed
+    def handle_port_add(self, ev):
+        """
+        Event handler indicating a port was added to a known switch
+        """
+        self.record(ev)
+        self.tm.add_port(ev.port)
+        self.coalescer.add((PORT_CHANGED, ev.port.dpid))
 
-            tm_switch_src.del_pm_link(src_port.hw_addr)
-            tm_switch_dst.del_pm_link(dst_port.hw_addr)
-        self.updateAll()
+    @set_ev_cls(event.EventPortDelete)
+    @timed
+    def handle_port_delete(self, ev):
+        """
+        Event handler indicating a port was removed from a switch
+        """
+        self.record(ev)
+        self.tm.delete_port(ev.port)
+        if FAST_FAILOVER:
+            self.fail_over(ev.port.dpid, ev.port.port_no)
+        self.coalescer.add((PORT_CHANGED, ev.port.dpid))
 
     @set_ev_cls(event.EventPortModify)
+    @timed
     def handle_port_modify(self, ev):
         """
         Event handler for when any switch port changes state.
         This includes links for hosts as well as links between switches.
         """
+        self.record(ev)
         port = ev.port
         self.logger.warn("Port Changed:  switch%s/%s (%s):  %s",
                          port.dpid, port.port_no, port.hw_addr,
                          "UP" if port.is_live() else "DOWN")
 
         # Update network topology and flow rules
+        if not FAST_FAILOVER:
+            return
+        if not port.is_live():
+            self.fail_over(port.dpid, port.port_no)
+        elif self.failed_over:
+            changes = {}
+            self.restore_routes(changes, (port.dpid, port.port_no))
+            self.install_routes(changes)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    @timed
     def packet_in_handler(self, ev):
         """
        EventHandler for PacketIn messages
         """
+        self.record(ev)
         msg = ev.msg
 
         # In OpenFlow, switches are called "datapaths".  Each switch gets its own datapath ID.
         # In the controller, we pass around datapath objects with metadata about each switch.
         dp = msg.datapath
 
+        if dp.ofproto.OFP_VERSION == ofproto_v1_0.OFP_VERSION:
+            in_port = msg.in_port
+        else:
+            in_port = msg.match['in_port']
+        # Peek at the headers instead of decoding the whole frame with
+        # packet.Packet(): only ARP (and IP to evicted destinations)
+        # needs work, everything else (LLDP, IPv6, ...) is just counted
+        # per ethertype and dropped
+        headers = self.classifier.classify(msg.data)
+        if headers is None:
+            return
+        if HOST_MAX_AGE:
+            self.refresh_host(dp, in_port, headers)
+        if headers.ethertype == ether_types.ETH_TYPE_IP and REACTIVE:
+            # Traffic to a destination whose rule was evicted
+            self.reinstall_route(dp, in_port, headers.dst_mac, msg)
+            return
+        if headers.ethertype != ether_types.ETH_TYPE_ARP:
+            return
+
         # Use this object to create packets for the given datapath
-        ofctl = OfCtl.factory(dp, self.logger)
-
-        in_port = msg.in_port
-        pkt = packet.Packet(msg.data)  # resolve packet out
-        eth = pkt.get_protocols(ethernet.ethernet)[
-            0]  # get link layer protocal
-
-        
-
-        if eth.ethertype == ether_types.ETH_TYPE_ARP:
-            # resolve package as arp msg
-            arp_msg = pkt.get_protocols(arp.arp)[0]
-
-            if arp_msg.opcode == arp.ARP_REQUEST:  # if it is a request option
-
-                self.logger.warning("Received ARP REQUEST on switch%d/%d:  Who has %s?  Tell %s",
-                                    dp.id, in_port, arp_msg.dst_ip, arp_msg.src_mac)
-                #TODO: Implement broadcast-storm preventing method
-                
-                # Generate a *REPLY* for this request based on your switch state
-                ask_ip = arp_msg.src_ip
-                ask_mac = arp_msg.src_mac
-                repl_ip = arp_msg.dst_ip
-                if repl_ip in self.tm.ARPTable.keys():
-                    repl_mac = self. tm.ARPTable[repl_ip]
-                    # Here is an example way to send an ARP packet using the ofctl utilities
-                    ofctl.send_arp(arp_opcode=arp.ARP_REPLY, vlan_id=VLANID_NONE, dst_mac=ask_mac, sender_mac=repl_mac, sender_ip=repl_ip,
-                                   target_mac=ask_mac, target_ip=ask_ip, src_port=ofctl.dp.ofproto.OFPP_CONTROLLER, output_port=in_port
-                                   )
-                else:
-                    # boardcast method
-                    host_src = self.tm.find_host_by_maco(
-                        ask_mac)  # search host by mac
-                    self.bfsGenerateTree(host_src)
+        ofctl = self.get_ofctl(dp)
+
+        # arp_opcode is only set for Ethernet/IPv4 ARP, the only kind the
+        # ARP table can answer
+        if headers.arp_opcode == arp.ARP_REQUEST:  # if it is a request option
 
+            self.logger.warning("Received ARP REQUEST on switch%d/%d:  Who has %s?  Tell %s",
+                                dp.id, in_port, headers.arp_dst_ip, headers.arp_src_mac)
+            # Generate a *REPLY* for this request based on your switch state
+            ask_ip = headers.arp_src_ip
+            ask_mac = headers.arp_src_mac
+            repl_ip = headers.arp_dst_ip
+            if repl_ip in self.tm.ARPTable.keys():
+                repl_mac = self.tm.ARPTable[repl_ip]
+                # The reply bytes come from the cache instead of being
+                # serialized by ofctl.send_arp() every time
+                data = self.arp_cache.reply(ask_mac, ask_ip,
+                                            repl_ip, repl_mac)
+                ofctl.send_packet_out(ofctl.dp.ofproto.OFPP_CONTROLLER,
+                                      in_port, data)
+                self.packet_outs.inc(dp.id)
+            else:
+                # boardcast method
+                self.flood_broadcast(dp, in_port, msg.data,
+                                     (ask_mac, repl_ip))
+
+            if TRACE:
                 print("send reply!")
+
+        elif headers.arp_opcode == arp.ARP_REPLY:
+            # Answer to a flooded request: unicast ARP has no forwarding
+            # rule, so hand it to the requester directly
+            requester = self.tm.find_host_by_mac(headers.arp_dst_mac)
+            if requester is None:
+                return
+            port = requester.get_port()
+            tm_switch = self.tm.find_tmswitch_by_dpid(port.dpid)
+            if tm_switch is not None:
+                ofctl = self.get_ofctl(tm_switch.get_dp())
+                ofctl.send_packet_out(ofctl.dp.ofproto.OFPP_CONTROLLER,
+                                      port.port_no, msg.data)
+                self.packet_outs.inc(port.dpid)
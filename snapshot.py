@@ -0,0 +1,237 @@
+"""Warm-restart snapshots
+
+A Snapshot holds what a restarted controller would otherwise have to
+rediscover: the switches, the links between them (LLDP takes a few
+rounds to find them all), the hosts and their IPv4 addresses (they are
+only learnt from their ARP traffic) and the rules installed on every
+switch.  The app writes one every few seconds and on shutdown, and
+warm-starts from it: a switch that reconnects gets its saved links and
+hosts back at once, so routes exist before discovery has caught up.
+
+File layout: the magic, a version and the record counts, then the
+records of each section back to back: switches, links, hosts, host
+addresses, rules and the output ports the rules refer to.  Every record
+has a fixed size, so loading is a few struct.iter_unpack() calls over a
+memory map of the file.  All integers are big-endian.
+"""
+
+import mmap
+import os
+import socket
+import struct
+
+from flow_table import SourceRule, PrefixRule, Failover, LabelRule
+from flow_table import PushLabel, STALE
+
+SNAPSHOT_MAGIC = b'SPSSNAPS'
+SNAPSHOT_VERSION = 2
+
+# Rule kinds
+RULE_DST = 0
+RULE_SOURCE = 1
+RULE_PREFIX = 2
+RULE_LABEL = 3
+
+# Output kinds
+OUTPUT_PORT = 0
+OUTPUT_MULTIPATH = 1
+OUTPUT_FAILOVER = 2
+OUTPUT_PUSH = 3
+
+# magic, version, switches, links, hosts, addresses, rules, ports
+_HEADER = struct.Struct('!8sHIIIIII')
+_SWITCH = struct.Struct('!Q')
+_LINK = struct.Struct('!QIQI')     # dpid, port_no, peer dpid, peer port_no
+_HOST = struct.Struct('!6sQI')     # mac, dpid, port_no
+_ADDRESS = struct.Struct('!4sI')   # IPv4 address, host index
+# dpid, kind, dl_dst, IPv4 address, prefix length, output kind, port
+# count, index of the first port, group id (0: none), VLAN id (the label
+# a RULE_LABEL matches or an OUTPUT_PUSH pushes, else 0)
+_RULE = struct.Struct('!QB6s4sBBHIIH')
+_PORT = struct.Struct('!I')
+
+_NO_MAC = bytes(6)
+_NO_IP = bytes(4)
+
+
+def _mac_bin(mac):
+    return bytes.fromhex(mac.replace(':', ''))
+
+
+def _encode_rule(dpid, key, value, group_id, ports):
+    """Return the _RULE record of an installed rule, appending its output
+    ports to ports"""
+    vlan = 0
+    if isinstance(key, PrefixRule):
+        kind, mac = RULE_PREFIX, _NO_MAC
+        ip, length = socket.inet_aton(key.nw_dst), key.length
+    elif isinstance(key, LabelRule):
+        kind, mac = RULE_LABEL, _NO_MAC
+        if key.dl_dst:
+            mac = _mac_bin(key.dl_dst)
+        ip, length, vlan = _NO_IP, 0, key.vlan
+    elif isinstance(key, SourceRule):
+        kind, mac = RULE_SOURCE, _mac_bin(key.dl_dst)
+        ip, length = socket.inet_aton(key.nw_src), 32
+    else:
+        kind, mac, ip, length = RULE_DST, _mac_bin(key), _NO_IP, 0
+    if isinstance(value, PushLabel):
+        output, vlan, value = OUTPUT_PUSH, value.vlan, (value.port,)
+    elif isinstance(value, Failover):
+        output = OUTPUT_FAILOVER
+    elif isinstance(value, tuple):
+        output = OUTPUT_MULTIPATH
+    else:
+        output, value = OUTPUT_PORT, (value,)
+    first = len(ports)
+    ports.extend(value)
+    return _RULE.pack(dpid, kind, mac, ip, length, output, len(value),
+                      first, group_id, vlan)
+
+
+def _decode_rule(record, ports):
+    """Return (dpid, key, value, group_id) of a _RULE record"""
+    (dpid, kind, mac, ip, length, output, count, first, group_id,
+     vlan) = record
+    if kind == RULE_PREFIX:
+        key = PrefixRule(socket.inet_ntoa(ip), length)
+    elif kind == RULE_LABEL:
+        key = LabelRule(vlan, mac.hex(':') if mac != _NO_MAC else None)
+    elif kind == RULE_SOURCE:
+        key = SourceRule(mac.hex(':'), socket.inet_ntoa(ip))
+    else:
+        key = mac.hex(':')
+    value = tuple(ports[first:first + count])
+    if output == OUTPUT_FAILOVER:
+        value = Failover(*value)
+    elif output == OUTPUT_PUSH:
+        value = PushLabel(vlan, value[0])
+    elif output == OUTPUT_PORT:
+        value = value[0]
+    return dpid, key, value, group_id
+
+
+class Snapshot(object):
+    """
+    Controller state to warm-start from
+
+    switches -- DPIDs of the switches
+    links    -- (dpid, port_no, peer dpid, peer port_no) of every link,
+                in one direction only
+    hosts    -- (mac, dpid, port_no, [IPv4 addresses]) of every host
+    rules    -- {dpid: {rule key: (installed output, group id or 0)}}
+    """
+
+    def __init__(self, switches=(), links=(), hosts=(), rules=None):
+        super(Snapshot, self).__init__()
+        self.switches = list(switches)
+        self.links = list(links)
+        self.hosts = list(hosts)
+        self.rules = rules if rules is not None else {}
+        self._by_dpid = None
+
+    @classmethod
+    def capture(cls, tm, flow_tables):
+        """Take a snapshot of a TopoManager and the installed state of
+        the flow tables ({dpid: FlowTable})"""
+        graph = tm.graph
+        links = []
+        for a, dpid in enumerate(graph.dpids):
+            for b, port, peer_port in zip(graph.adj[a], graph.port[a],
+                                          graph.peer_port[a]):
+                if a < b:
+                    links.append((dpid, port, graph.dpids[b], peer_port))
+        hosts = []
+        for mac, tm_host in tm.hosts.items():
+            port = tm_host.get_port()
+            hosts.append((mac, port.dpid, port.port_no,
+                          list(tm_host.get_ips())))
+        rules = {}
+        for dpid, table in flow_tables.items():
+            rules[dpid] = {key: (value, table.group_ids.get(key, 0))
+                           for key, value in table.installed.items()
+                           if value is not STALE}
+        return cls(tm.switches, links, hosts, rules)
+
+    def write(self, path):
+        """Write the snapshot to path, atomically replacing the last one"""
+        ports = []
+        rules = []
+        for dpid, table in self.rules.items():
+            for key, (value, group_id) in table.items():
+                rules.append(_encode_rule(dpid, key, value, group_id, ports))
+        addresses = [(socket.inet_aton(ip), i)
+                     for i, host in enumerate(self.hosts) for ip in host[3]]
+        chunks = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                               len(self.switches), len(self.links),
+                               len(self.hosts), len(addresses), len(rules),
+                               len(ports))]
+        chunks += [_SWITCH.pack(dpid) for dpid in self.switches]
+        chunks += [_LINK.pack(*link) for link in self.links]
+        chunks += [_HOST.pack(_mac_bin(mac), dpid, port_no)
+                   for mac, dpid, port_no, _ in self.hosts]
+        chunks += [_ADDRESS.pack(*address) for address in addresses]
+        chunks += rules
+        chunks.append(struct.pack('!%dI' % len(ports), *ports))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(chunks))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a snapshot file; raises ValueError if it is not one"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                raise ValueError("%s is not a snapshot" % path)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return cls._decode(buf, path)
+
+    @classmethod
+    def _decode(cls, buf, path):
+        (magic, version, n_switches, n_links, n_hosts, n_addresses,
+         n_rules, n_ports) = _HEADER.unpack_from(buf)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("%s is not a version %d snapshot" %
+                             (path, SNAPSHOT_VERSION))
+        sections = []
+        offset = _HEADER.size
+        for record, count in ((_SWITCH, n_switches), (_LINK, n_links),
+                              (_HOST, n_hosts), (_ADDRESS, n_addresses),
+                              (_RULE, n_rules), (_PORT, n_ports)):
+            end = offset + record.size * count
+            if end > len(buf):
+                raise ValueError("%s is truncated" % path)
+            with memoryview(buf)[offset:end] as view:
+                sections.append(list(record.iter_unpack(view)))
+            offset = end
+        switches, links, hosts, addresses, rules, ports = sections
+
+        hosts = [(mac.hex(':'), dpid, port_no, [])
+                 for mac, dpid, port_no in hosts]
+        for ip, i in addresses:
+            hosts[i][3].append(socket.inet_ntoa(ip))
+        ports = [port for port, in ports]
+        table = {}
+        for record in rules:
+            dpid, key, value, group_id = _decode_rule(record, ports)
+            table.setdefault(dpid, {})[key] = (value, group_id)
+        return cls([dpid for dpid, in switches], links, hosts, table)
+
+    def _index(self):
+        if self._by_dpid is None:
+            self._by_dpid = {}
+            for link in self.links:
+                for dpid in (link[0], link[2]):
+                    self._by_dpid.setdefault(dpid, ([], []))[0].append(link)
+            for host in self.hosts:
+                self._by_dpid.setdefault(host[1], ([], []))[1].append(host)
+        return self._by_dpid
+
+    def links_of(self, dpid):
+        """Return the links with an end on a switch"""
+        return self._index().get(dpid, ((), ()))[0]
+
+    def hosts_of(self, dpid):
+        """Return the hosts attached to a switch"""
+        return self._index().get(dpid, ((), ()))[1]
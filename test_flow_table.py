@@ -0,0 +1,134 @@
+"""Checks of FlowTable.sync(): the operations it returns, in order
+
+Applied to the rules a switch holds, the operations of every sync must
+give exactly the desired table.  Deletes must come after every add and
+modify, so that while a compressed table is replaced no known host
+address is left without a rule; preloaded rules are only deleted once
+they overlap a desired rule or are released.
+"""
+
+import random
+import socket
+import struct
+
+import pytest
+
+from flow_table import FlowTable, FLOW_ADD, FLOW_MODIFY, FLOW_DELETE
+from flow_table import PrefixRule, DROP
+
+
+def mac(i):
+    return '00:00:00:00:00:%02x' % i
+
+
+def ip(i):
+    return '10.0.0.%d' % i
+
+
+def aton(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def covered(rules, address):
+    """Return whether some prefix rule among rules matches address"""
+    addr = aton(address)
+    for key in rules:
+        if isinstance(key, PrefixRule):
+            mask = (0xffffffff << (32 - key.length)) & 0xffffffff
+            if addr & mask == aton(key.nw_dst):
+                return True
+    return False
+
+
+def apply(switch, ops):
+    """Apply sync() operations to the rules a switch holds; deletes must
+    come after every add and modify"""
+    deleting = False
+    for command, key, port in ops:
+        if command == FLOW_DELETE:
+            deleting = True
+            assert key in switch
+            del switch[key]
+        else:
+            assert not deleting, 'add or modify after a delete'
+            assert (key in switch) == (command == FLOW_MODIFY)
+            switch[key] = port
+
+
+def test_sync_sends_only_the_difference():
+    table = FlowTable(1)
+    switch = {}
+    table.set_route(mac(1), 1)
+    table.set_route(mac(2), 2)
+    ops = table.sync()
+    assert sorted(ops) == [(FLOW_ADD, mac(1), 1), (FLOW_ADD, mac(2), 2)]
+    apply(switch, ops)
+    assert table.sync() == []
+    table.set_route(mac(1), 1)
+    table.set_route(mac(2), 3)
+    table.set_route(mac(3), None)
+    assert table.sync() == [(FLOW_MODIFY, mac(2), 3)]
+    table.set_route(mac(1), None)
+    assert table.sync() == [(FLOW_DELETE, mac(1), 1)]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_sync_orders_deletes_last(seed):
+    rnd = random.Random(seed)
+    table = FlowTable(1)
+    switch = {}
+    addresses = {mac(i): [ip(i)] for i in range(1, 40) if rnd.random() < 0.8}
+    for _ in range(30):
+        for i in rnd.sample(range(1, 40), rnd.randint(1, 10)):
+            table.set_route(mac(i), rnd.choice([None, 1, 2, 3, 4]))
+        compressing = rnd.random() < 0.7
+        if compressing:
+            table.compress(addresses)
+        ops = table.sync()
+        assert len({key for _, key, _ in ops}) == len(ops)
+        before = dict(switch)
+        changes = [op for op in ops if op[0] != FLOW_DELETE]
+        apply(switch, changes)
+        # Halfway, the old and the new rules together still match every
+        # host address that is routed by prefix rules before and after
+        if compressing:
+            for dl_dst, (address,) in addresses.items():
+                if covered(before, address) and dl_dst in table.routes:
+                    assert covered(switch, address)
+        apply(switch, ops[len(changes):])
+        assert switch == table.desired == table.installed
+
+
+def test_compress_drops_unknown_addresses():
+    table = FlowTable(1)
+    for i in range(1, 9):
+        table.set_route(mac(i), 1 if i < 6 else 2)
+    table.compress({mac(i): [ip(i)] for i in range(1, 9)})
+    assert all(not isinstance(key, str) for key in table.desired)
+    assert table.desired[PrefixRule('0.0.0.0', 0)] == DROP
+    apply({}, table.sync())
+
+
+def test_preloaded_deletes_wait_unless_overlapping():
+    table = FlowTable(1)
+    switch = {mac(1): 1, mac(2): 2, PrefixRule('10.0.0.0', 24): 3}
+    table.preload({key: (port, 0) for key, port in switch.items()})
+    table.set_route(mac(2), None)
+    table.set_route(mac(3), 3)
+    table.resync()
+    ops = table.sync()
+    # Nothing the controller wants overlaps the old rules yet
+    assert ops == [(FLOW_ADD, mac(3), 3)]
+    apply(switch, ops)
+    # Routing mac(1) by prefix rules overlaps the old /24
+    table.set_route(mac(1), 1)
+    table.compress({mac(1): [ip(1)]})
+    ops = table.sync()
+    apply(switch, ops)
+    assert (FLOW_DELETE, PrefixRule('10.0.0.0', 24), 3) in ops
+    assert mac(2) in switch
+    table.release_preloaded()
+    ops = table.sync()
+    assert ops == [(FLOW_DELETE, mac(2), 2)]
+    apply(switch, ops)
+    assert switch == table.desired == table.installed
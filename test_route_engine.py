@@ -0,0 +1,209 @@
+"""Checks of the route engines against a fresh BFS
+
+Random topologies go through random link and switch changes, applied
+to the graph first and then to the engine, the way ShortestPathSwitching
+replays a burst.  After every step the engine's next hops (RouteEngine's
+incrementally repaired trees, MatrixRouteEngine's BFS over the CsrGraph)
+must be those of a BFS from scratch, and the changes it returned must
+add up to its current routes.
+"""
+
+import collections
+import functools
+import random
+
+import pytest
+
+from route_engine import RouteEngine, MatrixRouteEngine, np
+from topo_manager_example import TopoManager
+
+HOST_PORT = 1
+
+
+def link_port(peer):
+    """The port of a switch leading to the switch with DPID peer"""
+    return 100 + peer
+
+
+class Fabric(object):
+    """A random switch graph with one destination per switch"""
+
+    def __init__(self, rnd, n, engine=RouteEngine, ecmp=False,
+                 backups=False):
+        self.rnd = rnd
+        self.n = n
+        self.tm = TopoManager()
+        self.graph = self.tm.graph
+        for dpid in range(1, n + 1):
+            self.graph.add_node(dpid)
+        for a in range(1, n + 1):
+            for b in range(a + 1, n + 1):
+                if rnd.random() < 0.3:
+                    self.link(a, b)
+        self.engine = engine(self.tm, ecmp=ecmp, backups=backups)
+        # What the switches would have installed, from the changes alone
+        self.installed = {}
+        self.backups = {}
+        self.apply(self.engine.add_destinations(
+            [('h%d' % dpid, dpid, HOST_PORT) for dpid in range(1, n + 1)]))
+
+    def up(self):
+        return [d for d in range(1, self.n + 1)
+                if self.graph.is_up(self.graph.nodes[d])]
+
+    def linked(self, a, b):
+        return self.graph.port_to(self.graph.nodes[a],
+                                  self.graph.nodes[b]) is not None
+
+    def link(self, a, b):
+        self.graph.add_link(self.graph.nodes[a], link_port(b),
+                            self.graph.nodes[b], link_port(a))
+
+    def apply(self, changes):
+        for key, port in changes.items():
+            if port is None:
+                self.installed.pop(key, None)
+            else:
+                self.installed[key] = port
+        for key, port in self.engine.backup_changes().items():
+            if port is None:
+                self.backups.pop(key, None)
+            else:
+                self.backups[key] = port
+
+    def step(self):
+        """Make one random topology change and hand it to the engine"""
+        rnd = self.rnd
+        up = self.up()
+        r = rnd.random()
+        if r < 0.35:
+            links = [(a, b) for a in up for b in up
+                     if a < b and self.linked(a, b)]
+            if links:
+                a, b = rnd.choice(links)
+                self.graph.remove_link(self.graph.nodes[a],
+                                       self.graph.nodes[b])
+                self.apply(self.engine.link_deleted(a, b))
+        elif r < 0.7:
+            if len(up) > 1:
+                a, b = rnd.sample(up, 2)
+                if not self.linked(a, b):
+                    self.link(a, b)
+                    self.apply(self.engine.link_added(a, b))
+        elif r < 0.85:
+            if up:
+                dpid = rnd.choice(up)
+                self.graph.remove_node(dpid)
+                self.apply(self.engine.switch_removed(dpid))
+        else:
+            down = [d for d in range(1, self.n + 1) if d not in up]
+            if down:
+                dpid = rnd.choice(down)
+                self.graph.add_node(dpid)
+                self.apply(self.engine.switch_added(dpid))
+                for b in rnd.sample(up, min(2, len(up))):
+                    self.link(dpid, b)
+                    self.apply(self.engine.link_added(dpid, b))
+
+    def bfs(self, root):
+        """Return {dpid: hop count to root} over the switches that are up"""
+        if not self.graph.is_up(self.graph.nodes[root]):
+            return {}
+        up = self.up()
+        dist = {root: 0}
+        queue = collections.deque([root])
+        while queue:
+            a = queue.popleft()
+            for b in up:
+                if b not in dist and self.linked(a, b):
+                    dist[b] = dist[a] + 1
+                    queue.append(b)
+        return dist
+
+    def check(self):
+        engine = self.engine
+        expected = {}
+        for root in range(1, self.n + 1):
+            dst = 'h%d' % root
+            dist = self.bfs(root)
+            for dpid in self.up():
+                if dpid not in dist:
+                    assert engine.next_hop(dpid, dst) is None
+                    assert engine.path(dpid, dst) == []
+                    continue
+                path = engine.path(dpid, dst)
+                assert len(path) == dist[dpid] + 1 and path[-1] == root
+                if dpid == root:
+                    ports = (HOST_PORT,)
+                else:
+                    ports = tuple(sorted(
+                        link_port(b) for b in self.up()
+                        if dist.get(b) == dist[dpid] - 1 and
+                        self.linked(dpid, b)))
+                assert engine.next_hop(dpid, dst) in ports
+                if engine.ecmp and len(ports) > 1:
+                    expected[(dpid, dst)] = ports
+                else:
+                    expected[(dpid, dst)] = engine.next_hop(dpid, dst)
+                if len(path) > 1:
+                    assert engine.next_hop(dpid, dst) == link_port(path[1])
+                backup = engine.backup_routes(dpid).get(dst)
+                if backup is not None:
+                    peer = backup - 100
+                    assert self.linked(dpid, peer) and peer in dist
+                    assert backup != engine.next_hop(dpid, dst)
+                    assert (dist[peer] <= dist[dpid] or
+                            dpid not in engine.path(peer, dst))
+        routes = {(dpid, dst): port for dpid in self.up()
+                  for dst, port in engine.routes(dpid).items()}
+        assert routes == expected
+        assert self.installed == expected
+        if engine.backups:
+            backups = {(dpid, dst): port for dpid in self.up()
+                       for dst, port in engine.backup_routes(dpid).items()}
+            assert self.backups == backups
+
+
+ENGINES = [
+    RouteEngine,
+    pytest.param(MatrixRouteEngine, marks=pytest.mark.skipif(
+        np is None, reason="MatrixRouteEngine needs numpy")),
+]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('ecmp,backups', [(False, False), (True, False),
+                                          (False, True)])
+@pytest.mark.parametrize('seed', range(20))
+def test_engine_matches_bfs(seed, ecmp, backups, engine):
+    rnd = random.Random(seed)
+    fabric = Fabric(rnd, rnd.randint(3, 14), engine, ecmp=ecmp,
+                    backups=backups)
+    fabric.check()
+    for _ in range(60):
+        fabric.step()
+        fabric.check()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rebuild_after_changes(seed):
+    rnd = random.Random(seed)
+    fabric = Fabric(rnd, 12, ecmp=True)
+    for _ in range(30):
+        fabric.step()
+    fabric.apply(fabric.engine.rebuild())
+    fabric.check()
+
+
+@pytest.mark.skipif(np is None, reason="MatrixRouteEngine needs numpy")
+def test_sharded_matrix_matches_bfs():
+    rnd = random.Random(0)
+    engine = functools.partial(MatrixRouteEngine, workers=2)
+    fabric = Fabric(rnd, 40, engine, ecmp=True)
+    try:
+        fabric.check()
+        for _ in range(10):
+            fabric.step()
+            fabric.check()
+    finally:
+        fabric.engine.close()
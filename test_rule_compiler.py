@@ -0,0 +1,87 @@
+"""Checks of rule_compiler.compress() by longest prefix match
+
+Every address of the routes must come out of the compressed rules on
+the port it had before; with an unknown next hop, every other address
+must get that one.
+"""
+
+import random
+import socket
+import struct
+
+import pytest
+
+import rule_compiler
+
+DROP = 'drop'
+
+
+def aton(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def ntoa(addr):
+    return socket.inet_ntoa(struct.pack('!I', addr))
+
+
+def lookup(rules, addr):
+    """Return the next hop of the longest prefix matching addr"""
+    best = None
+    for (network, length), hop in rules.items():
+        mask = (0xffffffff << (32 - length)) & 0xffffffff
+        if addr & mask == aton(network) and (best is None or
+                                             length > best[0]):
+            best = length, hop
+    return best[1] if best is not None else None
+
+
+def random_routes(rnd):
+    """Some host addresses, clustered or spread out, over a few ports"""
+    base = rnd.choice([aton('10.0.0.0'), rnd.getrandbits(32) & ~0xff])
+    span = rnd.choice([64, 256, 1 << 16, 1 << 32])
+    ports = rnd.randint(1, 5)
+    addrs = {(base + rnd.randrange(span)) & 0xffffffff
+             for _ in range(rnd.randint(1, 80))}
+    return {ntoa(addr): rnd.randint(1, ports) for addr in addrs}
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_compress_keeps_every_route(seed):
+    routes = random_routes(random.Random(seed))
+    rules = rule_compiler.compress(routes)
+    assert len(rules) <= len(routes)
+    assert ('0.0.0.0', 0) in rules
+    for ip, port in routes.items():
+        assert lookup(rules, aton(ip)) == port
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_compress_sends_unknown_addresses_to_unknown(seed):
+    rnd = random.Random(seed)
+    routes = random_routes(rnd)
+    rules = rule_compiler.compress(routes, unknown=DROP)
+    assert rules[('0.0.0.0', 0)] == DROP
+    known = {aton(ip) for ip in routes}
+    for ip, port in routes.items():
+        assert lookup(rules, aton(ip)) == port
+    probes = [(addr ^ bit) for addr in known
+              for bit in (1, 2, 1 << 7, 1 << 15, 1 << 31)]
+    probes += [rnd.getrandbits(32) for _ in range(100)]
+    for addr in probes:
+        if addr not in known:
+            assert lookup(rules, addr) == DROP
+
+
+def test_compress_aggregates():
+    routes = {'10.0.0.%d' % i: 1 for i in range(256)}
+    assert rule_compiler.compress(routes) == {('0.0.0.0', 0): 1}
+    assert rule_compiler.compress(routes, unknown=DROP) == {
+        ('0.0.0.0', 0): DROP, ('10.0.0.0', 24): 1}
+    routes['10.0.0.7'] = 2
+    assert rule_compiler.compress(routes) == {('0.0.0.0', 0): 1,
+                                              ('10.0.0.7', 32): 2}
+
+
+def test_compress_nothing():
+    assert rule_compiler.compress({}) == {}
+    assert rule_compiler.compress({}, unknown=DROP) == {}
@@ -9,34 +9,190 @@ change its structure, or replace it entirely.
 
 """
 
+import time
+from array import array
+
 from ryu.topology.switches import Port, Switch, Link
 
+NO_NODE = -1
+
+
+class TopoGraph():
+    """Compact store of the switch graph
+
+    Every switch gets a dense integer node id the first time its DPID is
+    seen.  The id is kept when the switch leaves and comes back, so
+    per-node arrays held elsewhere (route trees) never need remapping.
+
+    The links of node n live in three parallel array('i') rows:
+    adj[n][i] is the neighbour, port[n][i] the local port leading to it
+    and peer_port[n][i] the neighbour's port leading back.  csr() flattens
+    the rows into compressed sparse row arrays for bulk algorithms.
+
+    Hosts get dense ids of their own; host_switch/host_port hold the node
+    and port each host is attached to (NO_NODE when detached).
+    """
+    def __init__(self):
+        self.dpids = []             # node id -> dpid
+        self.nodes = {}             # dpid -> node id
+        self.present = bytearray()  # node id -> 1 while the switch is up
+        self.adj = []
+        self.port = []
+        self.peer_port = []
+        self.hosts = []             # node id -> ids of attached hosts
+
+        self.host_ids = {}          # mac -> host id
+        self.host_switch = array('i')
+        self.host_port = array('i')
+
+        self.version = 0            # bumped whenever a link changes
+        self._csr = None
+
+    def __len__(self):
+        return len(self.dpids)
+
+    def node(self, dpid):
+        """Return the node id of a DPID, allocating one if needed"""
+        nid = self.nodes.get(dpid)
+        if nid is None:
+            nid = len(self.dpids)
+            self.nodes[dpid] = nid
+            self.dpids.append(dpid)
+            self.present.append(0)
+            self.adj.append(array('i'))
+            self.port.append(array('i'))
+            self.peer_port.append(array('i'))
+            self.hosts.append([])
+        return nid
+
+    def add_node(self, dpid):
+        nid = self.node(dpid)
+        self.present[nid] = 1
+        return nid
+
+    def remove_node(self, dpid):
+        """Mark a switch as gone and drop all of its links"""
+        nid = self.nodes.get(dpid)
+        if nid is None:
+            return None
+        for peer in list(self.adj[nid]):
+            self.remove_link(nid, peer)
+        self.present[nid] = 0
+        return nid
+
+    def is_up(self, nid):
+        return 0 <= nid < len(self.present) and self.present[nid] == 1
+
+    def _find(self, a, b):
+        row = self.adj[a]
+        for i in range(len(row)):
+            if row[i] == b:
+                return i
+        return -1
+
+    def _put(self, a, b, port_a, port_b):
+        i = self._find(a, b)
+        if i < 0:
+            self.adj[a].append(b)
+            self.port[a].append(port_a)
+            self.peer_port[a].append(port_b)
+        else:
+            self.port[a][i] = port_a
+            self.peer_port[a][i] = port_b
+
+    def _drop(self, a, b):
+        i = self._find(a, b)
+        if i < 0:
+            return
+        # Move the last entry into the hole so the rows stay packed
+        for row in (self.adj[a], self.port[a], self.peer_port[a]):
+            row[i] = row[-1]
+            row.pop()
+
+    def add_link(self, a, port_a, b, port_b):
+        """Add (or update) the link a/port_a <-> b/port_b"""
+        self._put(a, b, port_a, port_b)
+        self._put(b, a, port_b, port_a)
+        self.version += 1
+
+    def remove_link(self, a, b, port_a=None):
+        """Remove the link between a and b; when port_a is given only if
+        the link still leaves a on that port"""
+        i = self._find(a, b)
+        if i < 0 or (port_a is not None and self.port[a][i] != port_a):
+            return False
+        self._drop(a, b)
+        self._drop(b, a)
+        self.version += 1
+        return True
+
+    def port_to(self, a, b):
+        """Return the port of a leading to b, or None"""
+        i = self._find(a, b)
+        if i < 0:
+            return None
+        return self.port[a][i]
+
+    def csr(self):
+        """
+        Return (offsets, targets, ports, peer_ports) describing the whole
+        graph in CSR form: the links of node n are the entries
+        offsets[n]:offsets[n + 1] of the other three arrays.  The result
+        is cached until the next link change.
+        """
+        if self._csr is None or self._csr[0] != self.version:
+            offsets = array('i', [0])
+            targets = array('i')
+            ports = array('i')
+            peer_ports = array('i')
+            for nid in range(len(self.adj)):
+                targets.extend(self.adj[nid])
+                ports.extend(self.port[nid])
+                peer_ports.extend(self.peer_port[nid])
+                offsets.append(len(targets))
+            self._csr = (self.version, (offsets, targets, ports, peer_ports))
+        return self._csr[1]
+
+    def host(self, mac):
+        """Return the host id of a MAC, allocating one if needed"""
+        hid = self.host_ids.get(mac)
+        if hid is None:
+            hid = len(self.host_switch)
+            self.host_ids[mac] = hid
+            self.host_switch.append(NO_NODE)
+            self.host_port.append(0)
+        return hid
+
+    def attach_host(self, hid, nid, port):
+        self.detach_host(hid)
+        self.host_switch[hid] = nid
+        self.host_port[hid] = port
+        self.hosts[nid].append(hid)
+
+    def detach_host(self, hid):
+        nid = self.host_switch[hid]
+        if nid != NO_NODE:
+            self.hosts[nid].remove(hid)
+            self.host_switch[hid] = NO_NODE
+
+
 class Device():
     """Base class to represent an device in the network.
 
-    Any device (switch or host) has a name (used for debugging only)
-    and a set of neighbors.
+    Any device (switch or host) has a name (used for debugging only).
+    Devices are thin views: their links live in the TopoGraph of the
+    TopoManager they were added to.
     """
+    __slots__ = ('name', 'tm')
+
     def __init__(self, name):
         self.name = name
-        self.neighbors = set()
-        self.father = None
-
-    def add_neighbor(self, dev):
-        self.neighbors.add(dev)
+        self.tm = None
 
     def get_neighbors(self):
-        return self.neighbors
-    
-    def remove_neighbor(self,device):
-        if device in self.neighbors:
-            self.neighbors.remove(device)
-
-    def setFather(self,father):
-        self.father = father
-
-    def cleanFather(self):
-        self.father = None
+        """Return the devices linked to this one; a device that is not
+        part of a TopoManager has none"""
+        return []
 
     def __str__(self):
         return "{}({})\nneighbors:{}".format(self.__class__.__name__,
@@ -49,14 +205,13 @@ class TMSwitch(Device):
     This class is a wrapper around the Ryu Switch object,
     which contains information about the switch's ports
     """
+    __slots__ = ('switch', 'nid')
 
     def __init__(self, name, switch):
         super(TMSwitch, self).__init__(name)
 
         self.switch = switch
-        # pm_table : Port-Mac pair
-        self.pm_table = {}
-        # TODO:  Add more attributes as necessary
+        self.nid = NO_NODE
 
     def get_dpid(self):
         """Return switch DPID"""
@@ -71,21 +226,30 @@ class TMSwitch(Device):
         """Return switch datapath object"""
         return self.switch.dp
 
-    def set_pm_table(self, port, mac):
-        self.pm_table[mac] = port
+    def get_neighbors(self):
+        if self.tm is None:
+            return []
+        graph = self.tm.graph
+        neighbors = [self.tm.switches[graph.dpids[n]]
+                     for n in graph.adj[self.nid]]
+        neighbors += [self.tm.host_list[h] for h in graph.hosts[self.nid]]
+        return neighbors
+
+    def get_link_port(self, device):
+        """Return the local port leading to a neighbouring device"""
+        graph = self.tm.graph
+        if isinstance(device, TMHost):
+            if graph.host_switch[device.hid] == self.nid:
+                return graph.host_port[device.hid]
+            return None
+        return graph.port_to(self.nid, device.nid)
 
-    def get_link_port(self, mac):
-        return self.pm_table[mac]
-        
     def topo_str(self):
         return super(TMSwitch, self).__str__(self)
 
     def __str__(self):
         return "switch{}".format(self.get_dpid())
 
-    def del_pm_link(self, mac): 
-        if mac in self.pm_table.keys():
-            del self.pm_table[mac]
 
 class TMHost(Device):
     """Representation of a host, extends Device
@@ -94,11 +258,13 @@ class TMHost(Device):
     which contains information about the switch port to which
     the host is connected
     """
+    __slots__ = ('host', 'hid')
 
     def __init__(self, name, host):
-        super(TMHost, self).__init__(host)
+        super(TMHost, self).__init__(name)
 
         self.host = host
+        self.hid = NO_NODE
 
     def get_mac(self):
         return self.host.mac
@@ -109,60 +275,186 @@ class TMHost(Device):
     def get_port(self):
         """Return Ryu port object for this host"""
         return self.host.port
-    
+
+    def get_neighbors(self):
+        if self.tm is None:
+            return []
+        graph = self.tm.graph
+        nid = graph.host_switch[self.hid]
+        if nid == NO_NODE:
+            return []
+        return [self.tm.switches[graph.dpids[nid]]]
+
     def topo_str(self):
         return super(TMHost, self).__str__(self)
 
     def __str__(self):
-        return "Host "+self.get_ips()[0]
+        ips = self.get_ips()
+        return "Host "+(ips[0] if ips else self.get_mac())
 
 
 class TopoManager():
     """
     Example class for keeping track of the network topology
 
+    Devices are indexed so that the lookups done on every topology event
+    and packet-in are O(1) instead of a scan over all devices.  Links are
+    kept in a compact TopoGraph rather than in per-device sets.
+
+    Hosts remember when they were last heard from, so that the ones gone
+    quiet can be aged out with stale_hosts().
     """
     def __init__(self):
-        # TODO:  Initialize some data structures
-        self.all_devices = []
+        self.graph = TopoGraph()
+        self.switches = {}      # dpid -> TMSwitch
+        self.switch_ports = {}  # (dpid, port_no) -> TMSwitch
+        self.port_numbers = {}  # dpid -> set of port_no
+        self.hosts = {}         # mac -> TMHost
+        self.host_list = []     # host id -> TMHost
+        self.host_ips = {}      # ip -> TMHost
+        self.last_seen = {}     # mac -> time the host was last heard from
         self.ARPTable = {}; # store the ip address : Mac address pair
+        self.arp_listeners = []  # called with an ip whose entry changed
+
+    @property
+    def all_devices(self):
+        return list(self.switches.values()) + list(self.hosts.values())
+
+    def add_arp_listener(self, listener):
+        """Call listener(ip) whenever the ARP table entry of ip changes"""
+        self.arp_listeners.append(listener)
+
+    def _arp_changed(self, ip):
+        for listener in self.arp_listeners:
+            listener(ip)
 
     def add_switch(self, switch):
-        self.all_devices.append(switch)
+        switch.tm = self
+        switch.nid = self.graph.add_node(switch.get_dpid())
+        self.switches[switch.get_dpid()] = switch
+        for port in switch.get_ports():
+            self.add_port(port)
+
+    def add_port(self, port):
+        switch = self.switches.get(port.dpid)
+        if switch is not None:
+            self.switch_ports[(port.dpid, port.port_no)] = switch
+            self.port_numbers.setdefault(port.dpid, set()).add(port.port_no)
+
+    def delete_port(self, port):
+        self.switch_ports.pop((port.dpid, port.port_no), None)
+        self.port_numbers.get(port.dpid, set()).discard(port.port_no)
 
     def add_host(self, host):
-        self.all_devices.append(host)
+        old = self.hosts.get(host.get_mac())
+        if old is not None and old is not host:
+            self.delete_host(old)
+        host.tm = self
+        host.hid = self.graph.host(host.get_mac())
+        if host.hid == len(self.host_list):
+            self.host_list.append(host)
+        else:
+            self.host_list[host.hid] = host
+        self.hosts[host.get_mac()] = host
+        self.last_seen[host.get_mac()] = time.time()
+        self.addARPTable(host)
+
+    def attach_host(self, host, switch):
+        """Link a host to the switch port it was discovered on"""
+        self.graph.attach_host(host.hid, switch.nid,
+                               host.get_port().port_no)
+
+    def detach_host(self, host):
+        self.graph.detach_host(host.hid)
+
+    def move_host(self, host, ryu_host, switch):
+        """Re-attach a known host after Ryu reports it on a new port"""
+        self.detach_host(host)
+        host.host = ryu_host
+        if switch is not None:
+            self.attach_host(host, switch)
+        self.last_seen[host.get_mac()] = time.time()
         self.addARPTable(host)
 
+    def delete_host(self, host):
+        self.detach_host(host)
+        if self.hosts.get(host.get_mac()) is host:
+            del self.hosts[host.get_mac()]
+            self.last_seen.pop(host.get_mac(), None)
+        for ip in host.get_ips():
+            if self.host_ips.get(ip) is host:
+                del self.host_ips[ip]
+            if self.ARPTable.get(ip) == host.get_mac():
+                del self.ARPTable[ip]
+                self._arp_changed(ip)
+
+    def host_seen(self, mac, now=None):
+        """Note that a known host was heard from"""
+        if mac in self.hosts:
+            self.last_seen[mac] = time.time() if now is None else now
+
+    def stale_hosts(self, max_age, now=None):
+        """Return the hosts not heard from for more than max_age seconds"""
+        now = time.time() if now is None else now
+        return [self.hosts[mac] for mac, seen in self.last_seen.items()
+                if now - seen > max_age]
+
+    def add_link(self, src_port, dst_port):
+        """Record a link between two switch ports, in both directions"""
+        src = self.find_switch_by_port(src_port)
+        dst = self.find_switch_by_port(dst_port)
+        if src is None or dst is None:
+            return None
+        self.graph.add_link(src.nid, src_port.port_no,
+                            dst.nid, dst_port.port_no)
+        return src, dst
+
+    def delete_link(self, src_port, dst_port):
+        """Forget a link between two switch ports, in both directions"""
+        src = self.find_switch_by_port(src_port)
+        dst = self.find_switch_by_port(dst_port)
+        if src is None or dst is None:
+            return None
+        self.graph.remove_link(src.nid, dst.nid, src_port.port_no)
+        return src, dst
+
+    def get_edge_ports(self, switch):
+        """Return the ports of a switch that are not on a switch link,
+        i.e. the ports hosts may be attached to"""
+        links = set(self.graph.port[switch.nid])
+        return sorted(p for p in self.port_numbers.get(switch.get_dpid(), ())
+                      if p not in links)
+
     def find_switch_by_port(self,port):
-        for device in self.all_devices:
-            if isinstance(device,TMSwitch):
-                 if port in device.get_ports():
-                    return device
-    
+        return self.switch_ports.get((port.dpid, port.port_no))
+
     def find_tmswitch_by_dpid(self,dpid):
-        for device in self.all_devices:
-            if isinstance(device,TMSwitch):
-                if device.get_dpid() == dpid:
-                    return device
+        return self.switches.get(dpid)
 
     def find_host_by_mac(self,mac):
-        for device in self.all_devices:
-            if isinstance(device,TMHost):
-                if device.get_mac == mac:
-                    return device
+        return self.hosts.get(mac)
+
+    def find_host_by_ip(self,ip):
+        return self.host_ips.get(ip)
 
     def addARPTable(self,host):
         iplist = host.get_ips()
         macobj = host.get_mac()
         for i in range(0,len(iplist)):
-            self.ARPTable[iplist[i]] = macobj
+            if self.ARPTable.get(iplist[i]) != macobj:
+                self.ARPTable[iplist[i]] = macobj
+                self._arp_changed(iplist[i])
+            self.host_ips[iplist[i]] = host
 
     def deleteSwitch(self,switch):
-        self.all_devices.remove(switch)
-        print("remove:%s"%(switch))
-        for device in self.all_devices:
-            if switch in device.get_neighbors():
-                device.remove_neighbor(switch)
-            print("device: %s"%(device))
-                
+        dpid = switch.get_dpid()
+        if self.switches.get(dpid) is switch:
+            del self.switches[dpid]
+        for port in switch.get_ports():
+            if self.switch_ports.get((dpid, port.port_no)) is switch:
+                del self.switch_ports[(dpid, port.port_no)]
+        if dpid not in self.switches:
+            self.port_numbers.pop(dpid, None)
+            for hid in list(self.graph.hosts[switch.nid]):
+                self.graph.detach_host(hid)
+            self.graph.remove_node(dpid)